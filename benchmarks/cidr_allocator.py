@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Measure the client CIDR block allocation in large organisations.
+
+Each round generates the prefixes of a synthetic organisation (VPC CIDRs,
+peered VPCs and routes, most of them in 10.0.0.0/8), builds the prefix index
+and allocates a /22 next to one of the VPCs. The allocated block is checked
+against every prefix.
+
+    python3 benchmarks/cidr_allocator.py --prefixes 1000,10000,100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import ipaddress
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vpc_vpn_pivot.allocator import allocate
+from vpc_vpn_pivot.utils.cidr import PrefixIndex
+from vpc_vpn_pivot.constants import PRIVATE_RANGES
+
+
+def synthetic_prefixes(count, rng):
+    """
+    :return: `count` random prefixes between /16 and /32, 80% of them in
+             10.0.0.0/8 so that the allocator has to skip many used blocks
+    """
+    ranges = [ipaddress.ip_network(r) for r in PRIVATE_RANGES]
+    prefixes = []
+
+    for _ in range(count):
+        network = ranges[0] if rng.random() < 0.8 else rng.choice(ranges[1:])
+        prefix_length = 16 if rng.random() < 0.001 else rng.choice((20, 22, 24, 24, 26, 28, 32))
+
+        address = int(network.network_address) + rng.randrange(network.num_addresses)
+        prefixes.append(str(ipaddress.ip_network((address, prefix_length), strict=False)))
+
+    return prefixes
+
+
+def overlaps_any(cidr_block, prefixes):
+    network = ipaddress.ip_network(cidr_block)
+    return any(network.overlaps(ipaddress.ip_network(p)) for p in prefixes)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Client CIDR allocator benchmark')
+
+    parser.add_argument('--prefixes',
+                        help='Comma separated list with the number of prefixes in use',
+                        default='1000,10000,50000,100000')
+
+    parser.add_argument('--rounds',
+                        help='Number of organisations to generate per size',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--seed',
+                        help='Random seed',
+                        type=int,
+                        default=0)
+
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    rng = random.Random(options.seed)
+
+    print('%-10s %8s %14s %16s  %s' % ('prefixes', 'ranges', 'build avg ms',
+                                       'allocate avg ms', 'last block'))
+
+    for count in [int(c) for c in options.prefixes.split(',')]:
+        build_times = []
+        allocate_times = []
+
+        for _ in range(options.rounds):
+            prefixes = synthetic_prefixes(count, rng)
+            vpc_cidr = rng.choice(prefixes)
+
+            start = time.perf_counter()
+            index = PrefixIndex(prefixes)
+            ranges = len(index)
+            build_times.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            cidr_block = allocate(index, [vpc_cidr])
+            allocate_times.append((time.perf_counter() - start) * 1000)
+
+            if cidr_block is None:
+                print('No free block found for %s prefixes' % count)
+                return 1
+
+            if overlaps_any(cidr_block, prefixes):
+                print('%s overlaps a prefix in use' % cidr_block)
+                return 1
+
+        args = (count, ranges, statistics.mean(build_times),
+                statistics.mean(allocate_times), cidr_block)
+        print('%-10s %8s %14.1f %16.3f  %s' % args)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
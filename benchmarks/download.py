@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""
+Benchmark the streaming download and extraction using a local HTTP server.
+
+A tarball with random content is generated and served from 127.0.0.1 by a
+small HTTP server which supports range requests. The first request can be
+cut after a number of bytes to exercise the resume code.
+
+    python3 benchmarks/download.py --size-mb 64 --interrupt-at-mb 20
+"""
+import os
+import sys
+import io
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vpc_vpn_pivot.utils.download import stream_download, DownloadError
+from vpc_vpn_pivot.utils.misc import sha256_file
+
+
+def create_tarball(filename, size_mb):
+    with tarfile.open(filename, 'w:gz') as tf:
+        for i in range(max(size_mb, 1)):
+            data = os.urandom(1024 * 1024)
+            info = tarfile.TarInfo('release/file-%03d.bin' % i)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+def create_handler(filename, interrupt_at):
+    data = open(filename, 'rb').read()
+    state = {'interrupted': interrupt_at is None}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            start = 0
+            range_header = self.headers.get('Range')
+
+            if range_header:
+                start = int(range_header.split('=')[1].split('-')[0])
+
+                if start >= len(data):
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, len(data) - 1, len(data)))
+            else:
+                self.send_response(200)
+
+            body = data[start:]
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            if not state['interrupted']:
+                state['interrupted'] = True
+                self.wfile.write(body[:interrupt_at])
+                self.wfile.flush()
+                self.connection.close()
+                return
+
+            self.wfile.write(body)
+
+    return Handler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Streaming download benchmark')
+
+    parser.add_argument('--size-mb',
+                        help='Size of the generated tarball (uncompressible content)',
+                        type=int,
+                        default=32)
+
+    parser.add_argument('--interrupt-at-mb',
+                        help='Cut the first transfer after this many MiB to test resume',
+                        type=float,
+                        default=None)
+
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    workdir = tempfile.mkdtemp(prefix='vpc-vpn-pivot-bench-')
+
+    try:
+        source = os.path.join(workdir, 'release.tgz')
+        create_tarball(source, options.size_mb)
+        expected_sha256 = sha256_file(source)
+
+        interrupt_at = None
+        if options.interrupt_at_mb is not None:
+            interrupt_at = int(options.interrupt_at_mb * 1024 * 1024)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), create_handler(source, interrupt_at))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        url = 'http://127.0.0.1:%s/release.tgz' % server.server_address[1]
+        target = os.path.join(workdir, 'download.tgz')
+        extract_to = os.path.join(workdir, 'extracted')
+        os.makedirs(extract_to)
+
+        for attempt in range(1, 4):
+            start = time.time()
+
+            try:
+                stats = stream_download(url, target,
+                                        extract_to=extract_to,
+                                        expected_sha256=expected_sha256,
+                                        timeout=(5, 5))
+            except DownloadError as e:
+                print('attempt %s failed after %.2fs: %s' % (attempt, time.time() - start, e))
+                continue
+
+            print('attempt %s: %s' % (attempt, stats))
+            print('extracted %s files' % len(os.listdir(os.path.join(extract_to, 'release'))))
+            break
+        else:
+            return 1
+
+        server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+"""
+Compare the cost of the supported key algorithms.
+
+For each algorithm this measures the private key generation time and the
+cost of a TLS handshake between two in-memory endpoints using a certificate
+with that key type, which is what the OpenVPN control channel pays on each
+(re)connect.
+
+    python3 benchmarks/keygen.py --rounds 10
+"""
+import os
+import sys
+import ssl
+import time
+import argparse
+import datetime
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vpc_vpn_pivot.constants import KEY_ALGORITHMS
+from vpc_vpn_pivot.ssl.keys import generate_key, serialize_key
+
+
+def self_signed_cert(key):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'server')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    crt = x509.CertificateBuilder(
+    ).subject_name(
+        name
+    ).issuer_name(
+        name
+    ).public_key(
+        key.public_key()
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now
+    ).not_valid_after(
+        now + datetime.timedelta(days=1)
+    ).sign(key, hashes.SHA256())
+
+    return crt.public_bytes(serialization.Encoding.PEM)
+
+
+def handshake_contexts(algorithm, workdir):
+    key = generate_key(algorithm)
+
+    crt_filename = os.path.join(workdir, '%s.crt' % algorithm)
+    key_filename = os.path.join(workdir, '%s.key' % algorithm)
+
+    with open(crt_filename, 'wb') as f:
+        f.write(self_signed_cert(key))
+
+    with open(key_filename, 'wb') as f:
+        f.write(serialize_key(key))
+
+    server = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server.load_cert_chain(crt_filename, key_filename)
+
+    client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client.load_verify_locations(crt_filename)
+    client.check_hostname = False
+
+    return server, client
+
+
+def handshake(server_context, client_context):
+    """
+    Run a full TLS handshake using memory BIOs, no sockets are involved
+    """
+    c2s, s2c = ssl.MemoryBIO(), ssl.MemoryBIO()
+    s_in, s_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+
+    client = client_context.wrap_bio(s2c, c2s, server_side=False)
+    server = server_context.wrap_bio(s_in, s_out, server_side=True)
+
+    client_done = server_done = False
+
+    while not (client_done and server_done):
+        if not client_done:
+            try:
+                client.do_handshake()
+                client_done = True
+            except ssl.SSLWantReadError:
+                pass
+
+        s_in.write(c2s.read())
+
+        if not server_done:
+            try:
+                server.do_handshake()
+                server_done = True
+            except ssl.SSLWantReadError:
+                pass
+
+        s2c.write(s_out.read())
+
+
+def timed(function, rounds):
+    times = []
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return statistics.mean(times), max(times)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Key algorithm benchmark')
+
+    parser.add_argument('--rounds',
+                        help='Number of keys to generate and handshakes to run per algorithm',
+                        type=int,
+                        default=10)
+
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+
+    print('%-10s %14s %14s %16s' % ('algorithm', 'keygen avg ms', 'keygen max ms', 'handshake avg ms'))
+
+    with tempfile.TemporaryDirectory(prefix='vpc-vpn-pivot-bench-') as workdir:
+        for algorithm in KEY_ALGORITHMS:
+            keygen_avg, keygen_max = timed(lambda: generate_key(algorithm), options.rounds)
+
+            server, client = handshake_contexts(algorithm, workdir)
+            handshake_avg, _ = timed(lambda: handshake(server, client), options.rounds)
+
+            args = (algorithm, keygen_avg, keygen_max, handshake_avg)
+            print('%-10s %14.1f %14.1f %16.2f' % args)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+Measure the import time of each vpc-vpn-pivot sub-command.
+
+Each sub-command is loaded in a fresh interpreter using `python -X importtime`
+and the output is aggregated to show the total import time and the modules
+which are the most expensive to import.
+
+    python3 benchmarks/startup_time.py
+    python3 benchmarks/startup_time.py --budget status=80 --budget disconnect=80
+
+When a budget (in milliseconds) is exceeded the script returns 1, which makes
+it usable to catch startup time regressions.
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vpc_vpn_pivot.main import ALL_COMMANDS
+
+LOAD_CMD = ('from vpc_vpn_pivot.main import load_command;'
+            ' load_command(%r)')
+
+BASELINE = 'baseline'
+
+
+def import_times(subcommand):
+    """
+    :param subcommand: The sub-command to load, or BASELINE to measure the
+                       interpreter startup imports only
+    :return: A list containing (self_us, cumulative_us, module) tuples
+    """
+    code = 'pass' if subcommand == BASELINE else LOAD_CMD % subcommand
+
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    completed_process = subprocess.run(cmd,
+                                       cwd=ROOT,
+                                       check=True,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+
+    result = []
+
+    for line in completed_process.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        result.append((int(self_us), int(cumulative_us), module.strip()))
+
+    return result
+
+
+def measure(subcommand, repeat):
+    """
+    :return: A tuple containing the median total import time in milliseconds
+             and the import times of the last run
+    """
+    totals = []
+    times = []
+
+    for _ in range(repeat):
+        times = import_times(subcommand)
+        totals.append(sum(t[0] for t in times) / 1000.0)
+
+    return statistics.median(totals), times
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Sub-command import time benchmark')
+
+    parser.add_argument('--repeat',
+                        help='Number of runs per sub-command',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--top',
+                        help='Number of most expensive modules to show',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--budget',
+                        help='Max import time in milliseconds, eg. status=80',
+                        action='append',
+                        default=[])
+
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+
+    budgets = dict((k, float(v)) for k, v in
+                   (b.split('=', 1) for b in options.budget))
+    exit_code = 0
+
+    baseline_ms, _ = measure(BASELINE, options.repeat)
+    print('%-12s %8.1f ms (interpreter startup, not included below)' % (BASELINE, baseline_ms))
+
+    for subcommand in sorted(ALL_COMMANDS):
+        try:
+            total_ms, times = measure(subcommand, options.repeat)
+        except subprocess.CalledProcessError as e:
+            print('%-12s failed to import: %s' % (subcommand, e.stderr.decode('utf-8').splitlines()[-1]))
+            exit_code = 1
+            continue
+
+        total_ms -= baseline_ms
+
+        budget = budgets.get(subcommand)
+        over_budget = budget is not None and total_ms > budget
+
+        if over_budget:
+            exit_code = 1
+
+        print('%-12s %8.1f ms%s' % (subcommand,
+                                    total_ms,
+                                    '  (over %.1f ms budget)' % budget if over_budget else ''))
+
+        top_level = {}
+        for self_us, _, module in times:
+            name = module.split('.')[0]
+            top_level[name] = top_level.get(name, 0) + self_us
+
+        ranked = sorted(top_level.items(), key=lambda x: x[1], reverse=True)
+        for name, self_us in ranked[:options.top]:
+            print('    %-30s %8.1f ms' % (name, self_us / 1000.0))
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+import socket
+import struct
+import ipaddress
+
+from vpc_vpn_pivot import inventory
+from vpc_vpn_pivot.clients import get_client
+from vpc_vpn_pivot.constants import (CLIENT_CIDR_PREFIX_LENGTH,
+                                     MIN_CLIENT_CIDR_PREFIX_LENGTH,
+                                     MAX_CLIENT_CIDR_PREFIX_LENGTH,
+                                     PRIVATE_RANGES)
+from vpc_vpn_pivot.utils.cidr import to_interval, to_prefix
+from vpc_vpn_pivot.utils.misc import map_concurrently
+
+PROC_NET_ROUTE = '/proc/net/route'
+
+#
+# Routes which cover this many addresses or more (default routes, 0/1 + 128/1
+# VPN tricks, etc.) don't mean that the addresses are in use
+#
+MIN_IN_USE_PREFIX_LENGTH = 8
+
+VPC_CIDR_STATES = ('associating', 'associated')
+
+
+def allocate(index, vpc_cidrs, prefix_length=CLIENT_CIDR_PREFIX_LENGTH):
+    """
+    Find a free block for the VPN clients. The block closest to one of the
+    VPC CIDRs, inside the same private range, is preferred: security groups
+    which allow a summary of the VPC network (eg. 10.0.0.0/16 for a VPC with
+    10.0.1.0/24) are more likely to allow the VPN clients too.
+
+    :param index: A PrefixIndex with the prefixes in use
+    :param vpc_cidrs: The CIDR blocks of the target VPC
+    :param prefix_length: The size of the block, AWS Client VPN accepts
+                          /12 to /22
+    :return: The CIDR block, None if all the private ranges are full
+    """
+    if not MIN_CLIENT_CIDR_PREFIX_LENGTH <= prefix_length <= MAX_CLIENT_CIDR_PREFIX_LENGTH:
+        args = (MIN_CLIENT_CIDR_PREFIX_LENGTH, MAX_CLIENT_CIDR_PREFIX_LENGTH)
+        raise ValueError('The client CIDR block must be between /%s and /%s' % args)
+
+    ranges = [to_interval(r) for r in PRIVATE_RANGES]
+    size = 2 ** (32 - prefix_length)
+
+    best = None
+
+    for vpc_cidr in vpc_cidrs:
+        vpc_start, vpc_end = to_interval(vpc_cidr)
+
+        for lower, upper in ranges:
+            if not lower <= vpc_start <= upper:
+                continue
+
+            after = index.first_free(prefix_length, vpc_end + 1, upper)
+            before = index.last_free(prefix_length, lower, vpc_start - 1)
+
+            candidates = []
+
+            if after is not None:
+                candidates.append((after - vpc_end, after))
+
+            if before is not None:
+                candidates.append((vpc_start - (before + size - 1), before))
+
+            for candidate in candidates:
+                if best is None or candidate < best:
+                    best = candidate
+
+    if best is not None:
+        return to_prefix(best[1], prefix_length)
+
+    #
+    # The VPC is not in a private range, or its range is full
+    #
+    for lower, upper in ranges:
+        start = index.first_free(prefix_length, lower, upper)
+
+        if start is not None:
+            return to_prefix(start, prefix_length)
+
+    return None
+
+
+def in_use_prefixes(profile, region):
+    """
+    Collect the prefixes which the VPN clients must not use: the networks of
+    this workstation and the ones reachable from the VPCs in the region
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :return: A list of prefixes
+    """
+    prefixes = local_prefixes() + aws_prefixes(profile, region)
+
+    return [p for p in prefixes
+            if ipaddress.ip_network(p, strict=False).prefixlen >= MIN_IN_USE_PREFIX_LENGTH]
+
+
+def local_prefixes():
+    """
+    :return: The networks of the local interfaces and the routes in the
+             main routing table of this workstation
+    """
+    prefixes = []
+
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil is not None:
+        for addresses in psutil.net_if_addrs().values():
+            for address in addresses:
+                if address.family != socket.AF_INET or not address.netmask:
+                    continue
+
+                prefixes.append('%s/%s' % (address.address, address.netmask))
+
+    prefixes.extend(linux_routes())
+    return prefixes
+
+
+def linux_routes():
+    """
+    :return: The destinations in /proc/net/route, an empty list on other
+             operating systems
+    """
+    try:
+        with open(PROC_NET_ROUTE) as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return []
+
+    routes = []
+
+    for line in lines:
+        fields = line.split()
+
+        if len(fields) < 8:
+            continue
+
+        #
+        # The addresses are little endian hex numbers
+        #
+        destination = socket.inet_ntoa(struct.pack('<I', int(fields[1], 16)))
+        netmask = socket.inet_ntoa(struct.pack('<I', int(fields[7], 16)))
+
+        routes.append('%s/%s' % (destination, netmask))
+
+    return routes
+
+
+def aws_prefixes(profile, region):
+    """
+    :return: All the CIDR blocks associated with the VPCs in the region, the
+             CIDR blocks of the peered VPCs and the destinations of the VPC
+             and transit gateway routes
+    """
+    prefixes = []
+
+    for vpc in inventory.list_resources(profile, region, 'vpc'):
+        for association in vpc.get('CidrBlockAssociationSet', []):
+            if association['CidrBlockState']['State'] in VPC_CIDR_STATES:
+                prefixes.append(association['CidrBlock'])
+
+    for peering in inventory.list_resources(profile, region, 'vpc_peering_connection'):
+        for side in ('AccepterVpcInfo', 'RequesterVpcInfo'):
+            for cidr_block in peering.get(side, {}).get('CidrBlockSet', []):
+                prefixes.append(cidr_block['CidrBlock'])
+
+    for route_table in inventory.list_resources(profile, region, 'route_table'):
+        for route in route_table.get('Routes', []):
+            if route.get('DestinationCidrBlock'):
+                prefixes.append(route['DestinationCidrBlock'])
+
+    prefixes.extend(transit_gateway_prefixes(profile, region))
+
+    return prefixes
+
+
+def transit_gateway_prefixes(profile, region):
+    """
+    :return: The destinations of the routes in all the transit gateway route
+             tables, an empty list when they can't be read
+    """
+    ec2_client = get_client('ec2', profile, region)
+
+    try:
+        paginator = ec2_client.get_paginator('describe_transit_gateway_route_tables')
+        route_table_ids = [t['TransitGatewayRouteTableId']
+                           for page in paginator.paginate()
+                           for t in page['TransitGatewayRouteTables']]
+    except Exception as e:
+        print('Failed to describe the transit gateway route tables: %s' % e)
+        return []
+
+    def search(route_table_id):
+        response = ec2_client.search_transit_gateway_routes(
+            TransitGatewayRouteTableId=route_table_id,
+            Filters=[{'Name': 'state', 'Values': ['active', 'blackhole']}],
+        )
+        return [r['DestinationCidrBlock'] for r in response['Routes']
+                if r.get('DestinationCidrBlock')]
+
+    prefixes = []
+
+    for route_table_id, routes, error in map_concurrently(search, route_table_ids):
+        if error is not None:
+            print('Failed to search the routes of %s: %s' % (route_table_id, error))
+            continue
+
+        prefixes.extend(routes)
+
+    return prefixes
+
+
+def vpc_cidr_blocks(vpc):
+    """
+    :param vpc: A VPC as returned by describe_vpcs()
+    :return: The primary and secondary IPv4 CIDR blocks of the VPC
+    """
+    cidr_blocks = [a['CidrBlock'] for a in vpc.get('CidrBlockAssociationSet', [])
+                   if a['CidrBlockState']['State'] in VPC_CIDR_STATES]
+
+    return cidr_blocks or [vpc['CidrBlock']]
+
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import socket
+import struct
+
+from vpc_vpn_pivot.state import State
+from vpc_vpn_pivot.watch import percentile
+from vpc_vpn_pivot.bench_server import SESSION, REPORT, serve
+
+TCP_CHUNK_SIZE = 64 * 1024
+LATENCY_MESSAGE_SIZE = 64
+SOCKET_TIMEOUT = 5
+REPORT_ATTEMPTS = 3
+
+#
+# Above this UDP loss the result is flagged: the sink, not the tunnel, might
+# be dropping the datagrams
+#
+UDP_LOSS_WARNING = 5.0
+
+
+def bench(options):
+    """
+    Measure the throughput, latency and connection setup rate through the
+    tunnel against a host running bench_server.py
+
+    :param options: Options passed as command line arguments by the user
+    :return: Return code
+    """
+    if options.serve:
+        serve(options.bind, options.port)
+        return 0
+
+    if options.target is None:
+        print('The --target argument is required unless --serve is used')
+        return 1
+
+    state = State()
+    address = (options.target, options.port)
+
+    output = {'target': options.target,
+              'port': options.port,
+              'duration': options.duration,
+              'started': time.time(),
+              'vpn': {'transport': state.get('transport'),
+                      'vpn_port': state.get('vpn_port'),
+                      'time_to_connect': state.get('time_to_connect')},
+              'results': {}}
+
+    tests = {'tcp': bench_tcp_throughput,
+             'udp': bench_udp_throughput,
+             'latency': bench_latency,
+             'connect': bench_connect_rate}
+
+    failed = False
+
+    for name in options.tests:
+        print('Running %s benchmark against %s:%s...' % (name, options.target, options.port))
+
+        try:
+            result = tests[name](address, options)
+        except OSError as e:
+            print('    failed: %s' % e)
+            output['results'][name] = {'error': str(e)}
+            failed = True
+            continue
+
+        output['results'][name] = result
+
+        for key, value in sorted(result.items()):
+            if isinstance(value, float):
+                value = '%.3f' % value
+            print('    %-28s %s' % (key, value))
+
+    data = json.dumps(output, indent=4, sort_keys=True)
+
+    if options.output is None:
+        print('')
+        print(data)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+
+        print('Results written to %s' % options.output)
+
+    return 1 if failed else 0
+
+
+def bench_tcp_throughput(address, options):
+    """
+    Send data to the sink for `duration` seconds
+
+    :return: A dict with the results
+    """
+    chunk = os.urandom(TCP_CHUNK_SIZE)
+    sent = 0
+
+    sock = socket.create_connection(address, timeout=SOCKET_TIMEOUT)
+
+    with sock:
+        sock.sendall(b'S')
+
+        start = time.perf_counter()
+        deadline = start + options.duration
+
+        while time.perf_counter() < deadline:
+            sock.sendall(chunk)
+            sent += len(chunk)
+
+        sock.shutdown(socket.SHUT_WR)
+        received = struct.unpack('!Q', _recv_exactly(sock, 8))[0]
+        spent = time.perf_counter() - start
+
+    return {'bytes_sent': sent,
+            'bytes_received': received,
+            'seconds': spent,
+            'mbps': received * 8 / spent / 1e6}
+
+
+def bench_udp_throughput(address, options):
+    """
+    Send datagrams to the sink for `duration` seconds, at `udp_rate` Mbps
+    when set, then ask the server how many arrived
+
+    :return: A dict with the results
+    """
+    session = os.urandom(8)
+    payload = SESSION.pack(b'S', session)
+    payload += os.urandom(max(options.udp_size - len(payload), 0))
+
+    interval = 0.0
+    if options.udp_rate:
+        interval = len(payload) * 8 / (options.udp_rate * 1e6)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = 0
+
+    with sock:
+        sock.connect(address)
+        sock.settimeout(SOCKET_TIMEOUT)
+
+        start = time.perf_counter()
+        deadline = start + options.duration
+        next_send = start
+
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+
+            if interval and now < next_send:
+                time.sleep(next_send - now)
+
+            try:
+                sock.send(payload)
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+
+            sent += 1
+            next_send += interval
+
+        spent = time.perf_counter() - start
+
+        packets, received = _udp_report(sock, session)
+
+    result = {'packets_sent': sent,
+              'packets_received': packets,
+              'datagram_size': len(payload),
+              'loss_percent': 100.0 * (sent - packets) / sent if sent else 0.0,
+              'seconds': spent,
+              'send_mbps': sent * len(payload) * 8 / spent / 1e6,
+              'mbps': received * 8 / spent / 1e6}
+
+    if result['loss_percent'] > UDP_LOSS_WARNING:
+        result['warning'] = ('high loss, the benchmark server might be the bottleneck:'
+                             ' run again with a lower --udp-rate')
+
+    return result
+
+
+def _udp_report(sock, session):
+    request = SESSION.pack(b'R', session)
+
+    #
+    # Datagrams still in flight are counted after a short pause
+    #
+    time.sleep(0.5)
+
+    for _ in range(REPORT_ATTEMPTS):
+        sock.send(request)
+
+        try:
+            while True:
+                data = sock.recv(REPORT.size)
+
+                if len(data) != REPORT.size:
+                    continue
+
+                command, reply_session, packets, received = REPORT.unpack(data)
+
+                if command == b'R' and reply_session == session:
+                    return packets, received
+        except socket.timeout:
+            continue
+
+    raise OSError('The server did not answer the UDP report request')
+
+
+def bench_latency(address, options):
+    """
+    Send small messages to the TCP and UDP echo servers, one at a time, and
+    measure the round trip time
+
+    :return: A dict with the results in milliseconds
+    """
+    result = {}
+
+    message = os.urandom(LATENCY_MESSAGE_SIZE)
+    rtts = []
+
+    sock = socket.create_connection(address, timeout=SOCKET_TIMEOUT)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    with sock:
+        sock.sendall(b'E')
+
+        for _ in range(options.latency_count):
+            start = time.perf_counter()
+            sock.sendall(message)
+            _recv_exactly(sock, len(message))
+            rtts.append((time.perf_counter() - start) * 1000.0)
+
+    result.update(_distribution('tcp_rtt_ms', rtts))
+
+    session = os.urandom(8)
+    rtts = []
+    lost = 0
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    with sock:
+        sock.connect(address)
+        sock.settimeout(1)
+
+        for i in range(options.latency_count):
+            datagram = SESSION.pack(b'E', session) + struct.pack('!I', i)
+
+            start = time.perf_counter()
+            sock.send(datagram)
+
+            try:
+                while sock.recv(len(datagram)) != datagram:
+                    pass
+            except socket.timeout:
+                lost += 1
+                continue
+
+            rtts.append((time.perf_counter() - start) * 1000.0)
+
+    result.update(_distribution('udp_rtt_ms', rtts))
+    result['udp_lost'] = lost
+
+    return result
+
+
+def bench_connect_rate(address, options):
+    """
+    Open and close TCP connections sequentially for `duration` seconds
+
+    The rate is derived from the median time of each connection, a single
+    SYN retransmit (1 second) would dominate the average of a short run.
+
+    :return: A dict with the connection rate and setup times
+    """
+    setup_times = []
+    connection_times = []
+
+    start = time.perf_counter()
+    deadline = start + options.duration
+
+    while time.perf_counter() < deadline:
+        connect_start = time.perf_counter()
+        sock = socket.create_connection(address, timeout=SOCKET_TIMEOUT)
+        setup_times.append((time.perf_counter() - connect_start) * 1000.0)
+
+        with sock:
+            sock.sendall(b'C')
+
+        connection_times.append(time.perf_counter() - connect_start)
+
+    spent = time.perf_counter() - start
+
+    rate = 1.0 / percentile(connection_times, 50) if connection_times else 0.0
+
+    result = {'connections': len(setup_times),
+              'connections_per_second': rate,
+              'connections_per_second_wall': len(setup_times) / spent}
+    result.update(_distribution('setup_ms', setup_times))
+    return result
+
+
+def _distribution(prefix, values):
+    if not values:
+        return {'%s_count' % prefix: 0}
+
+    return {'%s_count' % prefix: len(values),
+            '%s_min' % prefix: min(values),
+            '%s_avg' % prefix: sum(values) / len(values),
+            '%s_p50' % prefix: percentile(values, 50),
+            '%s_p95' % prefix: percentile(values, 95),
+            '%s_p99' % prefix: percentile(values, 99),
+            '%s_max' % prefix: max(values)}
+
+
+def _recv_exactly(sock, size):
+    data = b''
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError('Connection closed by the server')
+        data += chunk
+
+    return data
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+"""
+Echo / sink server used by the `bench` sub-command.
+
+This file has no dependencies besides the standard library, so it can be
+copied to a host in the target VPC and started there:
+
+    python3 bench_server.py --port 5201
+
+TCP connections start with one command byte:
+
+    S   sink: read until EOF, then reply with the number of bytes received
+        (8 bytes, network order)
+    E   echo: send back everything received
+    C   connect: close the connection immediately
+
+UDP datagrams start with a command byte and an 8 byte session ID:
+
+    E   echo: the datagram is sent back
+    S   sink: the datagram is counted
+    R   report: reply with R, the session ID and the number of packets and
+        bytes received by the sink for that session (8 bytes each)
+"""
+import sys
+import struct
+import argparse
+import threading
+import socketserver
+
+DEFAULT_PORT = 5201
+BUFFER_SIZE = 256 * 1024
+
+SESSION = struct.Struct('!c8s')
+REPORT = struct.Struct('!c8sQQ')
+
+
+class TCPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        command = self.request.recv(1)
+
+        if command == b'S':
+            received = 0
+
+            while True:
+                data = self.request.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                received += len(data)
+
+            self.request.sendall(struct.pack('!Q', received))
+
+        elif command == b'E':
+            while True:
+                data = self.request.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                self.request.sendall(data)
+
+
+class UDPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+
+        if len(data) < SESSION.size:
+            return
+
+        command, session = SESSION.unpack_from(data)
+
+        if command == b'E':
+            sock.sendto(data, self.client_address)
+
+        elif command == b'S':
+            with self.server.lock:
+                packets, received = self.server.sessions.get(session, (0, 0))
+                self.server.sessions[session] = (packets + 1, received + len(data))
+
+        elif command == b'R':
+            with self.server.lock:
+                packets, received = self.server.sessions.get(session, (0, 0))
+
+            sock.sendto(REPORT.pack(b'R', session, packets, received), self.client_address)
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    #
+    # The default backlog of 5 drops SYNs during the connection rate test
+    #
+    request_queue_size = 128
+
+
+class UDPServer(socketserver.UDPServer):
+    allow_reuse_address = True
+    max_packet_size = 65535
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+
+def serve(bind='0.0.0.0', port=DEFAULT_PORT, ready=None):
+    """
+    Serve TCP and UDP on `port` until interrupted
+
+    :param bind: The address to listen on
+    :param port: The TCP and UDP port
+    :param ready: Optional threading.Event, set when the servers are listening
+    """
+    tcp_server = ThreadingTCPServer((bind, port), TCPHandler)
+    udp_server = UDPServer((bind, port), UDPHandler)
+
+    udp_thread = threading.Thread(target=udp_server.serve_forever, daemon=True)
+    udp_thread.start()
+
+    print('Benchmark server listening on %s:%s (TCP and UDP)' % (bind, port), flush=True)
+
+    if ready is not None:
+        ready.set()
+
+    try:
+        tcp_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        udp_server.shutdown()
+        udp_server.server_close()
+        tcp_server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='vpc-vpn-pivot benchmark server')
+    parser.add_argument('--bind', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    options = parser.parse_args()
+
+    serve(options.bind, options.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+import time
+import threading
+
+from vpc_vpn_pivot import metrics
+from vpc_vpn_pivot.constants import (DEFAULT_REGION,
+                                     MAX_POOL_CONNECTIONS,
+                                     TCP_KEEPALIVE)
+
+_lock = threading.RLock()
+
+_sessions = {}
+_clients = {}
+
+#
+# One lock per session. A boto3 session must not be used by several threads
+# at the same time to build clients.
+#
+_session_locks = {}
+
+_config = {'max_pool_connections': MAX_POOL_CONNECTIONS,
+           'tcp_keepalive': TCP_KEEPALIVE}
+
+_stats = {'sessions': [],
+          'clients': []}
+
+
+def configure(max_pool_connections=None, tcp_keepalive=None):
+    """
+    Change the connection pool settings used by the clients created after
+    this call. Clients which were already created are not modified.
+
+    :param max_pool_connections: Max number of connections kept in the pool
+    :param tcp_keepalive: True to enable TCP keep-alive on the connections
+    """
+    with _lock:
+        if max_pool_connections is not None:
+            _config['max_pool_connections'] = max_pool_connections
+
+        if tcp_keepalive is not None:
+            _config['tcp_keepalive'] = tcp_keepalive
+
+
+def get_session(profile, region=DEFAULT_REGION):
+    """
+    Get the boto3 session for (profile, region), creating it only once per
+    process.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :return: A boto3 session
+    """
+    key = (profile, region)
+
+    with _lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+
+    with _session_lock(key):
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+
+        import boto3
+
+        start = time.time()
+        session = boto3.Session(profile_name=profile,
+                                region_name=region)
+        with _lock:
+            _stats['sessions'].append((key, time.time() - start))
+            _sessions[key] = session
+
+        return session
+
+
+def get_client(service, profile, region=DEFAULT_REGION):
+    """
+    Get a boto3 client for (profile, region, service). Clients are cached,
+    thread-safe and share the connection pool between calls, so the service
+    model is loaded and the TLS connection established only once.
+
+    The clients of all the regions are built from the same session, which
+    keeps the loaded service models: the client for a second region is
+    built in a few milliseconds.
+
+    :param service: AWS service name, eg. ec2
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :return: A boto3 client
+    """
+    key = (profile, region, service)
+
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+
+        config = dict(_config)
+
+    session = get_session(profile, None)
+
+    with _session_lock((profile, None)):
+        client = _clients.get(key)
+        if client is not None:
+            return client
+
+        from botocore.config import Config
+
+        start = time.time()
+        client = session.client(service,
+                                region_name=region,
+                                config=Config(**config))
+
+        metrics.instrument_client(client)
+
+        with _lock:
+            _stats['clients'].append((key, time.time() - start))
+            _clients[key] = client
+
+        return client
+
+
+def get_regional_clients(service, profile, regions):
+    """
+    Build the clients for several regions
+
+    :param service: AWS service name, eg. ec2
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param regions: A list of AWS region names
+    :return: A dict containing region -> boto3 client, regions where the
+             client could not be built are not included
+    """
+    clients = {}
+
+    for region in regions:
+        try:
+            clients[region] = get_client(service, profile, region)
+        except Exception as e:
+            print('Failed to create %s client for %s: %s' % (service, region, e))
+
+    return clients
+
+
+def resolve_region(profile, region=None):
+    """
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: The region specified by the user, if any
+    :return: `region`, or the region configured for the profile, or
+             DEFAULT_REGION
+    """
+    if region:
+        return region
+
+    return get_session(profile, None).region_name or DEFAULT_REGION
+
+
+def _session_lock(key):
+    with _lock:
+        return _session_locks.setdefault(key, threading.Lock())
+
+
+def stats():
+    """
+    :return: A dict containing the (key, seconds) tuples for each session
+             and client built by this process
+    """
+    with _lock:
+        return {'sessions': list(_stats['sessions']),
+                'clients': list(_stats['clients'])}
+
+
+def print_stats():
+    data = stats()
+
+    if not data['sessions'] and not data['clients']:
+        return
+
+    total = sum(t for _, t in data['sessions'] + data['clients'])
+    args = (len(data['sessions']), len(data['clients']), total)
+    print('Built %s AWS session(s) and %s client(s) in %.2f seconds' % args)
+
+    for (profile, region, service), spent in data['clients']:
+        print('    %s (%s): %.2f seconds' % (service, region, spent))
+
+
+def error_code(exception):
+    """
+    :param exception: An exception raised by a boto3 client
+    :return: The AWS error code (eg. InvalidSubnetID.NotFound) or None
+    """
+    response = getattr(exception, 'response', None)
+
+    if not isinstance(response, dict):
+        return None
+
+    return response.get('Error', {}).get('Code')
+
+
+def retry_while_error(function, error_codes, timeout, max_interval):
+    """
+    Call `function` until it doesn't raise an exception with one of the
+    `error_codes`. Other exceptions are raised immediately.
+
+    :param function: A function without arguments
+    :param error_codes: AWS error codes which are retried
+    :param timeout: Max seconds to retry
+    :param max_interval: Max seconds between calls
+    :return: The value returned by `function`, raises the last exception on
+             timeout
+    """
+    from vpc_vpn_pivot.utils.poll import wait_until, Backoff
+
+    errors = []
+    result = []
+
+    def attempt():
+        try:
+            result.append(function())
+        except Exception as e:
+            if error_code(e) not in error_codes:
+                raise
+
+            errors.append(e)
+            return False
+
+        return True
+
+    if not wait_until(attempt, timeout, Backoff(cap=max_interval)):
+        raise errors[-1]
+
+    return result[0]
@@ -1,21 +1,42 @@
 import os
+import re
 import time
-import shlex
 import tempfile
 import subprocess
 
 from vpc_vpn_pivot.state import State
-from vpc_vpn_pivot.utils.misc import is_root, read_file
+from vpc_vpn_pivot.constants import (STATE_PATH,
+                                     OPENVPN_LOG_FILE,
+                                     OPENVPN_LOG_BACKUPS,
+                                     EXPORTER_LOG_FILE,
+                                     SUPERVISOR_CONFIG_FILE,
+                                     SUPERVISOR_LOG_FILE,
+                                     DEFAULT_TUNING_PROFILE)
+from vpc_vpn_pivot.utils.misc import is_root, read_file, spawn_detached
 from vpc_vpn_pivot.utils.which import which
-from vpc_vpn_pivot.utils.tail import tail
-
-OPENVPN_LOG_FILE = 'openvpn.log'
+from vpc_vpn_pivot.utils.tail import tail, rotate, LogFollower
 
 OPENVPN_PARAMS = [
     '--auth-nocache',
-    '--log %s' % OPENVPN_LOG_FILE,
 ]
 
+CONNECT_TIMEOUT = 30
+TUNNEL_POLL_INTERVAL = 0.1
+
+TUNNEL_UP = 'Initialization Sequence Completed'
+TUNNEL_FATAL_ERRORS = (
+    'Exiting due to fatal error',
+    'AUTH_FAILED',
+    'Options error',
+    'VERIFY ERROR',
+)
+
+TUN_DEVICE_RE = re.compile(r'TUN/TAP device (\S+) opened')
+
+MTU_AUTO = 'auto'
+MTU_OFF = 'off'
+MTU_DIRECTIVES = ('tun-mtu', 'link-mtu', 'mssfix', 'fragment')
+
 
 def connect(options):
     """
@@ -30,12 +51,17 @@ def connect(options):
     state = State()
 
     openvpn_config_file = state.get('openvpn_config_file')
-    openvpn_config_file = customize_openvpn_config(openvpn_config_file)
+    openvpn_config_file = customize_openvpn_config(openvpn_config_file,
+                                                   getattr(options, 'tuning', DEFAULT_TUNING_PROFILE),
+                                                   getattr(options, 'mtu', MTU_OFF))
+
+    if getattr(options, 'supervise', False):
+        return connect_supervised(options, openvpn_config_file)
 
     openvpn_filename = write_config_file(openvpn_config_file)
 
     try:
-        connect_to_vpn_server(openvpn_filename)
+        success = connect_to_vpn_server(openvpn_filename, options.timeout)
     except Exception as e:
         print('Unexpected exception while connecting to VPN server: %s' % e)
         os.remove(openvpn_filename)
@@ -43,9 +69,95 @@ def connect(options):
     else:
         os.remove(openvpn_filename)
 
+    if not success:
+        return 1
+
+    start_exporter(options, State().get('openvpn_pid'))
+    return 0
+
+
+def connect_supervised(options, openvpn_config_file):
+    """
+    Start the supervisor in a background process and wait until the tunnel
+    is up. The supervisor owns the OpenVPN client and restarts it when the
+    tunnel fails, see supervisor.py
+
+    :param options: Options passed as command line arguments by the user
+    :param openvpn_config_file: The customized OpenVPN config
+    :return: Return code
+    """
+    state = State()
+
+    #
+    # The supervisor reuses the config on each restart, it is removed by
+    # the supervisor when it exits
+    #
+    os.makedirs(STATE_PATH, exist_ok=True)
+
+    fd = os.open(SUPERVISOR_CONFIG_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(openvpn_config_file)
+
+    rotate(OPENVPN_LOG_FILE, OPENVPN_LOG_BACKUPS)
+
+    start = time.time()
+
+    process = spawn_detached('vpc_vpn_pivot.supervisor',
+                             ['--config', SUPERVISOR_CONFIG_FILE],
+                             SUPERVISOR_LOG_FILE)
+
+    print('OpenVPN supervisor started in process %s' % process.pid)
+    print('VPN connection log is at %s' % OPENVPN_LOG_FILE)
+    print('Supervisor log is at %s' % SUPERVISOR_LOG_FILE)
+
+    with state.transaction():
+        state.append('supervisor_pid', process.pid)
+        state.append('connect_count', (state.get('connect_count') or 0) + 1)
+
+    success, message = wait_for_tunnel(process, options.timeout)
+    elapsed = time.time() - start
+
+    if not success:
+        print('%s after %.2f seconds' % (message, elapsed))
+        print('Stopping the OpenVPN supervisor')
+
+        process.terminate()
+        process.wait()
+        return 1
+
+    state.append('time_to_connect', elapsed)
+    print('Tunnel is up after %.2f seconds' % elapsed)
+
+    start_exporter(options, process.pid)
     return 0
 
 
+def start_exporter(options, pid):
+    """
+    Start the metrics exporter in a background process, it exits when the
+    process with `pid` does.
+
+    :param options: Options passed as command line arguments by the user
+    :param pid: The PID of the OpenVPN client or supervisor
+    :return: True if the exporter was started
+    """
+    from vpc_vpn_pivot.exporter import exporter_args
+
+    args = exporter_args(options)
+    if args is None:
+        return False
+
+    state = State()
+
+    args = ['--pid', str(pid)] + args
+    process = spawn_detached('vpc_vpn_pivot.exporter', args, EXPORTER_LOG_FILE)
+
+    state.append('exporter_pid', process.pid)
+
+    print('Metrics exporter started in process %s' % process.pid)
+    return True
+
+
 def validate(options):
     """
     :param options: Options passed as command line arguments by the user
@@ -80,17 +192,26 @@ def validate(options):
     return True
 
 
-def connect_to_vpn_server(openvpn_filename):
+def connect_to_vpn_server(openvpn_filename, timeout=CONNECT_TIMEOUT):
+    """
+    Start the OpenVPN client and wait until the tunnel is up
+
+    :param openvpn_filename: The OpenVPN config file
+    :param timeout: Max seconds to wait for the tunnel to be up
+    :return: True if the tunnel is up
+    """
     state = State()
 
-    params = OPENVPN_PARAMS[:]
-    params.append('--config %s' % openvpn_filename)
+    cmd = openvpn_command(openvpn_filename)
 
-    openvpn_executable = which('openvpn')[0]
+    #
+    # Rotate the log from the previous connection, it might contain the
+    # messages wait_for_tunnel() looks for
+    #
+    os.makedirs(STATE_PATH, exist_ok=True)
+    rotate(OPENVPN_LOG_FILE, OPENVPN_LOG_BACKUPS)
 
-    cmd = [openvpn_executable]
-    cmd.extend(params)
-    cmd = shlex.split(' '.join(cmd))
+    start = time.time()
 
     process = subprocess.Popen(cmd,
                                close_fds=True)
@@ -98,16 +219,108 @@ def connect_to_vpn_server(openvpn_filename):
     print('OpenVPN client started in process %s' % process.pid)
     print('VPN connection log is at %s' % OPENVPN_LOG_FILE)
 
-    state.append('openvpn_pid', process.pid)
+    with state.transaction():
+        state.append('openvpn_pid', process.pid)
+        state.append('connect_count', (state.get('connect_count') or 0) + 1)
+
+    success, message = wait_for_tunnel(process, timeout)
+    elapsed = time.time() - start
+
+    if success:
+        state.append('time_to_connect', elapsed)
+        print('Tunnel is up after %.2f seconds' % elapsed)
+        return True
 
-    time.sleep(5)
+    print('%s after %.2f seconds' % (message, elapsed))
+
+    stop_openvpn(process)
+
+    if not os.path.exists(OPENVPN_LOG_FILE):
+        return False
 
     print('\nLast five lines from connection log:')
-    log_lines = tail(open(OPENVPN_LOG_FILE), 5)
+    with open(OPENVPN_LOG_FILE) as f:
+        log_lines = tail(f, 5)
     log_lines = '    '.join(log_lines)
     print(log_lines)
 
-    return True
+    return False
+
+
+def stop_openvpn(process):
+    """
+    Stop the OpenVPN client after a failed connection, it would keep trying
+    to connect in the background, and remove it from the state
+
+    :param process: The OpenVPN subprocess.Popen instance
+    """
+    if process.poll() is None:
+        print('Stopping the OpenVPN client')
+        process.terminate()
+
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    state = State()
+
+    with state.transaction():
+        for key in ('openvpn_pid', 'tun_device'):
+            if state.get(key) is not None:
+                state.remove(key)
+
+
+def openvpn_command(openvpn_filename, append_log=False, extra_params=()):
+    """
+    :param openvpn_filename: The OpenVPN config file
+    :param append_log: Append to the log instead of truncating it
+    :param extra_params: Parameters added after the config, they override
+                         the directives in the config file
+    :return: The command to start the OpenVPN client
+    """
+    cmd = [which('openvpn')[0]]
+    cmd.extend(OPENVPN_PARAMS)
+    cmd.extend(['--log-append' if append_log else '--log', OPENVPN_LOG_FILE])
+    cmd.extend(['--config', openvpn_filename])
+    cmd.extend(extra_params)
+    return cmd
+
+
+def wait_for_tunnel(process, timeout):
+    """
+    Follow the OpenVPN log until the tunnel is up, a fatal error is logged,
+    the process exits or the timeout is reached.
+
+    :param process: The OpenVPN subprocess.Popen instance
+    :param timeout: Max seconds to wait
+    :return: A tuple containing True if the tunnel is up, and a message
+             describing the result
+    """
+    follower = LogFollower(OPENVPN_LOG_FILE)
+    deadline = time.time() + timeout
+
+    while True:
+        for line in follower.read_lines():
+            match = TUN_DEVICE_RE.search(line)
+            if match:
+                State().append('tun_device', match.group(1))
+
+            if TUNNEL_UP in line:
+                return True, 'Tunnel is up'
+
+            for fatal_error in TUNNEL_FATAL_ERRORS:
+                if fatal_error in line:
+                    return False, 'OpenVPN failed: %s' % line.strip()
+
+        if process.poll() is not None:
+            return False, 'OpenVPN exited with code %s' % process.returncode
+
+        if time.time() > deadline:
+            return False, 'Timeout waiting for the tunnel to be up'
+
+        time.sleep(TUNNEL_POLL_INTERVAL)
 
 
 def write_config_file(openvpn_config_file):
@@ -128,15 +341,19 @@ def write_config_file(openvpn_config_file):
     return temp.name
 
 
-def customize_openvpn_config(openvpn_config_file):
+def customize_openvpn_config(openvpn_config_file, tuning=DEFAULT_TUNING_PROFILE, mtu=MTU_OFF):
     """
     Add some custom config to the OpenVPN config provided by AWS
 
     :param openvpn_config_file: The OpenVPN config provided by AWS
+    :param tuning: The name of the tuning profile to apply
+    :param mtu: MTU_AUTO to probe the path MTU, MTU_OFF, or the path MTU
     :return: The updated config file contents
     """
     openvpn_config_file = add_script_security(openvpn_config_file)
     openvpn_config_file = add_update_resolv(openvpn_config_file)
+    openvpn_config_file = add_tuning(openvpn_config_file, tuning)
+    openvpn_config_file = add_mtu(openvpn_config_file, mtu)
     openvpn_config_file = add_certs(openvpn_config_file)
     return openvpn_config_file
 
@@ -159,6 +376,53 @@ def add_update_resolv(openvpn_config_file):
     return openvpn_config_file
 
 
+def add_tuning(openvpn_config_file, tuning):
+    from vpc_vpn_pivot.tuning import apply_tuning
+
+    openvpn_config_file, skipped = apply_tuning(openvpn_config_file, tuning)
+
+    for name, reason in skipped:
+        print('Tuning profile %s: not adding %s, %s' % (tuning, name, reason))
+
+    return openvpn_config_file
+
+
+def add_mtu(openvpn_config_file, mtu):
+    """
+    Add tun-mtu and mssfix derived from the path MTU to the endpoint, so the
+    encapsulated packets are not fragmented
+    """
+    if mtu == MTU_OFF:
+        return openvpn_config_file
+
+    from vpc_vpn_pivot import mtu as path_mtu
+    from vpc_vpn_pivot.tuning import parse_directives
+
+    directives = parse_directives(openvpn_config_file)
+
+    if directives.get('proto', 'udp').startswith('tcp'):
+        return openvpn_config_file
+
+    existing = [d for d in MTU_DIRECTIVES if d in directives]
+    if existing:
+        print('The OpenVPN config already sets %s, skipping the MTU'
+              ' configuration' % ', '.join(existing))
+        return openvpn_config_file
+
+    if mtu == MTU_AUTO:
+        mtu = path_mtu.get_path_mtu(openvpn_config_file)
+
+        if mtu is None:
+            return openvpn_config_file
+
+    openvpn_config_file += '\n\n'
+
+    for name, args in path_mtu.mtu_directives(int(mtu)):
+        openvpn_config_file += '%s %s\n' % (name, args)
+
+    return openvpn_config_file
+
+
 def add_certs(openvpn_config_file):
     cert_fmt = '\n\n<cert>\n%s\n</cert>\n'
     key_fmt = '\n\n<key>\n%s\n</key>\n'
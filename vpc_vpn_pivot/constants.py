@@ -1,9 +1,206 @@
 import os
 
-STATE_FILE = os.path.expanduser('~/.vpc_vpn_pivot/state')
-STATE_PATH = os.path.expanduser('~/.vpc_vpn_pivot')
+#
+# VPC_VPN_PIVOT_HOME overrides the state directory. `create --regions` uses it
+# to give the worker of each region its own state, certificates and logs.
+# The caches and the key pool stay in DATA_PATH, shared by all the workers.
+#
+DATA_PATH = os.path.expanduser('~/.vpc_vpn_pivot')
+STATE_PATH = os.environ.get('VPC_VPN_PIVOT_HOME') or DATA_PATH
+STATE_FILE = os.path.join(STATE_PATH, 'state')
 
-CA_PATH = '/tmp/EasyRSA-v3.0.6/pki'
+#
+# One state directory per region created by `create --regions`
+#
+REGIONS_PATH = os.path.join(STATE_PATH, 'regions')
+
+#
+# The OpenVPN client log is rotated on each `connect`, keeping the logs of
+# the previous connections as openvpn.log.1 ... openvpn.log.N
+#
+OPENVPN_LOG_FILE = os.path.join(STATE_PATH, 'openvpn.log')
+OPENVPN_LOG_BACKUPS = 5
+
+#
+# The supervisor appends to the log on each OpenVPN restart, it is also
+# rotated when it grows larger than this many bytes
+#
+OPENVPN_LOG_MAX_SIZE = 10 * 1024 * 1024
+
+#
+# Throughput and latency samples collected by `status --watch`, one per
+# second. The ring buffer keeps the last hour.
+#
+TUNNEL_SAMPLES_FILE = os.path.join(STATE_PATH, 'tunnel-samples')
+TUNNEL_SAMPLES_SIZE = 3600
+
+#
+# Prometheus metrics exporter started by `connect --metrics-port` or
+# `connect --metrics-textfile`. The AWS API call latencies and errors measured
+# during `create` and `purge` are stored in API_METRICS_FILE.
+#
+API_METRICS_FILE = os.path.join(STATE_PATH, 'api-metrics.json')
+EXPORTER_LOG_FILE = os.path.join(STATE_PATH, 'exporter.log')
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_TEXTFILE_INTERVAL = 5
+
+#
+# `connect --supervise` runs OpenVPN under a supervisor process which
+# restarts it when the tunnel fails. The last MAX_OUTAGES outages are kept
+# in the state.
+#
+SUPERVISOR_CONFIG_FILE = os.path.join(STATE_PATH, 'openvpn.ovpn')
+SUPERVISOR_LOG_FILE = os.path.join(STATE_PATH, 'supervisor.log')
+MANAGEMENT_SOCKET = os.path.join(STATE_PATH, 'openvpn.sock')
+MAX_OUTAGES = 100
+
+#
+# Output of `create --detach`, followed by `create --attach`
+#
+CREATE_LOG_FILE = os.path.join(STATE_PATH, 'create.log')
+
+#
+# Expected duration in seconds of the steps in the critical path of `create`,
+# used to estimate the time left for background creates
+#
+CREATE_STEP_ETA = {'perform_initial_checks': 3,
+                   'create_ssl_certs': 2,
+                   'import_server_cert': 2,
+                   'create_client_vpn_endpoint': 5,
+                   'wait_for_vpn_creation': 480,
+                   'download_openvpn_config': 2}
+
+#
+# EasyRSA releases are downloaded once and kept in the cache, only the PKI
+# directory is reset between runs
+#
+CACHE_PATH = os.path.join(DATA_PATH, 'cache')
+CACHE_LOCK_FILE = os.path.join(CACHE_PATH, '.lock')
+
+EASYRSA_VERSION = '3.0.6'
+EASYRSA_RELEASE = 'https://github.com/OpenVPN/easy-rsa/releases/download/v3.0.6/EasyRSA-unix-v3.0.6.tgz'
+EASYRSA_PATH = os.path.join(CACHE_PATH, 'EasyRSA-v3.0.6')
+EASYRSA_CACHE_INDEX = os.path.join(CACHE_PATH, 'easyrsa.json')
+
+#
+# Set to the SHA-256 of the release to pin it. When None the hash of the
+# first download (or seeded file) is recorded in EASYRSA_CACHE_INDEX and
+# all later uses of the cache are verified against it.
+#
+EASYRSA_SHA256 = None
+
+#
+# The PKI created by EasyRSA (EASYRSA_PKI), outside the shared install
+#
+CA_PATH = os.path.join(STATE_PATH, 'easyrsa-pki')
+
+#
+# The native CA backend writes the certificates to this path
+#
+PKI_PATH = os.path.join(STATE_PATH, 'pki')
+
+CA_BACKEND_NATIVE = 'native'
+CA_BACKEND_EASYRSA = 'easyrsa'
+CA_BACKENDS = (CA_BACKEND_NATIVE, CA_BACKEND_EASYRSA)
+
+#
+# Key algorithms supported by the CA backends. AWS Client VPN documents
+# RSA 2048 for the server certificate, the others might be rejected by ACM
+# or the Client VPN endpoint.
+#
+KEY_ALGORITHMS = ('rsa2048', 'rsa3072', 'rsa4096', 'ec256', 'ec384')
+DEFAULT_KEY_ALGORITHM = 'rsa2048'
+
+#
+# Pre-generated private keys, one directory per algorithm. Each `create`
+# with the native CA backend needs three keys (CA, server and client).
+#
+KEYPOOL_PATH = os.path.join(DATA_PATH, 'keypool')
+KEYPOOL_SIZE = 6
+
+#
+# OpenVPN tuning profiles for `connect --tuning`, see tuning.py
+#
+TUNING_PROFILES = ('default', 'throughput', 'latency')
+DEFAULT_TUNING_PROFILE = 'default'
+
+#
+# Results of `cipher-bench`, they depend on the CPU and not on the VPN so
+# they are kept outside of the state
+#
+CIPHER_BENCH_FILE = os.path.join(DATA_PATH, 'cipher-bench.json')
+
+#
+# Seconds the path MTU measured by `connect` is cached for each endpoint
+#
+MTU_CACHE_TTL = 7 * 24 * 60 * 60
 
 DEFAULT_DNS_SERVERS = ['8.8.8.8',
                        '1.1.1.1']
+
+#
+# Used when neither --region nor the profile configure a region, and for the
+# state of previous versions which did not store the region
+#
+DEFAULT_REGION = 'us-east-1'
+
+#
+# Subnet ID -> region cache, filled when a subnet is found in a region other
+# than the default one. MAX_REGION_WORKERS bounds the number of regions
+# queried at the same time.
+#
+SUBNET_REGIONS_FILE = os.path.join(DATA_PATH, 'subnet-regions.json')
+MAX_REGION_WORKERS = 16
+
+#
+# Local inventory of the AWS resources read by `create`, see inventory.py.
+# Seconds each resource type is used before it is read again from AWS.
+#
+INVENTORY_FILE = os.path.join(DATA_PATH, 'inventory.sqlite3')
+INVENTORY_TTL = {'vpc': 60 * 60,
+                 'subnet': 15 * 60,
+                 'route_table': 15 * 60,
+                 'vpc_peering_connection': 15 * 60}
+
+#
+# AWS Client VPN requires a client CIDR block between /12 and /22. The
+# smallest one is used, it has fewer chances of colliding with other
+# networks. The block is allocated from the private ranges.
+#
+CLIENT_CIDR_PREFIX_LENGTH = 22
+MIN_CLIENT_CIDR_PREFIX_LENGTH = 12
+MAX_CLIENT_CIDR_PREFIX_LENGTH = 22
+PRIVATE_RANGES = ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16')
+
+#
+# Number of API calls and pings used to measure the latency of each region
+# by `create --regions --pick-fastest`
+#
+REGION_LATENCY_SAMPLES = 3
+
+#
+# Transport protocols and ports supported by AWS Client VPN endpoints
+#
+TRANSPORT_PROTOCOLS = ('udp', 'tcp')
+DEFAULT_TRANSPORT_PROTOCOL = 'udp'
+VPN_PORTS = (443, 1194)
+DEFAULT_VPN_PORT = 443
+
+#
+# Port and benchmarks of the `bench` sub-command, the port is also the
+# default of bench_server.py
+#
+BENCH_PORT = 5201
+BENCH_TESTS = ('tcp', 'udp', 'latency', 'connect')
+
+#
+# Default UDP send rate in Mbps. Unpaced sends overrun the single threaded
+# Python sink and measure its limit instead of the tunnel's.
+#
+BENCH_UDP_RATE = 100
+
+#
+# botocore connection pool settings shared by all the AWS clients
+#
+MAX_POOL_CONNECTIONS = 20
+TCP_KEEPALIVE = True
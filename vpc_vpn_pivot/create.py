@@ -1,89 +1,293 @@
+import os
+import sys
+import copy
 import time
-import boto3
+import ipaddress
+import threading
 
 from botocore.exceptions import ClientError
 
+from vpc_vpn_pivot import metrics
+from vpc_vpn_pivot import inventory
+from vpc_vpn_pivot import allocator
 from vpc_vpn_pivot.state import State
-from vpc_vpn_pivot.constants import STATE_FILE, DEFAULT_DNS_SERVERS
-from vpc_vpn_pivot.ssl.certs import create_ssl_certs
+from vpc_vpn_pivot.clients import (get_client, print_stats, error_code,
+                                   retry_while_error, resolve_region)
+from vpc_vpn_pivot.constants import (STATE_FILE,
+                                     CREATE_LOG_FILE,
+                                     DEFAULT_DNS_SERVERS,
+                                     DEFAULT_TRANSPORT_PROTOCOL,
+                                     DEFAULT_VPN_PORT,
+                                     CA_BACKEND_EASYRSA)
+from vpc_vpn_pivot.ssl.certs import create_ssl_certs, save_ssl_certs
+from vpc_vpn_pivot.subnets import print_subnets
+from vpc_vpn_pivot.regions import (create_in_regions, locate_subnets,
+                                   cached_subnet_region)
+from vpc_vpn_pivot.utils.dag import (Step, SUCCESS, run_steps,
+                                     all_succeeded, print_timings)
 from vpc_vpn_pivot.utils.misc import (is_valid_subnet_id,
-                                      read_file_b)
+                                      read_file_b,
+                                      pid_is_alive,
+                                      spawn_detached,
+                                      map_concurrently)
+from vpc_vpn_pivot.utils.tail import follow
+from vpc_vpn_pivot.utils.cidr import PrefixIndex
+from vpc_vpn_pivot.utils.poll import wait_until, Backoff
+
+WAIT_TIMEOUT = 600
+
+#
+# With the 20% jitter the interval never exceeds 1.8 seconds, so a resource
+# which becomes ready is noticed within two seconds. Each poll only
+# describes the resources which are not ready yet, which keeps the API
+# cost low.
+#
+WAIT_MAX_INTERVAL = 1.5
+
+#
+# Returned when several changes are made to the same client VPN endpoint at
+# the same time, the request is retried
+#
+CONCURRENT_MUTATION_ERRORS = ('ConcurrentMutationLimitExceeded',)
 
 
 def create(options):
     """
     Create the VPN server in the VPC
 
+    The creation is split in steps which form a dependency graph. Steps which
+    do not depend on each other, such as the SSL certificate generation and
+    the AWS checks, run concurrently. If any step fails the steps which did
+    not start yet are cancelled.
+
+    The progress of each step is saved to the state, `status` uses it to show
+    the progress of creates running in the background (--detach).
+
     :param options: Options passed as command line arguments by the user
     :return: Return code
 
     :see: https://github.com/aws-quickstart/quickstart-biotech-blueprint/blob/f2e1e76dc8cbc30fd938dd78f0ea5c029c03a9d4/scripts/clientvpnendpoint-customlambdaresource.py#L40
     """
-    state = State()
+    if options.attach:
+        return attach(options)
 
     #
-    # Initial checks to increase the chances of success during AWS resource
-    # creation
+    # Local checks, these need to run before any step writes to the state.
+    # The background worker doesn't need to run them again.
     #
-    success = perform_initial_checks(options)
+    if not options.worker:
+        success = validate_options(options)
 
-    if not success:
-        return 1
+        if not success:
+            return 1
 
-    msg = 'Creating VPN server in AWS account ID %s using %s'
-    args = (state.get('account_id'),
-            state.get('user_arn'))
-    print(msg % args)
+    if options.regions:
+        return create_in_regions(options)
 
-    #
-    # Create the SSL certificates
-    #
-    success = create_ssl_certs(options)
+    if options.detach:
+        return detach(options)
 
-    if not success:
-        return 1
+    inventory.configure(enabled=not options.no_cache)
+
+    progress = CreateProgress(background=options.worker)
 
     #
-    # Create the AWS resources. Leave this step to the end in order to reduce
-    # the number of resources to remove if something fails
+    # A create interrupted with Ctrl+C must not be shown by `status` as
+    # running forever
     #
-    success = create_aws_resources(options)
+    start = time.time()
+    finished = False
 
-    if not success:
+    try:
+        results = run_steps(get_create_steps(), options,
+                            cancel_on_failure=True,
+                            listener=progress.step_changed)
+        finished = True
+    finally:
+        if not finished:
+            progress.finish(1)
+
+    print_timings(results, time.time() - start)
+
+    endpoint_result = results['create_client_vpn_endpoint']
+    if endpoint_result.status == SUCCESS:
+        args = endpoint_result.end - start
+        print('Client VPN endpoint requested %.2f seconds after start' % args)
+
+    print_stats()
+    inventory.print_stats()
+    metrics.flush()
+
+    if not all_succeeded(results):
+        progress.finish(1)
         return 1
 
-    success = wait_for_vpn_creation(options)
+    progress.finish(0)
 
-    if not success:
-        return 1
+    print('\nAWS Client VPN created! Connect using:')
+    print('')
+    print('    sudo ./vpc-vpn-pivot connect')
+    print('')
 
-    success = download_openvpn_config(options)
+    return 0
 
-    if not success:
-        return 1
 
-    print('\nAWS Client VPN created! Connect using:')
+def detach(options):
+    """
+    Run `create` in a background process. The process output is written to
+    CREATE_LOG_FILE.
+
+    :param options: Options passed as command line arguments by the user
+    :return: Return code
+    """
+    args = [arg for arg in sys.argv[1:] if arg != '--detach']
+    args.append('--worker')
+
+    #
+    # The worker writes to the state file, this process must not write to
+    # it after the worker is started
+    #
+    State().append('create_progress', CreateProgress.initial())
+
+    open(CREATE_LOG_FILE, 'w').close()
+    process = spawn_detached('vpc_vpn_pivot.main', args, CREATE_LOG_FILE)
+
+    print('Creating the VPN in background process %s' % process.pid)
     print('')
-    print('    sudo ./vpc-vpn-pivot connect')
+    print('    ./vpc-vpn-pivot status          (progress and ETA)')
+    print('    ./vpc-vpn-pivot create --attach (follow the output)')
     print('')
 
     return 0
 
 
-def perform_initial_checks(options):
+def attach(options):
     """
-    Perform initial checks on the user-controlled parameters
+    Print the output of a background `create` until it finishes
+
+    :param options: Options passed as command line arguments by the user
+    :return: The return code of the background create
+    """
+    state = State()
+
+    if state.get('create_progress') is None:
+        print('There is no create running in the background')
+        return 1
+
+    def is_done():
+        progress = state.reload().get('create_progress') or {}
+
+        if progress.get('finished') is not None:
+            return True
+
+        pid = progress.get('pid')
+        return pid is not None and not pid_is_alive(pid)
+
+    try:
+        for line in follow(CREATE_LOG_FILE, is_done):
+            print(line, end='')
+    except KeyboardInterrupt:
+        print('\nDetached, the VPN creation continues in the background')
+        return 0
+
+    exit_code = (state.get('create_progress') or {}).get('exit_code')
+
+    if exit_code is None:
+        print('The background create process died, check %s' % CREATE_LOG_FILE)
+        return 1
+
+    return exit_code
+
+
+class CreateProgress(object):
+    """
+    Save the status and timing of each create step to the state
+    """
+    def __init__(self, background=False):
+        self.lock = threading.Lock()
+        self.progress = self.initial()
+        self.progress['pid'] = os.getpid()
+        self.progress['background'] = background
+
+        State().append('create_progress', self.progress)
+
+    @staticmethod
+    def initial():
+        return {'pid': None,
+                'started': time.time(),
+                'finished': None,
+                'exit_code': None,
+                'steps': {}}
+
+    def step_changed(self, result):
+        with self.lock:
+            self.progress['steps'][result.name] = {'status': result.status or 'running',
+                                                   'start': result.start,
+                                                   'end': result.end}
+            self.save()
+
+    def finish(self, exit_code):
+        with self.lock:
+            self.progress['finished'] = time.time()
+            self.progress['exit_code'] = exit_code
+            self.save()
+
+    def save(self):
+        State().append('create_progress', copy.deepcopy(self.progress))
+
+
+def get_create_steps():
+    """
+    :return: The steps required to create the VPN. Leave the AWS resource
+             creation to the end in order to reduce the number of resources
+             to remove if something fails.
+    """
+    checked = 'perform_initial_checks'
+    certs_ready = ('save_ssl_certs',)
+    endpoint_created = ('create_client_vpn_endpoint',)
+
+    return [
+        Step('perform_initial_checks', perform_initial_checks),
+        Step('create_ssl_certs', lambda context: create_ssl_certs(context.options)),
+        Step('save_ssl_certs',
+             lambda context: save_ssl_certs(context.results['create_ssl_certs']),
+             requires=(checked, 'create_ssl_certs')),
+        Step('import_server_cert', import_server_cert, requires=certs_ready),
+        Step('import_client_cert', import_client_cert, requires=certs_ready),
+        Step('get_cidr_block', get_cidr_block, requires=(checked,)),
+        Step('get_dns_servers', get_dns_servers, requires=(checked,)),
+        Step('create_client_vpn_endpoint', create_client_vpn_endpoint,
+             requires=('import_server_cert',
+                       'import_client_cert',
+                       'get_cidr_block',
+                       'get_dns_servers')),
+        Step('add_cidr_to_all_security_groups', add_cidr_to_all_security_groups,
+             requires=endpoint_created),
+        Step('wait_for_vpn_creation', wait_for_vpn_creation, requires=endpoint_created),
+        Step('download_openvpn_config', download_openvpn_config,
+             requires=('wait_for_vpn_creation',)),
+    ]
+
+
+def validate_options(options):
+    """
+    Perform the initial checks which don't require network access
 
     :param options: Options passed as command line arguments by the user
     :return: True if all the inputs look good
     """
     state = State()
 
+    if options.profile is None or not options.subnet_id:
+        print('The --profile and --subnet-id arguments are required')
+        return False
+
     #
     # Check if there is a state and require the user to use --force in order to
-    # remove it
+    # remove it. The progress of a previous create which failed before saving
+    # anything else is ignored.
     #
-    if state.dump() and not options.force:
+    if not is_empty_state(state.dump()) and not options.force:
         print('The state file at %s is not empty.\n'
               '\n'
               'This is most likely because the `purge` sub-command was not run'
@@ -95,24 +299,83 @@ def perform_initial_checks(options):
               ' process anyways.' % STATE_FILE)
         return False
 
-    if not is_valid_subnet_id(options.subnet_id):
-        print('%s does not have a valid Subnet ID format' % options.subnet_id)
+    for subnet_id in options.subnet_id:
+        if not is_valid_subnet_id(subnet_id):
+            print('%s does not have a valid Subnet ID format' % subnet_id)
+            return False
+
+    if len(set(options.subnet_id)) != len(options.subnet_id):
+        print('The same Subnet ID was specified more than once')
+        return False
+
+    if options.regions and options.region:
+        print('The --region and --regions arguments can not be used together')
+        return False
+
+    if options.regions and (options.detach or options.attach):
+        print('The --regions argument can not be used with --detach or --attach')
+        return False
+
+    if options.pick_fastest and not options.regions:
+        print('The --pick-fastest argument requires --regions')
+        return False
+
+    if options.keypool and options.ca_backend == CA_BACKEND_EASYRSA:
+        print('The --keypool argument can not be used with --ca-backend %s,'
+              ' EasyRSA generates its own keys' % CA_BACKEND_EASYRSA)
+        return False
+
+    return True
+
+
+def is_empty_state(state):
+    """
+    :param state: The state contents
+    :return: True if the state is empty, or only holds the progress of a
+             create which is no longer running
+    """
+    state = dict(state)
+    progress = state.pop('create_progress', None)
+
+    if state:
         return False
 
+    if progress is None or progress.get('finished') is not None:
+        return True
+
+    pid = progress.get('pid')
+    return pid is not None and not pid_is_alive(pid)
+
+
+def perform_initial_checks(context):
+    """
+    Perform initial checks on the user-controlled parameters to increase the
+    chances of success during AWS resource creation
+
+    :param context: The step context
+    :return: A dict with the account and subnet information
+    """
+    options = context.options
+    state = State()
+
     #
-    # Check if the profile is valid
+    # Check if the profile is valid. All the resources are created in the
+    # region of the subnets: --region, or the one configured for the profile.
     #
     try:
-        session = boto3.Session(profile_name=options.profile,
-                                region_name='us-east-1')
+        region = resolve_region(options.profile, options.region)
     except Exception:
         print('%s is not a valid profile defined in ~/.aws/credentials' % options.profile)
         return False
 
-    sts_client = session.client('sts')
+    if options.region is None:
+        region = cached_subnet_region(options.subnet_id) or region
 
+    #
+    # Never cached, this is the check for revoked keys and expired tokens
+    #
     try:
-        response = sts_client.get_caller_identity()
+        response = get_client('sts', options.profile, region).get_caller_identity()
     except Exception as e:
         msg = ('The profile has invalid credentials.'
                ' Call to get_caller_identity() failed with error: %s')
@@ -123,99 +386,156 @@ def perform_initial_checks(options):
     arn = response['Arn']
 
     #
-    # Check if the specified Subnet ID exists in the target AWS account
+    # Check if the specified Subnet IDs exist in the target AWS account
     #
-    ec2_client = session.client('ec2')
+    subnets, error = describe_subnets(options.profile, region, options.subnet_id)
 
-    try:
-        subnets = ec2_client.describe_subnets(SubnetIds=[options.subnet_id])
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'InvalidSubnetID.NotFound':
+    #
+    # The subnets might be in another region, look for them in all the
+    # regions unless the user chose one
+    #
+    if error_code(error) == 'InvalidSubnetID.NotFound' and options.region is None:
+        other_region = locate_subnets(options.profile, options.subnet_id, exclude=(region,))
+
+        if other_region is not None:
+            region = other_region
+            subnets, error = describe_subnets(options.profile, region, options.subnet_id)
+
+    if error is not None:
+        if error_code(error) == 'InvalidSubnetID.NotFound':
             #
             # Show the error
             #
-            msg = 'The specified Subnet ID (%s) does not exist in AWS account %s'
-            args = (options.subnet_id, account_id)
+            msg = 'The specified Subnet ID (%s) does not exist in AWS account %s (%s)'
+            args = (', '.join(options.subnet_id), account_id, region)
             print(msg % args)
 
             #
-            # Get the user a list of all the VPC IDs
+            # Get the user a list of all the subnets, use `list-subnets` to
+            # filter them
             #
             print('')
             print('The following is a list of existing subnets:')
             print('')
 
-            response = ec2_client.describe_subnets()
-
-            for subnet_data in response['Subnets']:
-                args = (subnet_data['SubnetId'], subnet_data['CidrBlock'], subnet_data['VpcId'])
-                msg = ' - %s (%s , %s)'
-                print(msg % args)
+            try:
+                print_subnets(get_client('ec2', options.profile, region),
+                              subnets=inventory.list_resources(options.profile, region, 'subnet'))
+            except Exception as e:
+                print('Failed to list the subnets: %s' % e)
         else:
-            print('Failed to call ec2.describe_subnets: %s' % e)
+            print('Failed to call ec2.describe_subnets: %s' % error)
 
         return False
 
     #
-    # We want to get the VPC ID for this subnet and store it
+    # We want to get the VPC ID for these subnets and store it. The client
+    # VPN can only be associated with subnets of one VPC, each in a different
+    # availability zone.
     #
-    vpc_id = subnets['Subnets'][0]['VpcId']
-    subnet_cidr_block = subnets['Subnets'][0]['CidrBlock']
+    vpc_ids = set(s['VpcId'] for s in subnets)
+    if len(vpc_ids) != 1:
+        print('All the subnets must be in the same VPC, found: %s' % ', '.join(sorted(vpc_ids)))
+        return False
 
-    args = (options.subnet_id, subnet_cidr_block, vpc_id)
-    print('%s has IP address CIDR %s and is in %s' % args)
+    vpc_id = vpc_ids.pop()
+
+    if options.all_azs:
+        try:
+            subnets = add_subnets_in_all_azs(options.profile, region, vpc_id, subnets)
+        except Exception as e:
+            print('Failed to call ec2.describe_subnets: %s' % e)
+            return False
+
+    availability_zones = [s['AvailabilityZone'] for s in subnets]
+    if len(set(availability_zones)) != len(availability_zones):
+        print('The client VPN can only be associated with one subnet per'
+              ' availability zone')
+        return False
+
+    for subnet in subnets:
+        args = (subnet['SubnetId'], subnet['CidrBlock'], subnet['AvailabilityZone'], vpc_id)
+        print('%s has IP address CIDR %s and is in %s (%s)' % args)
+
+    subnet_ids = [s['SubnetId'] for s in subnets]
+    subnet_cidr_blocks = [s['CidrBlock'] for s in subnets]
 
     #
     # The first thing we want to do in the connect() is to save the profile
     # passed as parameter to the state. We do this in order to spare the user
     # the need of specifying the same parameter for all the sub-commands
     #
-    state.append('profile', options.profile)
-    state.append('account_id', account_id)
-    state.append('user_arn', arn)
-    state.append('vpc_id', vpc_id)
-    state.append('subnet_id', options.subnet_id)
-    state.append('subnet_cidr_block', subnet_cidr_block)
-
-    return True
-
-
-def create_aws_resources(options):
+    with state.transaction():
+        state.append('profile', options.profile)
+        state.append('account_id', account_id)
+        state.append('user_arn', arn)
+        state.append('region', region)
+        state.append('vpc_id', vpc_id)
+        state.append('subnet_ids', subnet_ids)
+        state.append('subnet_cidr_blocks', subnet_cidr_blocks)
+
+    msg = 'Creating VPN server in AWS account ID %s (%s) using %s'
+    print(msg % (account_id, region, arn))
+
+    return {'account_id': account_id,
+            'user_arn': arn,
+            'region': region,
+            'vpc_id': vpc_id,
+            'subnet_ids': subnet_ids,
+            'subnet_cidr_blocks': subnet_cidr_blocks}
+
+
+def describe_subnets(profile, region, subnet_ids):
     """
-    Create the AWS resources
-
-    :param options: Options passed as command line arguments by the user
-    :return: True if all the resources were successfully created
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :param subnet_ids: A list of subnet IDs
+    :return: A tuple with the subnets and a ClientError, one of them is
+             always None. The error code is InvalidSubnetID.NotFound when
+             any of the subnets does not exist.
     """
-    success = create_acm_certs(options)
-
-    if not success:
-        return False
-
-    success = get_cidr_block(options)
+    try:
+        subnets = inventory.get_resources(profile, region, 'subnet', subnet_ids)
+    except ClientError as e:
+        return None, e
 
-    if not success:
-        return False
+    if len(subnets) != len(subnet_ids):
+        found = set(s['SubnetId'] for s in subnets)
+        missing = [s for s in subnet_ids if s not in found]
 
-    success = get_dns_servers(options)
+        error = {'Error': {'Code': 'InvalidSubnetID.NotFound',
+                           'Message': "The subnet ID '%s' does not exist" % ', '.join(missing)}}
+        return None, ClientError(error, 'DescribeSubnets')
 
-    if not success:
-        return False
+    return subnets, None
 
-    success = create_client_vpn_endpoint(options)
 
-    if not success:
-        return False
+def add_subnets_in_all_azs(profile, region, vpc_id, subnets):
+    """
+    Add one subnet of the VPC for each availability zone which doesn't have
+    one yet. The subnet with the most available IP addresses is chosen.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :param vpc_id: The VPC ID
+    :param subnets: The subnets specified by the user, as returned by
+                    describe_subnets()
+    :return: The list of subnets, one per availability zone
+    """
+    vpc_subnets = inventory.list_resources(profile, region, 'subnet', vpc_id)
 
-    success = add_cidr_to_all_security_groups(options)
+    selected = {s['AvailabilityZone']: s for s in subnets}
+    candidates = sorted(vpc_subnets,
+                        key=lambda s: s['AvailableIpAddressCount'],
+                        reverse=True)
 
-    if not success:
-        return False
+    for subnet in candidates:
+        selected.setdefault(subnet['AvailabilityZone'], subnet)
 
-    return True
+    return subnets + [s for s in selected.values() if s not in subnets]
 
 
-def add_cidr_to_all_security_groups(options):
+def add_cidr_to_all_security_groups(context):
     """
     Adds the VPN CIDR to all security groups that would block traffic.
 
@@ -227,61 +547,59 @@ def add_cidr_to_all_security_groups(options):
 
     This is noisy.
 
-    :param options: Options passed as command line arguments by the user
+    :param context: The step context
     :return: True if all security groups were modified to allow all traffic from the VPN CIDR
     """
     # TODO: Implement this feature
     return True
 
 
-def create_acm_certs(options):
-    """
-    Create the ACM resources
+def import_server_cert(context):
+    return import_acm_cert(context, 'server')
 
-    :param options: Options passed as command line arguments by the user
-    :return: True if all the resources were successfully created
+
+def import_client_cert(context):
+    return import_acm_cert(context, 'client')
+
+
+def import_acm_cert(context, cert_type):
     """
-    session = boto3.Session(profile_name=options.profile,
-                            region_name='us-east-1')
-    acm_client = session.client('acm')
+    Import one of the certificates created by create_ssl_certs() into ACM
 
-    state = State()
+    :param context: The step context
+    :param cert_type: server or client
+    :return: The certificate ARN
+    """
+    region = context.results['perform_initial_checks']['region']
+    acm_client = get_client('acm', context.options.profile, region)
+    certs = context.results['create_ssl_certs']
 
     try:
         response = acm_client.import_certificate(
-            Certificate=read_file_b(state.get('server_crt')),
-            PrivateKey=read_file_b(state.get('server_key')),
-            CertificateChain=read_file_b(state.get('ca_crt')),
+            Certificate=read_file_b(certs['%s_crt' % cert_type]),
+            PrivateKey=read_file_b(certs['%s_key' % cert_type]),
+            CertificateChain=read_file_b(certs['ca_crt']),
         )
     except Exception as e:
-        print('Failed to import server certificate: %s' % e)
+        print('Failed to import %s certificate: %s' % (cert_type, e))
         return False
-    else:
-        state.append('server_cert_acm_arn', response['CertificateArn'])
 
-    try:
-        response = acm_client.import_certificate(
-            Certificate=read_file_b(state.get('client_crt')),
-            PrivateKey=read_file_b(state.get('client_key')),
-            CertificateChain=read_file_b(state.get('ca_crt')),
-        )
-    except Exception as e:
-        print('Failed to import client certificate: %s' % e)
-        return False
-    else:
-        state.append('client_cert_acm_arn', response['CertificateArn'])
+    certificate_arn = response['CertificateArn']
 
-    print('Successfully created certificates in ACM')
+    State().append('%s_cert_acm_arn' % cert_type, certificate_arn)
+    print('Successfully imported %s certificate into ACM' % cert_type)
 
-    return True
+    return certificate_arn
 
 
-def get_cidr_block(options):
+def get_cidr_block(context):
     """
     This is the CIDR block for the VPN clients.
 
-    We'll be the only ones connecting to this VPN so a /30 is more than enough,
-    but it is very important for us to choose a CIDR block that:
+    We'll be the only ones connecting to this VPN so a /30 would be more than
+    enough, but AWS Client VPN requires a block between /12 and /22, so the
+    smallest one (/22) is used. It is very important for us to choose a CIDR
+    block that:
 
         * Doesn't overlap with the client's local network (usually 192.168.0.0/24
           or 10.0.0.0/16)
@@ -290,23 +608,48 @@ def get_cidr_block(options):
           blocks defined in VPC peerings, etc.
 
     Ideally it should be a CIDR block that is adjacent to the VPC CIDR.
-    For example if the VPC has 10.0.0.0/24 we should choose 10.0.1.0/30 to benefit
+    For example if the VPC has 10.0.0.0/24 we should choose 10.0.4.0/22 to benefit
     from potential security groups which are allowing access to 10.0.0.0/16.
 
-    :param options: Options passed as command line arguments by the user
-    :return: True if we were able to find a CIDR block for the VPN client
+    All the prefixes in use (local interfaces and routes, the CIDR blocks of
+    all the VPCs in the region, peered VPCs, VPC and transit gateway routes)
+    are merged into a sorted interval index, see utils/cidr.py, so finding a
+    free block takes a few binary searches.
+
+    :param context: The step context
+    :return: The CIDR block for the VPN client
     """
-    state = State()
-    state.append('cidr_block', '10.2.0.0/16')
+    profile = context.options.profile
+    checks = context.results['perform_initial_checks']
 
-    # TODO: Choose a /30 or /29 CIDR block! Larger has more changes of collision
+    start = time.time()
 
-    print('Using CIDR block %s' % state.get('cidr_block'))
+    try:
+        prefixes = allocator.in_use_prefixes(profile, checks['region'])
+        vpc = inventory.get_resources(profile, checks['region'], 'vpc', [checks['vpc_id']])
+    except Exception as e:
+        print('Failed to read the networks in use: %s' % e)
+        return False
 
-    return True
+    vpc_cidrs = allocator.vpc_cidr_blocks(vpc[0]) if vpc else []
 
+    index = PrefixIndex(prefixes)
+    cidr_block = allocator.allocate(index, vpc_cidrs)
 
-def get_dns_servers(options):
+    if cidr_block is None:
+        print('There is no free CIDR block for the VPN clients in the private ranges')
+        return False
+
+    State().append('cidr_block', cidr_block)
+
+    args = (cidr_block, ', '.join(vpc_cidrs), len(prefixes), len(index), time.time() - start)
+    print('Using CIDR block %s (VPC %s, %s prefixes in use merged into %s ranges,'
+          ' %.2f seconds)' % args)
+
+    return cidr_block
+
+
+def get_dns_servers(context):
     """
     Get the DNS servers for the VPN connection.
 
@@ -318,47 +661,74 @@ def get_dns_servers(options):
         * 1.1.1.1
         * 8.8.8.8
 
-    :param options: Options passed as command line arguments by the user
-    :return: True if we were able to get the DNS servers for the VPN
+    :param context: The step context
+    :return: The list of DNS servers for the VPN
     """
-    state = State()
-
     # TODO: Implement custom DNS according to remote config
-    state.append('dns_server_list', DEFAULT_DNS_SERVERS)
+    dns_server_list = DEFAULT_DNS_SERVERS
 
-    print('Using DNS servers: %s' % ', '.join(state.get('dns_server_list')))
+    State().append('dns_server_list', dns_server_list)
+    print('Using DNS servers: %s' % ', '.join(dns_server_list))
 
-    return True
+    return dns_server_list
 
 
-def create_client_vpn_endpoint(options):
+def vpc_dns_server(ec2_client, profile, region, vpc_id):
+    """
+    :param ec2_client: The EC2 client
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :param vpc_id: The VPC ID
+    :return: The address of the Amazon provided DNS server of the VPC (the
+             base of the primary CIDR block plus two), None if DNS support
+             is disabled in the VPC or it could not be read
+    """
+    try:
+        vpcs = inventory.get_resources(profile, region, 'vpc', [vpc_id])
+        response = ec2_client.describe_vpc_attribute(VpcId=vpc_id,
+                                                     Attribute='enableDnsSupport')
+    except Exception as e:
+        print('Failed to read the DNS settings of %s: %s' % (vpc_id, e))
+        return None
+
+    if not vpcs or not response['EnableDnsSupport']['Value']:
+        return None
+
+    network = ipaddress.ip_network(vpcs[0]['CidrBlock'])
+    return str(network.network_address + 2)
+
+
+def create_client_vpn_endpoint(context):
     """
     Create client VPN endpoint
 
         aws ec2 create-client-vpn-endpoint ...
 
-    :param options: Options passed as command line arguments by the user
-    :return: True if all the SSL certs were successfully created
+    :param context: The step context
+    :return: A dict containing the client VPN endpoint and association IDs
     """
     state = State()
+    results = context.results
+    checks = results['perform_initial_checks']
+
+    ec2_client = get_client('ec2', context.options.profile, checks['region'])
 
-    session = boto3.Session(profile_name=state.get('profile'),
-                            region_name='us-east-1')
-    ec2_client = session.client('ec2')
+    transport = getattr(context.options, 'transport', DEFAULT_TRANSPORT_PROTOCOL)
+    vpn_port = getattr(context.options, 'vpn_port', DEFAULT_VPN_PORT)
 
     #
     #    aws ec2 create-client-vpn-endpoint
     #
     try:
         response = ec2_client.create_client_vpn_endpoint(
-            ClientCidrBlock=state.get('cidr_block'),
+            ClientCidrBlock=results['get_cidr_block'],
 
-            ServerCertificateArn=state.get('server_cert_acm_arn'),
+            ServerCertificateArn=results['import_server_cert'],
 
             AuthenticationOptions=[
                 {'Type': 'certificate-authentication',
                  'MutualAuthentication': {
-                     'ClientRootCertificateChainArn': state.get('client_cert_acm_arn')
+                     'ClientRootCertificateChainArn': results['import_client_cert']
                  }}
             ],
 
@@ -366,9 +736,11 @@ def create_client_vpn_endpoint(options):
                 'Enabled': False,
             },
 
-            DnsServers=state.get('dns_server_list'),
+            DnsServers=results['get_dns_servers'],
 
-            TransportProtocol='udp',
+            TransportProtocol=transport,
+
+            VpnPort=vpn_port,
 
             # Only route some traffic to the VPN, internet traffic will
             # still go out using the workstation regular default route
@@ -379,39 +751,102 @@ def create_client_vpn_endpoint(options):
         return False
     else:
         vpn_endpoint_id = response['ClientVpnEndpointId']
-        state.append('vpn_endpoint_id', vpn_endpoint_id)
+
+        with state.transaction():
+            state.append('vpn_endpoint_id', vpn_endpoint_id)
+            state.append('transport', transport)
+            state.append('vpn_port', vpn_port)
+
+    #
+    # The DNS servers pushed to the clients are not routed through the
+    # tunnel (SplitTunnel), `status --watch` and the supervisor send their
+    # probes to the VPC resolver instead. It needs an ingress rule when it
+    # is not in one of the subnets.
+    #
+    authorized_cidr_blocks = list(checks['subnet_cidr_blocks'])
+
+    probe_dns_server = vpc_dns_server(ec2_client, context.options.profile,
+                                      checks['region'], checks['vpc_id'])
+    probe_cidr_block = None
+
+    if probe_dns_server is not None:
+        address = ipaddress.ip_address(probe_dns_server)
+
+        if not any(address in ipaddress.ip_network(c) for c in authorized_cidr_blocks):
+            probe_cidr_block = '%s/32' % probe_dns_server
+            authorized_cidr_blocks.append(probe_cidr_block)
+
+    with state.transaction():
+        state.append('probe_dns_server', probe_dns_server)
+        state.append('probe_cidr_block', probe_cidr_block)
 
     #
     #    aws ec2 associate-client-vpn-target-network
+    #    aws ec2 authorize-client-vpn-ingress
     #
-    try:
-        response = ec2_client.associate_client_vpn_target_network(
-            ClientVpnEndpointId=vpn_endpoint_id,
-            SubnetId=state.get('subnet_id')
-        )
-    except Exception as e:
-        print('Failed to create client vpn association: %s' % e)
-        return False
-    else:
-        association_id = response['AssociationId']
-        state.append('association_id', association_id)
+    # One association and ingress rule per subnet, all the requests are sent
+    # concurrently
+    #
+    def associate(subnet_id):
+        return retry_while_error(
+            lambda: ec2_client.associate_client_vpn_target_network(
+                ClientVpnEndpointId=vpn_endpoint_id,
+                SubnetId=subnet_id
+            ),
+            CONCURRENT_MUTATION_ERRORS, WAIT_TIMEOUT, WAIT_MAX_INTERVAL)
+
+    def authorize(cidr_block):
+        if cidr_block == probe_cidr_block:
+            description = 'Client VPN DNS probe'
+        else:
+            index = checks['subnet_cidr_blocks'].index(cidr_block)
+            description = 'Client VPN ingress #%s' % (index + 1)
+
+        return retry_while_error(
+            lambda: ec2_client.authorize_client_vpn_ingress(
+                ClientVpnEndpointId=vpn_endpoint_id,
+                TargetNetworkCidr=cidr_block,
+                AuthorizeAllGroups=True,
+                Description=description,
+            ),
+            CONCURRENT_MUTATION_ERRORS, WAIT_TIMEOUT, WAIT_MAX_INTERVAL)
+
+    requests = [(associate, subnet_id) for subnet_id in checks['subnet_ids']]
+    requests += [(authorize, cidr_block) for cidr_block in authorized_cidr_blocks]
+
+    responses = map_concurrently(lambda request: request[0](request[1]), requests)
+
+    association_ids = []
+    success = True
+
+    for (function, item), response, error in responses:
+        if error is not None:
+            if function is associate:
+                print('Failed to create client vpn association for %s: %s' % (item, error))
+            else:
+                print('Failed to create ingress authorization for %s: %s' % (item, error))
+
+            success = False
+            continue
+
+        if function is associate:
+            association_ids.append(response['AssociationId'])
 
     #
-    #   aws ec2 authorize-client-vpn-ingress
+    # Save the associations which were created, even if others failed, so
+    # `purge` removes them
     #
-    try:
-        response = ec2_client.authorize_client_vpn_ingress(
-            ClientVpnEndpointId=vpn_endpoint_id,
-            TargetNetworkCidr=state.get('subnet_cidr_block'),
-            AuthorizeAllGroups=True,
-            Description='Client VPN ingress #1',
-        )
-    except Exception as e:
-        print('Failed to create ingress authorization for vpn client: %s' % e)
+    state.append('association_ids', association_ids)
+
+    #
+    # The associations use IP addresses of the subnets
+    #
+    inventory.invalidate(context.options.profile, checks['region'], 'subnet', checks['vpc_id'])
+
+    if not success:
         return False
-    else:
-        # TODO: How do I get the authorization ID to remove it later?
-        pass
+
+    print('Associated the client VPN with %s subnet(s)' % len(association_ids))
 
     #
     #   aws ec2 create-security-group
@@ -420,13 +855,14 @@ def create_client_vpn_endpoint(options):
         response = ec2_client.create_security_group(
             Description='Security group for client VPN',
             GroupName='client_vpn_%s' % int(time.time()),
-            VpcId=state.get('vpc_id'),
+            VpcId=checks['vpc_id'],
         )
 
-        state.append('security_group_id', response['GroupId'])
+        security_group_id = response['GroupId']
+        state.append('security_group_id', security_group_id)
 
         ec2_client.authorize_security_group_ingress(
-            GroupId=state.get('security_group_id'),
+            GroupId=security_group_id,
             IpPermissions=[
                 {'IpProtocol': 'tcp',
                  'FromPort': 0,
@@ -448,9 +884,9 @@ def create_client_vpn_endpoint(options):
     try:
         response = ec2_client.apply_security_groups_to_client_vpn_target_network(
             ClientVpnEndpointId=vpn_endpoint_id,
-            VpcId=state.get('vpc_id'),
+            VpcId=checks['vpc_id'],
             SecurityGroupIds=[
-                state.get('security_group_id'),
+                security_group_id,
             ],
         )
     except Exception as e:
@@ -460,26 +896,26 @@ def create_client_vpn_endpoint(options):
         # TODO: How do I get the authorization ID to remove it later?
         pass
 
-    return True
+    return {'vpn_endpoint_id': vpn_endpoint_id,
+            'association_ids': association_ids}
 
 
-def download_openvpn_config(options):
+def download_openvpn_config(context):
     """
     Downloads the OpenVPN config file from the Client VPN service
     and saves it to the state file.
 
-    :param options: Options passed as command line arguments by the user
+    :param context: The step context
     :return: True if the config was saved to the state
     """
     state = State()
 
-    session = boto3.Session(profile_name=state.get('profile'),
-                            region_name='us-east-1')
-    ec2_client = session.client('ec2')
+    region = context.results['perform_initial_checks']['region']
+    ec2_client = get_client('ec2', context.options.profile, region)
 
     try:
         response = ec2_client.export_client_vpn_client_configuration(
-            ClientVpnEndpointId=state.get('vpn_endpoint_id')
+            ClientVpnEndpointId=context.results['create_client_vpn_endpoint']['vpn_endpoint_id']
         )
     except Exception as e:
         print('Failed to download the client VPN configuration: %s' % e)
@@ -493,25 +929,42 @@ def download_openvpn_config(options):
     return True
 
 
-def wait_for_vpn_creation(options):
+def wait_for_vpn_creation(context):
     """
     The client VPN creation might take a few minutes to be created, this
-    method will wait until all resources are ready.
+    method will wait until all resources are ready: the target network
+    association, the ingress authorization rules and the endpoint itself.
 
-    :param options: Options passed as command line arguments by the user
+    Polling starts every second and backs off (with jitter) to
+    WAIT_MAX_INTERVAL seconds. Resources which are already ready are not
+    described again, so most polls require only one API call.
+
+    :param context: The step context
     :return: True if the VPN was successfully created and all resources
              are ready to be used.
     """
-    state = State()
-    association_id = state.get('association_id')
+    endpoint = context.results['create_client_vpn_endpoint']
+    region = context.results['perform_initial_checks']['region']
+    ec2_client = get_client('ec2', context.options.profile, region)
 
     print('Waiting for association... (this might take a while)')
 
-    for _ in range(120):
-        if association_is_ready(association_id):
-            return True
+    checker = VpnReadinessChecker(ec2_client,
+                                  endpoint['vpn_endpoint_id'],
+                                  endpoint['association_ids'])
+
+    backoff = Backoff(initial=1.0, cap=WAIT_MAX_INTERVAL)
 
-        time.sleep(5)
+    if wait_until(checker.is_ready, WAIT_TIMEOUT, backoff, context.cancelled):
+        for resource, seconds in sorted(checker.ready_at.items(), key=lambda x: x[1]):
+            print('    %s ready after %.1f seconds' % (resource, seconds))
+
+        print('AWS Client VPN %s is ready to use! (%s API calls)' % (endpoint['vpn_endpoint_id'],
+                                                                     checker.api_calls))
+        return True
+
+    if context.cancelled.is_set():
+        return False
 
     print('Timeout waiting for association to be ready. The VPN might still'
           ' be usable, wait a few minutes and try to connect to it using the'
@@ -519,34 +972,92 @@ def wait_for_vpn_creation(options):
     return False
 
 
-def association_is_ready(association_id):
+class VpnReadinessChecker(object):
     """
-    Use the AWS API to check if the association_id is ready to be used
-
-    :param association_id: The newly created association_id
-    :return: True if the association_id is ready
+    Track the readiness of the client VPN resources across polls
     """
-    state = State()
-    vpn_endpoint_id = state.get('vpn_endpoint_id')
+    ASSOCIATIONS = 'associations'
+    AUTHORIZATION_RULES = 'authorization rules'
+    ENDPOINT = 'endpoint'
+
+    def __init__(self, ec2_client, vpn_endpoint_id, association_ids):
+        self.ec2_client = ec2_client
+        self.vpn_endpoint_id = vpn_endpoint_id
+        self.association_ids = association_ids
+
+        self.start = time.time()
+        self.ready_at = {}
+        self.last_status = {}
+        self.api_calls = 0
+
+    def is_ready(self):
+        """
+        :return: True when all the resources are ready
+        """
+        checks = ((self.ASSOCIATIONS, self.associations_ready),
+                  (self.AUTHORIZATION_RULES, self.authorization_rules_ready),
+                  (self.ENDPOINT, self.endpoint_ready))
+
+        for resource, check in checks:
+            if resource in self.ready_at:
+                continue
 
-    session = boto3.Session(profile_name=state.get('profile'),
-                            region_name='us-east-1')
-    ec2_client = session.client('ec2')
+            #
+            # The endpoint only becomes available after the association
+            # completes, don't spend API calls on it before that
+            #
+            if resource == self.ENDPOINT and self.ASSOCIATIONS not in self.ready_at:
+                continue
 
-    try:
-        response = ec2_client.describe_client_vpn_endpoints(
-            ClientVpnEndpointIds=[vpn_endpoint_id],
+            try:
+                ready = check()
+            except Exception as e:
+                print('Failed to describe the client VPN %s: %s' % (resource, e))
+                continue
+
+            if ready:
+                self.ready_at[resource] = time.time() - self.start
+
+        return len(self.ready_at) == len(checks)
+
+    def report(self, resource, status):
+        if self.last_status.get(resource) == status:
+            return
+
+        self.last_status[resource] = status
+        args = (self.vpn_endpoint_id, resource, status)
+        print('AWS Client VPN %s %s: %s' % args)
+
+    def associations_ready(self):
+        self.api_calls += 1
+        response = self.ec2_client.describe_client_vpn_target_networks(
+            ClientVpnEndpointId=self.vpn_endpoint_id,
+            AssociationIds=self.association_ids,
         )
-    except Exception as e:
-        print('Failed to describe the client VPN state: %s' % e)
-        return False
 
-    status = response['ClientVpnEndpoints'][0]['Status']['Code']
+        statuses = [t['Status']['Code'] for t in response['ClientVpnTargetNetworks']]
+        self.report(self.ASSOCIATIONS, ', '.join(statuses) or 'missing')
 
-    if status == 'available':
-        print('AWS Client VPN %s is ready to use!' % vpn_endpoint_id)
-        return True
+        return len(statuses) == len(self.association_ids) and set(statuses) == {'associated'}
 
-    args = (vpn_endpoint_id, status)
-    print('AWS Client VPN %s has status %s' % args)
-    return False
+    def authorization_rules_ready(self):
+        self.api_calls += 1
+        response = self.ec2_client.describe_client_vpn_authorization_rules(
+            ClientVpnEndpointId=self.vpn_endpoint_id,
+        )
+
+        statuses = [r['Status']['Code'] for r in response['AuthorizationRules']]
+        self.report(self.AUTHORIZATION_RULES, ', '.join(statuses) or 'missing')
+
+        return bool(statuses) and set(statuses) == {'active'}
+
+    def endpoint_ready(self):
+        self.api_calls += 1
+        response = self.ec2_client.describe_client_vpn_endpoints(
+            ClientVpnEndpointIds=[self.vpn_endpoint_id],
+        )
+
+        status = response['ClientVpnEndpoints'][0]['Status']['Code']
+        self.report(self.ENDPOINT, status)
+
+        return status == 'available'
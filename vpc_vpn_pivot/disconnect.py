@@ -2,7 +2,7 @@ import os
 import signal
 
 from vpc_vpn_pivot.state import State
-from vpc_vpn_pivot.utils.misc import is_root
+from vpc_vpn_pivot.utils.misc import is_root, pid_is_alive
 
 
 def disconnect(options):
@@ -23,14 +23,40 @@ def disconnect(options):
         return 1
 
     openvpn_pid = state.get('openvpn_pid')
-    if openvpn_pid is None:
+    supervisor_pid = state.get('supervisor_pid')
+
+    if openvpn_pid is None and supervisor_pid is None:
         print('The VPN connection was never initiated.')
         return 1
 
+    exporter_pid = state.get('exporter_pid')
+
+    #
+    # Update the state before signaling the supervisor, it also updates the
+    # state when it exits
+    #
+    with state.transaction():
+        for key in ('openvpn_pid', 'supervisor_pid', 'exporter_pid'):
+            if state.get(key) is not None:
+                state.remove(key)
+
+    if exporter_pid is not None and pid_is_alive(exporter_pid):
+        os.kill(exporter_pid, signal.SIGTERM)
+
+    if supervisor_pid is not None and pid_is_alive(supervisor_pid):
+        #
+        # The supervisor stops the OpenVPN client before exiting
+        #
+        os.kill(supervisor_pid, signal.SIGTERM)
+        print('Stop signal sent to the OpenVPN supervisor process')
+        return 0
+
+    if openvpn_pid is None or not pid_is_alive(openvpn_pid):
+        print('The OpenVPN client is not running.')
+        return 0
+
     os.kill(openvpn_pid, signal.SIGINT)
 
     print('Ctrl+C sent to the OpenVPN client process')
 
-    state.remove('openvpn_pid')
-
     return 0
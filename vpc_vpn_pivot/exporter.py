@@ -0,0 +1,214 @@
+import os
+import sys
+import time
+import argparse
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from vpc_vpn_pivot import metrics
+from vpc_vpn_pivot.state import State
+from vpc_vpn_pivot.constants import (OPENVPN_LOG_FILE,
+                                     API_METRICS_FILE,
+                                     METRICS_ADDRESS,
+                                     METRICS_TEXTFILE_INTERVAL)
+from vpc_vpn_pivot.connect import TUNNEL_UP
+from vpc_vpn_pivot.watch import read_interface_counters
+from vpc_vpn_pivot.utils.misc import pid_is_alive
+from vpc_vpn_pivot.utils.tail import LogFollower
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Collector(object):
+    """
+    Build the metrics in Prometheus text format. Everything is read from
+    sources which are cheap to query: the state file, /proc/net/dev, the new
+    lines of the OpenVPN log and the API metrics file (only when it changes).
+    """
+    def __init__(self, openvpn_pid):
+        self.openvpn_pid = openvpn_pid
+        self.tunnels_up = 0
+        self._follower = LogFollower(OPENVPN_LOG_FILE)
+        self._api_mtime = None
+        self._api_lines = []
+
+    def collect(self):
+        state = State()
+        state.reload()
+
+        for line in self._follower.read_lines():
+            if TUNNEL_UP in line:
+                self.tunnels_up += 1
+
+        lines = []
+
+        self._gauge(lines, 'vpc_vpn_pivot_up',
+                    '1 if the OpenVPN client is running',
+                    1 if pid_is_alive(self.openvpn_pid) else 0)
+
+        self._counter(lines, 'vpc_vpn_pivot_connects_total',
+                      'Number of times `connect` started the OpenVPN client',
+                      state.get('connect_count') or 0)
+
+        self._counter(lines, 'vpc_vpn_pivot_reconnects_total',
+                      'Number of times the OpenVPN client re-established the tunnel',
+                      max(self.tunnels_up - 1, 0))
+
+        outages = state.get('outages') or []
+
+        self._counter(lines, 'vpc_vpn_pivot_outages_total',
+                      'Tunnel outages recovered by the supervisor',
+                      len(outages))
+
+        self._counter(lines, 'vpc_vpn_pivot_outage_seconds_total',
+                      'Seconds the tunnel was down, for the outages recovered by the supervisor',
+                      '%.3f' % sum(o['duration'] for o in outages))
+
+        time_to_connect = state.get('time_to_connect')
+        if time_to_connect is not None:
+            self._gauge(lines, 'vpc_vpn_pivot_time_to_connect_seconds',
+                        'Seconds between starting OpenVPN and the tunnel being up',
+                        '%.3f' % time_to_connect)
+
+        device = state.get('tun_device')
+        counters = read_interface_counters(device) if device else None
+
+        if counters is not None:
+            names = (('receive_bytes', 'Bytes received'),
+                     ('transmit_bytes', 'Bytes sent'),
+                     ('receive_packets', 'Packets received'),
+                     ('transmit_packets', 'Packets sent'))
+
+            for (name, description), value in zip(names, counters):
+                name = 'vpc_vpn_pivot_tunnel_%s_total' % name
+                lines.extend(['# HELP %s %s through the tunnel' % (name, description),
+                              '# TYPE %s counter' % name,
+                              '%s{device="%s"} %s' % (name, device, value)])
+
+        lines.extend(self._api_metrics())
+
+        return '\n'.join(lines) + '\n'
+
+    def _api_metrics(self):
+        try:
+            mtime = os.stat(API_METRICS_FILE).st_mtime
+        except FileNotFoundError:
+            return []
+
+        if mtime != self._api_mtime:
+            self._api_lines = metrics.render_api_metrics(metrics.load())
+            self._api_mtime = mtime
+
+        return self._api_lines
+
+    def _gauge(self, lines, name, description, value):
+        lines.extend(['# HELP %s %s' % (name, description),
+                      '# TYPE %s gauge' % name,
+                      '%s %s' % (name, value)])
+
+    def _counter(self, lines, name, description, value):
+        lines.extend(['# HELP %s %s' % (name, description),
+                      '# TYPE %s counter' % name,
+                      '%s %s' % (name, value)])
+
+
+def serve(collector, port):
+    """
+    Serve the metrics over HTTP until the OpenVPN client exits
+
+    :param collector: A Collector instance
+    :param port: The TCP port to listen on
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            body = collector.collect().encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((METRICS_ADDRESS, port), MetricsHandler)
+    server.timeout = 1
+
+    print('Serving metrics at http://%s:%s/metrics' % (METRICS_ADDRESS, port))
+
+    with server:
+        while pid_is_alive(collector.openvpn_pid):
+            server.handle_request()
+
+
+def write_textfile(collector, filename):
+    """
+    Write the metrics to `filename` every few seconds until the OpenVPN
+    client exits. The file is replaced atomically, so it can be read by the
+    node_exporter textfile collector at any time.
+
+    :param collector: A Collector instance
+    :param filename: The file to write
+    """
+    print('Writing metrics to %s' % filename)
+
+    while True:
+        alive = pid_is_alive(collector.openvpn_pid)
+
+        temp_filename = filename + '.tmp'
+
+        with open(temp_filename, 'w') as f:
+            f.write(collector.collect())
+
+        os.replace(temp_filename, filename)
+
+        if not alive:
+            return
+
+        time.sleep(METRICS_TEXTFILE_INTERVAL)
+
+
+def exporter_args(options):
+    """
+    :param options: Options passed as command line arguments to `connect`
+    :return: The arguments for the exporter process, None if the user did
+             not ask for metrics
+    """
+    port = getattr(options, 'metrics_port', None)
+    textfile = getattr(options, 'metrics_textfile', None)
+
+    if port is not None:
+        return ['--port', str(port)]
+
+    if textfile is not None:
+        return ['--textfile', os.path.abspath(textfile)]
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='vpc_vpn_pivot.exporter')
+    parser.add_argument('--pid', type=int, required=True)
+
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--port', type=int)
+    output.add_argument('--textfile')
+
+    options = parser.parse_args()
+    collector = Collector(options.pid)
+
+    if options.port is not None:
+        serve(collector, options.port)
+    else:
+        write_textfile(collector, options.textfile)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
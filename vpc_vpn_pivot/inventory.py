@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from vpc_vpn_pivot.clients import get_client
+from vpc_vpn_pivot.constants import DATA_PATH, INVENTORY_FILE, INVENTORY_TTL
+
+#
+# Resource type -> (describe operation, response key, ID key). All of them
+# are read using the operation paginator.
+#
+RESOURCES = {
+    'subnet': ('describe_subnets', 'Subnets', 'SubnetId'),
+    'vpc': ('describe_vpcs', 'Vpcs', 'VpcId'),
+    'route_table': ('describe_route_tables', 'RouteTables', 'RouteTableId'),
+    'vpc_peering_connection': ('describe_vpc_peering_connections', 'VpcPeeringConnections',
+                               'VpcPeeringConnectionId'),
+}
+
+#
+# The resources of a whole region are stored using this scope, the ones of
+# one VPC use the VPC ID as scope
+#
+ALL = '*'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resources (
+    profile TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource_type TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    vpc_id TEXT,
+    cidr_block TEXT,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (profile, region, resource_type, resource_id)
+);
+
+CREATE INDEX IF NOT EXISTS resources_by_vpc
+    ON resources (profile, region, resource_type, vpc_id);
+
+CREATE INDEX IF NOT EXISTS resources_by_cidr
+    ON resources (cidr_block);
+
+CREATE TABLE IF NOT EXISTS collections (
+    profile TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource_type TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (profile, region, resource_type, scope)
+);
+'''
+
+_lock = threading.RLock()
+_connection = None
+
+_config = {'enabled': True}
+
+_stats = {}
+
+
+def configure(enabled=None):
+    """
+    :param enabled: False to ignore the cached entries, AWS is always called
+                    and the inventory is only updated with the responses
+    """
+    with _lock:
+        if enabled is not None:
+            _config['enabled'] = enabled
+
+
+def get_resources(profile, region, resource_type, resource_ids):
+    """
+    Get resources by ID. When any of them is not in the inventory all the
+    resources of that type in the region are read again.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :param resource_type: One of RESOURCES, eg. subnet
+    :param resource_ids: The resource IDs
+    :return: The resources which exist, in the same order as `resource_ids`
+    """
+    with _lock:
+        if _config['enabled']:
+            rows = dict(_fresh_rows_by_id(profile, region, resource_type, resource_ids))
+
+            #
+            # After a fresh read of the whole region the missing resources
+            # are known not to exist
+            #
+            if len(rows) == len(resource_ids) or _collection_is_fresh(profile, region, resource_type, ALL):
+                _count(resource_type, 'hits')
+                return [json.loads(rows[i]) for i in resource_ids if i in rows]
+
+        _count(resource_type, 'misses')
+
+    items = _describe(profile, region, resource_type, ALL)
+    id_key = RESOURCES[resource_type][2]
+
+    by_id = dict((item[id_key], item) for item in items)
+    return [by_id[i] for i in resource_ids if i in by_id]
+
+
+def list_resources(profile, region, resource_type, vpc_id=None):
+    """
+    List the resources of one type in the region, or in one VPC
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :param resource_type: One of RESOURCES, eg. subnet
+    :param vpc_id: Only the resources of this VPC
+    :return: A list with the resources
+    """
+    scope = vpc_id or ALL
+
+    with _lock:
+        if _config['enabled']:
+            fresh = (_collection_is_fresh(profile, region, resource_type, ALL) or
+                     _collection_is_fresh(profile, region, resource_type, scope))
+
+            if fresh:
+                _count(resource_type, 'hits')
+                return _rows_in_scope(profile, region, resource_type, vpc_id)
+
+        _count(resource_type, 'misses')
+
+    return _describe(profile, region, resource_type, scope)
+
+
+def invalidate(profile, region, resource_type, vpc_id=None):
+    """
+    Remove resources from the inventory after they were changed, the next
+    read calls AWS
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param region: AWS region name
+    :param resource_type: One of RESOURCES, eg. subnet
+    :param vpc_id: Only remove the resources of this VPC
+    """
+    with _lock:
+        connection = _connect()
+
+        with connection:
+            if vpc_id is None:
+                connection.execute('DELETE FROM resources'
+                                   ' WHERE profile = ? AND region = ? AND resource_type = ?',
+                                   (profile, region, resource_type))
+                connection.execute('DELETE FROM collections'
+                                   ' WHERE profile = ? AND region = ? AND resource_type = ?',
+                                   (profile, region, resource_type))
+            else:
+                connection.execute('DELETE FROM resources'
+                                   ' WHERE profile = ? AND region = ? AND resource_type = ?'
+                                   ' AND vpc_id = ?',
+                                   (profile, region, resource_type, vpc_id))
+                connection.execute('DELETE FROM collections'
+                                   ' WHERE profile = ? AND region = ? AND resource_type = ?'
+                                   ' AND scope IN (?, ?)',
+                                   (profile, region, resource_type, vpc_id, ALL))
+
+
+def stats():
+    """
+    :return: A dict containing resource type -> {'hits': N, 'misses': N}
+    """
+    with _lock:
+        return dict((k, dict(v)) for k, v in _stats.items())
+
+
+def print_stats():
+    data = stats()
+
+    if not data:
+        return
+
+    hits = sum(s['hits'] for s in data.values())
+    misses = sum(s['misses'] for s in data.values())
+
+    print('Inventory cache: %s hit(s), %s miss(es)' % (hits, misses))
+
+    for resource_type, counters in sorted(data.items()):
+        print('    %s: %s hit(s), %s miss(es)' % (resource_type,
+                                                 counters['hits'],
+                                                 counters['misses']))
+
+
+def _describe(profile, region, resource_type, scope):
+    """
+    Read all the resources in the scope using the paginator and replace the
+    ones in the inventory
+    """
+    operation, response_key, id_key = RESOURCES[resource_type]
+
+    filters = []
+    if scope != ALL:
+        filters.append({'Name': 'vpc-id', 'Values': [scope]})
+
+    paginator = get_client('ec2', profile, region).get_paginator(operation)
+
+    items = []
+    for page in paginator.paginate(Filters=filters):
+        items.extend(page[response_key])
+
+    with _lock:
+        connection = _connect()
+
+        with connection:
+            if scope == ALL:
+                connection.execute('DELETE FROM resources'
+                                   ' WHERE profile = ? AND region = ? AND resource_type = ?',
+                                   (profile, region, resource_type))
+            else:
+                connection.execute('DELETE FROM resources'
+                                   ' WHERE profile = ? AND region = ? AND resource_type = ?'
+                                   ' AND vpc_id = ?',
+                                   (profile, region, resource_type, scope))
+
+            _store(profile, region, resource_type, [(item[id_key], item) for item in items])
+
+            connection.execute('INSERT OR REPLACE INTO collections VALUES (?, ?, ?, ?, ?)',
+                               (profile, region, resource_type, scope, time.time()))
+
+    return items
+
+
+def _store(profile, region, resource_type, items):
+    connection = _connect()
+    now = time.time()
+
+    rows = [(profile,
+             region,
+             resource_type,
+             resource_id,
+             item.get('VpcId'),
+             item.get('CidrBlock') or item.get('ClientCidrBlock'),
+             json.dumps(item, default=str),
+             now) for resource_id, item in items]
+
+    connection.executemany('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           rows)
+
+
+def _fresh_rows_by_id(profile, region, resource_type, resource_ids):
+    placeholders = ', '.join('?' * len(resource_ids))
+
+    cursor = _connect().execute('SELECT resource_id, data FROM resources'
+                                ' WHERE profile = ? AND region = ? AND resource_type = ?'
+                                ' AND fetched > ? AND resource_id IN (%s)' % placeholders,
+                                [profile, region, resource_type, _oldest(resource_type)] +
+                                list(resource_ids))
+    return cursor.fetchall()
+
+
+def _rows_in_scope(profile, region, resource_type, vpc_id):
+    query = ('SELECT data FROM resources'
+             ' WHERE profile = ? AND region = ? AND resource_type = ?')
+    args = [profile, region, resource_type]
+
+    if vpc_id is not None:
+        query += ' AND vpc_id = ?'
+        args.append(vpc_id)
+
+    cursor = _connect().execute(query + ' ORDER BY resource_id', args)
+    return [json.loads(row[0]) for row in cursor]
+
+
+def _collection_is_fresh(profile, region, resource_type, scope):
+    cursor = _connect().execute('SELECT 1 FROM collections'
+                                ' WHERE profile = ? AND region = ? AND resource_type = ?'
+                                ' AND scope = ? AND fetched > ?',
+                                (profile, region, resource_type, scope,
+                                 _oldest(resource_type)))
+    return cursor.fetchone() is not None
+
+
+def _oldest(resource_type):
+    return time.time() - INVENTORY_TTL[resource_type]
+
+
+def _count(resource_type, counter):
+    counters = _stats.setdefault(resource_type, {'hits': 0, 'misses': 0})
+    counters[counter] += 1
+
+
+def _connect():
+    global _connection
+
+    if _connection is None:
+        os.makedirs(DATA_PATH, exist_ok=True)
+
+        connection = sqlite3.connect(INVENTORY_FILE, timeout=30, check_same_thread=False)
+        connection.executescript(SCHEMA)
+        _connection = connection
+
+    return _connection
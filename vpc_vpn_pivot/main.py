@@ -1,12 +1,38 @@
 import sys
 import argparse
+import importlib
 
-from vpc_vpn_pivot.create import create
-from vpc_vpn_pivot.connect import connect
-from vpc_vpn_pivot.disconnect import disconnect
-from vpc_vpn_pivot.purge import purge
-from vpc_vpn_pivot.status import status
+from vpc_vpn_pivot.constants import (CA_BACKENDS,
+                                     CA_BACKEND_NATIVE,
+                                     KEY_ALGORITHMS,
+                                     DEFAULT_KEY_ALGORITHM,
+                                     KEYPOOL_SIZE,
+                                     TUNING_PROFILES,
+                                     DEFAULT_TUNING_PROFILE,
+                                     TRANSPORT_PROTOCOLS,
+                                     DEFAULT_TRANSPORT_PROTOCOL,
+                                     VPN_PORTS,
+                                     DEFAULT_VPN_PORT,
+                                     BENCH_PORT,
+                                     BENCH_TESTS,
+                                     BENCH_UDP_RATE)
+from vpc_vpn_pivot.state import StateError
 
+#
+# The sub-command modules are only imported when the sub-command is run.
+# This prevents `status` and `disconnect` from loading boto3, requests, etc.
+#
+ALL_COMMANDS = {
+    'create': ('vpc_vpn_pivot.create', 'create'),
+    'connect': ('vpc_vpn_pivot.connect', 'connect'),
+    'status': ('vpc_vpn_pivot.status', 'status'),
+    'disconnect': ('vpc_vpn_pivot.disconnect', 'disconnect'),
+    'purge': ('vpc_vpn_pivot.purge', 'purge'),
+    'keypool': ('vpc_vpn_pivot.ssl.keypool', 'keypool'),
+    'cipher-bench': ('vpc_vpn_pivot.tuning', 'cipher_bench'),
+    'bench': ('vpc_vpn_pivot.bench', 'bench'),
+    'list-subnets': ('vpc_vpn_pivot.subnets', 'list_subnets'),
+}
 
 DESCRIPTION = '''\
 This tool simplifies the creation of an AWS Client VPN with the objective
@@ -31,18 +57,105 @@ def parse_args():
                                            help='Create the VPN server')
 
     parser_connect.add_argument('--profile',
-                                help='AWS profile name (as stored in ~/.aws/credentials)',
-                                required=True)
+                                help='AWS profile name (as stored in ~/.aws/credentials).'
+                                     ' Required unless --attach is used')
 
     parser_connect.add_argument('--subnet-id',
-                                help='Subnet ID of the target network to start a connection with',
-                                required=True)
+                                help='Subnet ID of the target network to start a connection with.'
+                                     ' Repeat to associate subnets in several availability zones.'
+                                     ' Required unless --attach is used',
+                                action='append')
+
+    parser_connect.add_argument('--all-azs',
+                                help='Also associate one subnet of the VPC in each availability'
+                                     ' zone which is not covered by --subnet-id',
+                                action='store_true',
+                                default=False)
+
+    parser_connect.add_argument('--region',
+                                help='Region of the subnets. Defaults to the region configured'
+                                     ' for the profile, or us-east-1',
+                                default=None)
+
+    parser_connect.add_argument('--regions',
+                                help='Comma separated list of regions. One VPN is created in each'
+                                     ' region where one of the --subnet-id is found, concurrently',
+                                type=regions_option,
+                                default=None)
+
+    parser_connect.add_argument('--pick-fastest',
+                                help='Use the VPN of the region with the lowest API and endpoint'
+                                     ' latency. By default the first region in --regions is used',
+                                action='store_true',
+                                default=False)
+
+    parser_connect.add_argument('--no-cache',
+                                help='Read all the AWS resources again instead of using'
+                                     ' the local inventory',
+                                action='store_true',
+                                default=False)
+
+    parser_connect.add_argument('--detach',
+                                help='Create the VPN in a background process, use `status`'
+                                     ' to see the progress',
+                                action='store_true',
+                                default=False)
+
+    parser_connect.add_argument('--attach',
+                                help='Show the output of a create running in the background',
+                                action='store_true',
+                                default=False)
+
+    parser_connect.add_argument('--worker',
+                                help=argparse.SUPPRESS,
+                                action='store_true',
+                                default=False)
 
     parser_connect.add_argument('--force',
                                 help='Force the connect command to run even if there is a previous state',
                                 action='store_true',
                                 default=False)
 
+    parser_connect.add_argument('--transport',
+                                help='Transport protocol used by the VPN',
+                                choices=TRANSPORT_PROTOCOLS,
+                                default=DEFAULT_TRANSPORT_PROTOCOL)
+
+    parser_connect.add_argument('--vpn-port',
+                                help='Port used by the VPN endpoint',
+                                type=int,
+                                choices=VPN_PORTS,
+                                default=DEFAULT_VPN_PORT)
+
+    parser_connect.add_argument('--ca-backend',
+                                help='Tool used to create the SSL certificates.'
+                                     ' The native backend runs in-process and'
+                                     ' does not require network access',
+                                choices=CA_BACKENDS,
+                                default=CA_BACKEND_NATIVE)
+
+    parser_connect.add_argument('--key-algorithm',
+                                help='Algorithm and size of the private keys',
+                                choices=KEY_ALGORITHMS,
+                                default=DEFAULT_KEY_ALGORITHM)
+
+    parser_connect.add_argument('--keypool',
+                                help='Take the private keys from the pool created by'
+                                     ' the `keypool` sub-command and refill it in'
+                                     ' the background',
+                                action='store_true',
+                                default=False)
+
+    parser_connect.add_argument('--easyrsa-tarball',
+                                help='Seed the EasyRSA cache from a local copy of the'
+                                     ' release tarball instead of downloading it',
+                                default=None)
+
+    parser_connect.add_argument('--download-timeout',
+                                help='Connect and read timeout in seconds for downloads',
+                                type=float,
+                                default=None)
+
     #
     # Create the parser for the "connect" command
     #
@@ -53,6 +166,43 @@ def parse_args():
                                                 ' your workstation in order to start the'
                                                 ' OpenVPN client.')
 
+    parser_connect.add_argument('--timeout',
+                                help='Max seconds to wait for the tunnel to be up',
+                                type=float,
+                                default=30)
+
+    parser_connect.add_argument('--tuning',
+                                help='OpenVPN tuning profile',
+                                choices=TUNING_PROFILES,
+                                default=DEFAULT_TUNING_PROFILE)
+
+    parser_connect.add_argument('--mtu',
+                                help='Path MTU to the VPN endpoint used to set tun-mtu'
+                                     ' and mssfix: auto (probe once per endpoint),'
+                                     ' off, or the MTU in bytes',
+                                type=mtu_option,
+                                default='auto')
+
+    parser_connect.add_argument('--supervise',
+                                help='Run OpenVPN under a supervisor which restarts'
+                                     ' it when the tunnel fails',
+                                action='store_true',
+                                default=False)
+
+    metrics_output = parser_connect.add_mutually_exclusive_group()
+
+    metrics_output.add_argument('--metrics-port',
+                                help='Serve Prometheus metrics on this local port'
+                                     ' while the VPN connection is up',
+                                type=int,
+                                default=None)
+
+    metrics_output.add_argument('--metrics-textfile',
+                                help='Write Prometheus metrics to this file every'
+                                     ' few seconds, eg. for the node_exporter'
+                                     ' textfile collector',
+                                default=None)
+
     #
     # Create the parser for the "disconnect" command
     #
@@ -65,6 +215,139 @@ def parse_args():
     parser_status = subparsers.add_parser('status',
                                           help='Check the VPC status')
 
+    parser_status.add_argument('--follow',
+                               help='Stream the OpenVPN log until the connection'
+                                    ' is closed',
+                               action='store_true',
+                               default=False)
+
+    parser_status.add_argument('--watch',
+                               help='Show the tunnel throughput, latency and time'
+                                    ' since the last handshake every second',
+                               action='store_true',
+                               default=False)
+
+    #
+    # Create the parser for the "keypool" command
+    #
+    parser_keypool = subparsers.add_parser('keypool',
+                                           help='Pre-generate private keys for `create --keypool`')
+
+    parser_keypool.add_argument('--key-algorithm',
+                                help='Algorithm and size of the private keys',
+                                choices=KEY_ALGORITHMS,
+                                default=DEFAULT_KEY_ALGORITHM)
+
+    parser_keypool.add_argument('--size',
+                                help='Number of keys to keep in the pool',
+                                type=int,
+                                default=KEYPOOL_SIZE)
+
+    #
+    # Create the parser for the "cipher-bench" command
+    #
+    parser_cipher_bench = subparsers.add_parser('cipher-bench',
+                                                help='Measure the speed of the OpenVPN data'
+                                                     ' ciphers on this CPU')
+
+    parser_cipher_bench.add_argument('--runs',
+                                     help='Number of times each cipher is tested',
+                                     type=int,
+                                     default=3)
+
+    #
+    # Create the parser for the "bench" command
+    #
+    parser_bench = subparsers.add_parser('bench',
+                                         help='Measure throughput, latency and connection'
+                                              ' rate through the VPN')
+
+    parser_bench.add_argument('--target',
+                              help='IP address of a host running the benchmark server'
+                                   ' (bench --serve or bench_server.py)')
+
+    parser_bench.add_argument('--port',
+                              help='TCP and UDP port of the benchmark server',
+                              type=int,
+                              default=BENCH_PORT)
+
+    parser_bench.add_argument('--tests',
+                              help='Comma separated list of benchmarks to run: %s' % ','.join(BENCH_TESTS),
+                              type=bench_tests_option,
+                              default=list(BENCH_TESTS))
+
+    parser_bench.add_argument('--duration',
+                              help='Seconds each throughput and connection rate benchmark runs',
+                              type=float,
+                              default=5)
+
+    parser_bench.add_argument('--udp-size',
+                              help='Size of the UDP datagrams in bytes',
+                              type=int,
+                              default=1200)
+
+    parser_bench.add_argument('--udp-rate',
+                              help='Max UDP send rate in Mbps, 0 for no limit (the'
+                                   ' benchmark server might become the bottleneck)',
+                              type=float,
+                              default=BENCH_UDP_RATE)
+
+    parser_bench.add_argument('--latency-count',
+                              help='Number of round trips measured by the latency benchmark',
+                              type=int,
+                              default=200)
+
+    parser_bench.add_argument('--output',
+                              help='Write the JSON results to this file',
+                              default=None)
+
+    parser_bench.add_argument('--serve',
+                              help='Run the benchmark server instead of the benchmarks',
+                              action='store_true',
+                              default=False)
+
+    parser_bench.add_argument('--bind',
+                              help='Address the benchmark server listens on',
+                              default='0.0.0.0')
+
+    #
+    # Create the parser for the "list-subnets" command
+    #
+    parser_list_subnets = subparsers.add_parser('list-subnets',
+                                                help='List the subnets which can be used'
+                                                     ' with `create --subnet-id`')
+
+    parser_list_subnets.add_argument('--profile',
+                                     help='AWS profile name (as stored in ~/.aws/credentials)')
+
+    parser_list_subnets.add_argument('--region',
+                                     help='Region to list. Defaults to the region configured'
+                                          ' for the profile, or us-east-1',
+                                     default=None)
+
+    parser_list_subnets.add_argument('--vpc-id',
+                                     help='Only list the subnets of this VPC',
+                                     default=None)
+
+    parser_list_subnets.add_argument('--az',
+                                     help='Only list the subnets in this availability zone',
+                                     default=None)
+
+    parser_list_subnets.add_argument('--cidr',
+                                     help='Only list the subnet with this CIDR block',
+                                     default=None)
+
+    parser_list_subnets.add_argument('--tag',
+                                     help='Only list the subnets with this tag, Key=Value or Key.'
+                                          ' Can be repeated',
+                                     action='append',
+                                     default=None)
+
+    parser_list_subnets.add_argument('--page-size',
+                                     help='Number of subnets requested to AWS in each call',
+                                     type=int,
+                                     default=None)
+
     #
     # Create the parser for the "purge" command
     #
@@ -79,19 +362,71 @@ def parse_args():
     return parser.parse_args(cmd_args)
 
 
+def bench_tests_option(value):
+    tests = [t.strip() for t in value.split(',') if t.strip()]
+
+    for test in tests:
+        if test not in BENCH_TESTS:
+            raise argparse.ArgumentTypeError('unknown benchmark %s' % test)
+
+    return tests
+
+
+def regions_option(value):
+    regions = []
+
+    for region in value.split(','):
+        region = region.strip()
+
+        if region and region not in regions:
+            regions.append(region)
+
+    if not regions:
+        raise argparse.ArgumentTypeError('expected a comma separated list of regions')
+
+    return regions
+
+
+def mtu_option(value):
+    if value in ('auto', 'off'):
+        return value
+
+    try:
+        mtu = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected auto, off or a number')
+
+    if not 576 <= mtu <= 9001:
+        raise argparse.ArgumentTypeError('the MTU must be between 576 and 9001')
+
+    return mtu
+
+
+def load_command(subcommand):
+    """
+    Import the module which implements the sub-command
+
+    :param subcommand: The sub-command name, eg. status
+    :return: The function which implements the sub-command
+    """
+    module_name, function_name = ALL_COMMANDS[subcommand]
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
 def main():
     options = parse_args()
 
-    all_commands = {
-        'create': create,
-        'connect': connect,
-        'status': status,
-        'disconnect': disconnect,
-        'purge': purge,
-    }
-
-    if options.subcommand not in all_commands:
+    if options.subcommand not in ALL_COMMANDS:
         print('Unknown sub-command: %s' % options.subcommand)
         return 1
 
-    return all_commands[options.subcommand](options)
+    try:
+        return load_command(options.subcommand)(options)
+    except StateError as e:
+        print(e)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+
+from vpc_vpn_pivot.constants import API_METRICS_FILE
+
+#
+# Upper bounds in seconds of the AWS API call latency histogram
+#
+API_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#
+# `create` and `purge` might flush at the same time, the read-modify-write
+# of API_METRICS_FILE is done while holding a lock on this file
+#
+API_METRICS_LOCK_FILE = API_METRICS_FILE + '.lock'
+
+_lock = threading.Lock()
+
+#
+# (service, operation) -> {'count': int, 'sum': float, 'buckets': [int],
+#                          'errors': {error code: int}}
+#
+_api_calls = {}
+
+
+def instrument_client(client):
+    """
+    Register botocore event handlers which measure the latency and errors of
+    each API call made using `client`. The measurements are kept in memory
+    until flush() is called.
+
+    :param client: A boto3 client
+    """
+    service = client.meta.service_model.service_name
+
+    def before_call(model, context, **kwargs):
+        context['metrics_operation'] = model.name
+        context['metrics_start'] = time.perf_counter()
+
+    def after_call(http_response, parsed, context, **kwargs):
+        error = None
+
+        if http_response.status_code >= 300:
+            error = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+
+        _record(service, context, error)
+
+    def after_call_error(exception, context, **kwargs):
+        _record(service, context, exception.__class__.__name__)
+
+    #
+    # before-call handlers can return a response and stop the event, make
+    # sure the start time is always recorded
+    #
+    client.meta.events.register_first('before-call.*.*', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+
+
+def _record(service, context, error):
+    start = context.get('metrics_start')
+    if start is None:
+        return
+
+    spent = time.perf_counter() - start
+    key = (service, context['metrics_operation'])
+
+    with _lock:
+        call = _api_calls.get(key)
+
+        if call is None:
+            call = {'count': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * len(API_LATENCY_BUCKETS),
+                    'errors': {}}
+            _api_calls[key] = call
+
+        call['count'] += 1
+        call['sum'] += spent
+
+        for i, bound in enumerate(API_LATENCY_BUCKETS):
+            if spent <= bound:
+                call['buckets'][i] += 1
+
+        if error is not None:
+            call['errors'][error] = call['errors'].get(error, 0) + 1
+
+
+def flush():
+    """
+    Add the API calls measured by this process to API_METRICS_FILE, where
+    the exporter reads them from. Called at the end of `create` and `purge`.
+
+    :return: True if the metrics were written
+    """
+    with _lock:
+        if not _api_calls:
+            return False
+
+        directory = os.path.dirname(API_METRICS_FILE)
+        os.makedirs(directory, exist_ok=True)
+
+        with open(API_METRICS_LOCK_FILE, 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            try:
+                _merge_and_write(directory)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    return True
+
+
+def _merge_and_write(directory):
+    data = load()
+
+    for (service, operation), call in _api_calls.items():
+        key = '%s %s' % (service, operation)
+        saved = data.setdefault(key, {'count': 0,
+                                      'sum': 0.0,
+                                      'buckets': [0] * len(API_LATENCY_BUCKETS),
+                                      'errors': {}})
+
+        saved['count'] += call['count']
+        saved['sum'] += call['sum']
+        saved['buckets'] = [a + b for a, b in zip(saved['buckets'], call['buckets'])]
+
+        for code, count in call['errors'].items():
+            saved['errors'][code] = saved['errors'].get(code, 0) + count
+
+    fd, temp_filename = tempfile.mkstemp(dir=directory,
+                                         prefix='.api-metrics-',
+                                         suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+
+    os.replace(temp_filename, API_METRICS_FILE)
+    _api_calls.clear()
+
+
+def load():
+    """
+    :return: The API call metrics saved by flush()
+    """
+    try:
+        with open(API_METRICS_FILE) as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    #
+    # Saved using a different set of buckets
+    #
+    for key in list(data):
+        if len(data[key].get('buckets', ())) != len(API_LATENCY_BUCKETS):
+            data.pop(key)
+
+    return data
+
+
+def render_api_metrics(data):
+    """
+    :param data: The API call metrics returned by load()
+    :return: A list with the lines in Prometheus text format
+    """
+    lines = ['# HELP vpc_vpn_pivot_aws_api_calls_total AWS API calls made by create and purge',
+             '# TYPE vpc_vpn_pivot_aws_api_calls_total counter']
+
+    for key, call in sorted(data.items()):
+        labels = _api_labels(key)
+        lines.append('vpc_vpn_pivot_aws_api_calls_total{%s} %s' % (labels, call['count']))
+
+    lines.extend(['# HELP vpc_vpn_pivot_aws_api_errors_total AWS API calls which failed',
+                  '# TYPE vpc_vpn_pivot_aws_api_errors_total counter'])
+
+    for key, call in sorted(data.items()):
+        labels = _api_labels(key)
+
+        for code, count in sorted(call['errors'].items()):
+            args = (labels, _escape(code), count)
+            lines.append('vpc_vpn_pivot_aws_api_errors_total{%s,code="%s"} %s' % args)
+
+    name = 'vpc_vpn_pivot_aws_api_call_duration_seconds'
+    lines.extend(['# HELP %s Latency of the AWS API calls, including retries' % name,
+                  '# TYPE %s histogram' % name])
+
+    for key, call in sorted(data.items()):
+        labels = _api_labels(key)
+
+        for bound, count in zip(API_LATENCY_BUCKETS, call['buckets']):
+            lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, count))
+
+        lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, call['count']))
+        lines.append('%s_sum{%s} %.6f' % (name, labels, call['sum']))
+        lines.append('%s_count{%s} %s' % (name, labels, call['count']))
+
+    return lines
+
+
+def _api_labels(key):
+    service, operation = key.split(' ', 1)
+    return 'service="%s",operation="%s"' % (_escape(service), _escape(operation))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
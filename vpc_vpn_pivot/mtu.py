@@ -0,0 +1,164 @@
+import time
+import random
+import subprocess
+
+from vpc_vpn_pivot.state import State
+from vpc_vpn_pivot.constants import MTU_CACHE_TTL
+from vpc_vpn_pivot.tuning import parse_directives
+from vpc_vpn_pivot.utils.which import which
+
+#
+# IPv4 (20) + ICMP (8) headers, added to the ping payload size
+#
+ICMP_OVERHEAD = 28
+
+#
+# IPv4 (20) + UDP (8) headers around each OpenVPN packet
+#
+UDP_OVERHEAD = 28
+
+#
+# Worst case OpenVPN data channel overhead: opcode and peer id, packet id,
+# IV, HMAC and block padding. Used to derive tun-mtu from the path MTU.
+#
+OPENVPN_OVERHEAD = 69
+
+MIN_MTU = 576
+MAX_MTU = 1500
+
+PING_TIMEOUT = 1
+
+
+def endpoint_host(openvpn_config_file):
+    """
+    :param openvpn_config_file: The OpenVPN config file contents
+    :return: The host name of the Client VPN endpoint, None if the config
+             has no `remote` directive
+    """
+    directives = parse_directives(openvpn_config_file)
+
+    remote = directives.get('remote')
+    if not remote:
+        return None
+
+    host = remote.split()[0]
+
+    #
+    # The endpoint only resolves with a random prefix, the same one OpenVPN
+    # adds when `remote-random-hostname` is set
+    #
+    if 'remote-random-hostname' in directives:
+        host = '%012x.%s' % (random.getrandbits(48), host)
+
+    return host
+
+
+def ping_df(host, mtu, timeout=PING_TIMEOUT):
+    """
+    Send one ping of `mtu` bytes with the don't fragment bit set
+
+    :return: True if the ping was answered
+    """
+    cmd = ['ping', '-n', '-q',
+           '-M', 'do',
+           '-c', '1',
+           '-W', str(timeout),
+           '-s', str(mtu - ICMP_OVERHEAD),
+           host]
+
+    completed = subprocess.run(cmd,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+
+    return completed.returncode == 0
+
+
+def probe_path_mtu(host):
+    """
+    Find the largest packet which reaches `host` without being fragmented,
+    using a binary search between MIN_MTU and MAX_MTU.
+
+    :param host: The host to probe
+    :return: The path MTU, None if the host doesn't answer pings
+    """
+    if not which('ping'):
+        print('`ping` is not installed, skipping the path MTU probe')
+        return None
+
+    if not ping_df(host, MIN_MTU):
+        return None
+
+    if ping_df(host, MAX_MTU):
+        return MAX_MTU
+
+    low, high = MIN_MTU, MAX_MTU - 1
+
+    while low < high:
+        middle = (low + high + 1) // 2
+
+        if ping_df(host, middle):
+            low = middle
+        else:
+            high = middle - 1
+
+    return low
+
+
+def get_path_mtu(openvpn_config_file):
+    """
+    Get the path MTU to the Client VPN endpoint. The result of the probe is
+    cached per endpoint in the state, later connects use the cached value.
+
+    :param openvpn_config_file: The OpenVPN config file contents
+    :return: The path MTU, None if it could not be measured
+    """
+    directives = parse_directives(openvpn_config_file)
+
+    remote = directives.get('remote')
+    if not remote:
+        return None
+
+    endpoint = remote.split()[0]
+
+    state = State()
+    cache = state.get('path_mtu') or {}
+
+    cached = cache.get(endpoint)
+    if cached is not None and time.time() - cached['measured'] < MTU_CACHE_TTL:
+        return cached['mtu']
+
+    print('Probing the path MTU to %s' % endpoint)
+
+    start = time.time()
+    mtu = probe_path_mtu(endpoint_host(openvpn_config_file))
+
+    if mtu is None:
+        print('The endpoint does not answer pings, using the default MTU')
+    else:
+        print('Path MTU is %s bytes (measured in %.2f seconds)' % (mtu, time.time() - start))
+
+    #
+    # Failures are cached too, the probe would fail again on the next connect
+    #
+    cache[endpoint] = {'mtu': mtu, 'measured': time.time()}
+    state.append('path_mtu', cache)
+
+    return mtu
+
+
+def mtu_directives(path_mtu):
+    """
+    :param path_mtu: The path MTU to the Client VPN endpoint
+    :return: A list with the (directive, arguments) tuples which prevent
+             the encapsulated packets from being fragmented
+    """
+    directives = [('mssfix', str(path_mtu - UDP_OVERHEAD))]
+
+    #
+    # Only lower the tun MTU when the path is smaller than usual, the server
+    # uses the default and a mismatch is logged as a warning
+    #
+    if path_mtu < MAX_MTU:
+        directives.insert(0, ('tun-mtu', str(path_mtu - UDP_OVERHEAD - OPENVPN_OVERHEAD)))
+
+    return directives
@@ -1,14 +1,31 @@
-import boto3
+import time
 import shutil
 
+from vpc_vpn_pivot import metrics
+from vpc_vpn_pivot import inventory
 from vpc_vpn_pivot.state import State
-from vpc_vpn_pivot.easyrsa import EASYRSA_PATH
+from vpc_vpn_pivot.constants import CA_PATH, PKI_PATH, DEFAULT_REGION
+from vpc_vpn_pivot.clients import get_client, print_stats, error_code, retry_while_error
+from vpc_vpn_pivot.utils.dag import Step, run_steps, all_succeeded, print_timings
+from vpc_vpn_pivot.utils.poll import wait_until, Backoff
+from vpc_vpn_pivot.utils.misc import map_concurrently
+
+PURGE_WAIT_TIMEOUT = 600
+PURGE_WAIT_INTERVAL = 5
+
+ENDPOINT_NOT_FOUND = 'InvalidClientVpnEndpointId.NotFound'
+CONCURRENT_MUTATION_ERRORS = ('ConcurrentMutationLimitExceeded',)
 
 
 def purge(options):
     """
     Remove all the AWS resources
 
+    The resources are removed in the opposite order of create().
+    Steps which do not depend on each other run concurrently, and the steps
+    which do wait for AWS to report that the resources they depend on were
+    actually removed.
+
     :param options: Options passed as command line arguments by the user
     :return: Return code
     """
@@ -19,157 +36,328 @@ def purge(options):
         return 1
 
     #
-    # The opposite of create_aws_resources()
+    # `create --regions` keeps the resources of each region in its own state
     #
-    overall_success = True
+    if state.get('regions'):
+        from vpc_vpn_pivot.regions import purge_regions
+        return purge_regions(state)
+
+    endpoint_deleted = ('delete_client_vpn_endpoint',)
+
     purge_steps = [
-        delete_client_vpn_endpoint,
-        delete_acm_certs,
-        delete_easy_rsa_install,
+        Step('revoke_client_vpn_ingress', revoke_client_vpn_ingress),
+        Step('disassociate_client_vpn_target_network', disassociate_client_vpn_target_network),
+        Step('delete_client_vpn_endpoint', delete_client_vpn_endpoint,
+             requires=('revoke_client_vpn_ingress',
+                       'disassociate_client_vpn_target_network')),
+        Step('delete_security_group', delete_security_group, requires=endpoint_deleted),
+        Step('delete_acm_server_cert', delete_acm_server_cert, requires=endpoint_deleted),
+        Step('delete_acm_client_cert', delete_acm_client_cert, requires=endpoint_deleted),
+        Step('delete_local_certs', delete_local_certs),
     ]
 
-    for purge_step in purge_steps:
-        success = purge_step()
-
-        if not success:
-            overall_success = False
+    start = time.time()
+    results = run_steps(purge_steps, options)
+    print_timings(results, time.time() - start)
 
-    if overall_success:
+    if all_succeeded(results):
         state.force({})
 
+    print_stats()
+    metrics.flush()
+
     return 0
 
 
-def delete_easy_rsa_install():
-    shutil.rmtree(EASYRSA_PATH, ignore_errors=True)
+def delete_local_certs(context):
+    #
+    # The EasyRSA install is kept in the cache, only remove the PKI
+    #
+    shutil.rmtree(CA_PATH, ignore_errors=True)
+    shutil.rmtree(PKI_PATH, ignore_errors=True)
     return True
 
 
-def delete_acm_certs():
+def delete_acm_server_cert(context):
+    return delete_acm_cert('server', 'server_cert_acm_arn')
+
+
+def delete_acm_client_cert(context):
+    return delete_acm_cert('client', 'client_cert_acm_arn')
+
+
+def delete_acm_cert(cert_type, state_key):
     """
-    Delete ACM certificates created during `create`
+    Delete an ACM certificate created during `create`. ACM refuses to delete
+    certificates which are still in use by the client VPN endpoint, so the
+    deletion is retried until AWS releases it.
 
-    :return: True if all certs were removed
+    :param cert_type: server or client, used for the messages
+    :param state_key: The state key which holds the certificate ARN
+    :return: True if the cert was removed
     """
     state = State()
 
-    session = boto3.Session(profile_name=state.get('profile'),
-                            region_name='us-east-1')
-    acm_client = session.client('acm')
-
-    server_arn = state.get('server_cert_acm_arn')
-    client_arn = state.get('client_cert_acm_arn')
-
-    server_arn_success = True
-    client_arn_success = True
-
-    if server_arn is not None:
-        try:
-            acm_client.delete_certificate(CertificateArn=server_arn)
-        except Exception as e:
-            args = (server_arn, e)
-            print('Failed to remove ACM server certificate with ARN %s: %s' % args)
-            server_arn_success = False
-        else:
-            print('Removed ACM server certificate with ARN %s' % server_arn)
-            state.remove('server_cert_acm_arn')
-
-    if client_arn is not None:
-        try:
-            acm_client.delete_certificate(CertificateArn=client_arn)
-        except Exception as e:
-            args = (server_arn, e)
-            print('Failed to remove ACM client certificate with ARN %s: %s' % args)
-            client_arn_success = False
-        else:
-            print('Removed ACM client certificate with ARN %s' % server_arn)
-            state.remove('client_cert_acm_arn')
-
-    return server_arn_success and client_arn_success
-
-
-def delete_client_vpn_endpoint():
+    arn = state.get(state_key)
+
+    if arn is None:
+        print('There is no ACM %s certificate to delete' % cert_type)
+        return True
+
+    acm_client = get_client('acm', state.get('profile'), state_region(state))
+
+    try:
+        _retry_while_error(lambda: acm_client.delete_certificate(CertificateArn=arn),
+                           ('ResourceInUseException',))
+    except Exception as e:
+        args = (cert_type, arn, e)
+        print('Failed to remove ACM %s certificate with ARN %s: %s' % args)
+        return False
+
+    print('Removed ACM %s certificate with ARN %s' % (cert_type, arn))
+    state.remove(state_key)
+    return True
+
+
+def state_region(state):
+    """
+    :param state: The State instance
+    :return: The region where the resources were created. Previous versions
+             did not store it and always used DEFAULT_REGION.
     """
-    Delete all resources created during Client VPN `create`
+    return state.get('region') or DEFAULT_REGION
+
 
-    :return: True if all certs were removed
+def state_list(state, key, legacy_key):
     """
-    state = State()
+    :param state: The State instance
+    :param key: The state key which holds a list, eg. association_ids
+    :param legacy_key: The key used by older versions to store one value,
+                       eg. association_id
+    :return: The list stored in the state, merged with the legacy value
+    """
+    values = list(state.get(key) or [])
 
-    session = boto3.Session(profile_name=state.get('profile'),
-                            region_name='us-east-1')
-    ec2_client = session.client('ec2')
+    legacy_value = state.get(legacy_key)
+    if legacy_value is not None and legacy_value not in values:
+        values.append(legacy_value)
+
+    return values
+
+
+def revoke_client_vpn_ingress(context):
+    state = State()
 
-    security_group_id = state.get('security_group_id')
     vpn_endpoint_id = state.get('vpn_endpoint_id')
-    subnet_cidr_block = state.get('subnet_cidr_block')
-    association_id = state.get('association_id')
+    subnet_cidr_blocks = state_list(state, 'subnet_cidr_blocks', 'subnet_cidr_block')
 
-    security_group_success = True
-    client_vpn_endpoint_success = True
-    client_vpn_target_network_success = True
-    client_vpn_ingress_success = True
+    #
+    # The ingress rule for the DNS probes, see create_client_vpn_endpoint()
+    #
+    if state.get('probe_cidr_block') is not None:
+        subnet_cidr_blocks.append(state.get('probe_cidr_block'))
 
-    if vpn_endpoint_id is None or subnet_cidr_block is None:
+    if vpn_endpoint_id is None or not subnet_cidr_blocks:
         print('There is no VPN ingress to revoke')
-    else:
-        try:
-            ec2_client.revoke_client_vpn_ingress(
+        return True
+
+    ec2_client = get_client('ec2', state.get('profile'), state_region(state))
+
+    def revoke(subnet_cidr_block):
+        _retry_while_error(
+            lambda: ec2_client.revoke_client_vpn_ingress(
                 ClientVpnEndpointId=vpn_endpoint_id,
                 TargetNetworkCidr=subnet_cidr_block,
                 RevokeAllGroups=True,
-            )
-        except Exception as e:
-            print('Failed to delete client VPN ingress: %s' % e)
-            client_vpn_ingress_success = False
-        else:
-            print('Successfully removed client VPN ingress')
-
-    if association_id is None:
+            ),
+            CONCURRENT_MUTATION_ERRORS)
+
+    success = True
+
+    for subnet_cidr_block, _, e in map_concurrently(revoke, subnet_cidr_blocks):
+        if e is None:
+            print('Successfully removed client VPN ingress for %s' % subnet_cidr_block)
+            continue
+
+        if error_code(e) in (ENDPOINT_NOT_FOUND,
+                             'InvalidClientVpnEndpointAuthorizationRuleNotFound'):
+            print('The client VPN ingress for %s was already removed' % subnet_cidr_block)
+            continue
+
+        print('Failed to delete client VPN ingress for %s: %s' % (subnet_cidr_block, e))
+        success = False
+
+    return success
+
+
+def disassociate_client_vpn_target_network(context):
+    state = State()
+
+    vpn_endpoint_id = state.get('vpn_endpoint_id')
+    association_ids = state_list(state, 'association_ids', 'association_id')
+
+    if not association_ids:
         print('There is no VPN association ID to delete')
-    else:
-        try:
-            ec2_client.disassociate_client_vpn_target_network(
+        return True
+
+    ec2_client = get_client('ec2', state.get('profile'), state_region(state))
+
+    def disassociate(association_id):
+        _retry_while_error(
+            lambda: ec2_client.disassociate_client_vpn_target_network(
                 ClientVpnEndpointId=vpn_endpoint_id,
                 AssociationId=association_id
-            )
-        except Exception as e:
+            ),
+            CONCURRENT_MUTATION_ERRORS)
+
+    for association_id, _, e in map_concurrently(disassociate, association_ids):
+        if e is None:
+            continue
+
+        if error_code(e) not in (ENDPOINT_NOT_FOUND,
+                                 'InvalidClientVpnAssociationId.NotFound'):
             args = (association_id, e)
             print('Failed to delete client VPN association with ID %s: %s' % args)
-            client_vpn_target_network_success = False
-        else:
-            print('Successfully removed client VPN association with ID %s' % association_id)
-            state.remove('association_id')
+            return False
+
+    #
+    # All the associations are removed at the same time, wait for them with
+    # one describe call per poll
+    #
+    print('Waiting for client VPN associations %s to be removed...' % ', '.join(association_ids))
+
+    def is_disassociated():
+        return association_is_removed(ec2_client, vpn_endpoint_id, association_ids)
+
+    if not wait_until(is_disassociated, PURGE_WAIT_TIMEOUT, Backoff(cap=PURGE_WAIT_INTERVAL)):
+        print('Timeout waiting for client VPN associations to be removed')
+        return False
+
+    print('Successfully removed client VPN associations with IDs %s' % ', '.join(association_ids))
+
+    with state.transaction():
+        for key in ('association_ids', 'association_id'):
+            if state.get(key) is not None:
+                state.remove(key)
+
+    inventory.invalidate(state.get('profile'), state_region(state),
+                         'subnet', state.get('vpc_id'))
+
+    return True
+
+
+def delete_client_vpn_endpoint(context):
+    state = State()
+
+    vpn_endpoint_id = state.get('vpn_endpoint_id')
 
     if vpn_endpoint_id is None:
         print('There is no client VPN endpoint to delete')
-    else:
-        try:
-            ec2_client.delete_client_vpn_endpoint(ClientVpnEndpointId=vpn_endpoint_id)
-        except Exception as e:
+        return True
+
+    ec2_client = get_client('ec2', state.get('profile'), state_region(state))
+
+    try:
+        ec2_client.delete_client_vpn_endpoint(ClientVpnEndpointId=vpn_endpoint_id)
+    except Exception as e:
+        if error_code(e) != ENDPOINT_NOT_FOUND:
             args = (vpn_endpoint_id, e)
             print('Failed to delete client VPN endpoint with ID %s: %s' % args)
-            client_vpn_endpoint_success = False
-        else:
-            print('Successfully removed client VPN endpoint with ID %s' % vpn_endpoint_id)
-            state.remove('vpn_endpoint_id')
+            return False
+
+    print('Waiting for client VPN endpoint %s to be removed...' % vpn_endpoint_id)
+
+    def is_deleted():
+        return endpoint_is_removed(ec2_client, vpn_endpoint_id)
+
+    if not wait_until(is_deleted, PURGE_WAIT_TIMEOUT, Backoff(cap=PURGE_WAIT_INTERVAL)):
+        print('Timeout waiting for client VPN endpoint %s to be removed' % vpn_endpoint_id)
+        return False
+
+    print('Successfully removed client VPN endpoint with ID %s' % vpn_endpoint_id)
+    state.remove('vpn_endpoint_id')
+    return True
+
+
+def delete_security_group(context):
+    state = State()
+
+    security_group_id = state.get('security_group_id')
 
     if security_group_id is None:
         print('There is no security group to remove')
-    else:
-        try:
-            ec2_client.delete_security_group(
-                GroupId=security_group_id
-            )
-        except Exception as e:
+        return True
+
+    ec2_client = get_client('ec2', state.get('profile'), state_region(state))
+
+    #
+    # The network interfaces created by the association might still reference
+    # the security group for a few seconds after the endpoint is deleted
+    #
+    try:
+        _retry_while_error(lambda: ec2_client.delete_security_group(GroupId=security_group_id),
+                           ('DependencyViolation',))
+    except Exception as e:
+        if error_code(e) != 'InvalidGroup.NotFound':
             args = (security_group_id, e)
             print('Failed to delete resource with ARN %s: %s' % args)
-            security_group_success = False
-        else:
-            print('Successfully removed resource with ARN %s' % security_group_id)
-            state.remove('security_group_id')
-
-    return (security_group_success and
-            client_vpn_endpoint_success and
-            client_vpn_target_network_success and
-            client_vpn_ingress_success)
+            return False
+
+    print('Successfully removed resource with ARN %s' % security_group_id)
+    state.remove('security_group_id')
+    return True
+
+
+def association_is_removed(ec2_client, vpn_endpoint_id, association_ids):
+    """
+    :return: True if AWS reports that none of the associations exist
+    """
+    try:
+        response = ec2_client.describe_client_vpn_target_networks(
+            ClientVpnEndpointId=vpn_endpoint_id,
+            AssociationIds=association_ids,
+        )
+    except Exception as e:
+        if error_code(e) == ENDPOINT_NOT_FOUND:
+            return True
+
+        print('Failed to describe the client VPN associations: %s' % e)
+        return False
+
+    for target_network in response['ClientVpnTargetNetworks']:
+        if target_network['Status']['Code'] != 'disassociated':
+            return False
+
+    return True
+
+
+def endpoint_is_removed(ec2_client, vpn_endpoint_id):
+    """
+    :return: True if AWS reports that the client VPN endpoint no longer exists
+    """
+    try:
+        response = ec2_client.describe_client_vpn_endpoints(
+            ClientVpnEndpointIds=[vpn_endpoint_id],
+        )
+    except Exception as e:
+        if error_code(e) == ENDPOINT_NOT_FOUND:
+            return True
+
+        print('Failed to describe the client VPN endpoint: %s' % e)
+        return False
+
+    for endpoint in response['ClientVpnEndpoints']:
+        if endpoint['Status']['Code'] != 'deleted':
+            return False
+
+    return True
+
+
+def _retry_while_error(function, error_codes):
+    """
+    Call `function` until it doesn't raise an exception with one of the
+    `error_codes`. Other exceptions are raised immediately.
+
+    :return: None, raises the last exception on timeout
+    """
+    retry_while_error(function, error_codes, PURGE_WAIT_TIMEOUT, PURGE_WAIT_INTERVAL)
@@ -0,0 +1,640 @@
+import os
+import re
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from vpc_vpn_pivot.state import State
+from vpc_vpn_pivot.clients import (get_client, get_regional_clients,
+                                   resolve_region, print_stats)
+from vpc_vpn_pivot.constants import (DATA_PATH,
+                                     STATE_FILE,
+                                     REGIONS_PATH,
+                                     REGION_LATENCY_SAMPLES,
+                                     SUBNET_REGIONS_FILE,
+                                     MAX_REGION_WORKERS)
+from vpc_vpn_pivot.mtu import endpoint_host
+from vpc_vpn_pivot.utils.misc import map_concurrently, spawn_detached
+from vpc_vpn_pivot.utils.tail import tail
+from vpc_vpn_pivot.utils.which import which
+
+#
+# The state directory of each region worker is set using this environment
+# variable, see constants.STATE_PATH. The caches and the key pool are shared.
+#
+HOME_ENV = 'VPC_VPN_PIVOT_HOME'
+
+WAIT_INTERVAL = 1
+FAILED_LOG_LINES = 10
+SOCKET_TIMEOUT = 3
+
+PING_AVG_RE = re.compile(r'= [\d.]+/([\d.]+)/')
+
+_cache_lock = threading.Lock()
+
+
+def create_in_regions(options):
+    """
+    Create one VPN in each of the regions in --regions where at least one of
+    the subnets is found. Each region is created by a `create` worker process
+    with its own state directory, all of them run at the same time.
+
+    The main state keeps the list of regions, used by `purge`, and a copy of
+    the state of the region used by `connect`: the first region which was
+    created successfully, or the one with the lowest latency when
+    --pick-fastest is set.
+
+    :param options: Options passed as command line arguments by the user
+    :return: Return code
+    """
+    subnets = find_subnet_regions(options.profile, options.regions, options.subnet_id)
+
+    if subnets is None:
+        return 1
+
+    found = set(s for region_subnets in subnets.values() for s in region_subnets)
+    missing = [s for s in options.subnet_id if s not in found]
+
+    if missing:
+        args = (', '.join(missing), ', '.join(options.regions))
+        print('The subnets %s do not exist in any of the regions: %s' % args)
+        return 1
+
+    regions = [r for r in options.regions if r in subnets]
+
+    for region in options.regions:
+        if region not in subnets:
+            print('None of the subnets is in %s, no VPN is created there' % region)
+
+    for region in regions:
+        if read_region_state(region) and not options.force:
+            print('The state of %s at %s is not empty. Use the `purge` sub-command'
+                  ' or --force' % (region, region_home(region)))
+            return 1
+
+    #
+    # Save the regions before any resource is created, so `purge` finds them
+    # even if this process dies
+    #
+    State().force({'profile': options.profile, 'regions': regions})
+
+    processes = {}
+
+    for region in regions:
+        args = worker_args(options, region, subnets[region])
+        processes[region] = run_in_region(region, args, 'create.log')
+
+        args = (region, ', '.join(subnets[region]), processes[region].pid)
+        print('Creating the VPN in %s for %s (process %s)' % args)
+
+    print('')
+    print('Waiting for %s region(s)... (this might take a while)' % len(regions))
+
+    try:
+        exit_codes = wait_for_regions(processes, 'create.log')
+    except KeyboardInterrupt:
+        print('\nThe VPN creation continues in the background, the output is'
+              ' written to %s/<region>/create.log' % REGIONS_PATH)
+        return 1
+
+    succeeded = [r for r in regions
+                 if exit_codes[r] == 0 and read_region_state(r).get('openvpn_config_file')]
+
+    if not succeeded:
+        print('Failed to create the VPN in all the regions. Call `purge` to'
+              ' remove the resources which were created.')
+        return 1
+
+    active = succeeded[0]
+
+    if options.pick_fastest:
+        active = pick_fastest(options.profile, succeeded)
+
+    activate_region(active, regions)
+    print_stats()
+
+    print('\nAWS Client VPN created in %s! Connect using:' % ', '.join(succeeded))
+    print('')
+    print('    sudo ./vpc-vpn-pivot connect    (uses %s)' % active)
+    print('')
+
+    if len(succeeded) != len(regions):
+        return 1
+
+    return 0
+
+
+def purge_regions(state):
+    """
+    Run `purge` for each of the regions created by `create --regions`, all
+    of them at the same time
+
+    :param state: The State instance
+    :return: Return code
+    """
+    regions = state.get('regions')
+
+    processes = {}
+
+    for region in regions:
+        if not read_region_state(region):
+            shutil.rmtree(region_home(region), ignore_errors=True)
+            continue
+
+        processes[region] = run_in_region(region, ['purge'], 'purge.log')
+        print('Removing the resources in %s (process %s)' % (region, processes[region].pid))
+
+    exit_codes = wait_for_regions(processes, 'purge.log')
+
+    failed = [r for r in processes if exit_codes[r] != 0]
+
+    for region in processes:
+        if region not in failed:
+            shutil.rmtree(region_home(region), ignore_errors=True)
+
+    if failed:
+        #
+        # Keep the regions which still have resources, `purge` can be called
+        # again to retry them
+        #
+        state.force({'profile': state.get('profile'), 'regions': failed})
+        return 1
+
+    state.force({})
+    return 0
+
+
+def describe_subnets_in_regions(profile, regions, subnet_ids, first_match=False):
+    """
+    Call ec2.describe_subnets in all the regions at the same time.
+
+    When `first_match` is set the search stops at the first region which has
+    one of the subnets: the queries which did not start yet are cancelled and
+    the ones still running are not waited for.
+
+    The errors are printed unless they don't matter, ie. a subnet was found
+    and `first_match` is set.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param regions: A list of region names
+    :param subnet_ids: A list of subnet IDs
+    :param first_match: Return as soon as one region has one of the subnets
+    :return: A tuple containing a dict with region -> subnets (only the
+             regions where subnets were found) and a dict with
+             region -> exception
+    """
+    found = threading.Event()
+
+    def describe(region):
+        if found.is_set():
+            return []
+
+        response = get_client('ec2', profile, region).describe_subnets(
+            Filters=[{'Name': 'subnet-id', 'Values': subnet_ids}]
+        )
+        return response['Subnets']
+
+    subnets = {}
+    errors = {}
+    futures = {}
+
+    executor = ThreadPoolExecutor(max_workers=min(MAX_REGION_WORKERS, len(regions)))
+
+    try:
+        futures = {executor.submit(describe, r): r for r in regions}
+
+        for future in as_completed(futures):
+            region = futures[future]
+
+            try:
+                region_subnets = future.result()
+            except Exception as e:
+                errors[region] = e
+                continue
+
+            if not region_subnets:
+                continue
+
+            subnets[region] = region_subnets
+
+            if first_match:
+                found.set()
+                return subnets, errors
+    finally:
+        #
+        # Don't wait for the queries which are still running.
+        # shutdown(cancel_futures=True) requires Python 3.9
+        #
+        for future in futures:
+            future.cancel()
+
+        executor.shutdown(wait=False)
+
+    #
+    # Expired credentials or missing permissions look like a missing subnet
+    # unless the errors are shown
+    #
+    for region, error in sorted(errors.items()):
+        print('Failed to describe the subnets in %s: %s' % (region, error))
+
+    return subnets, errors
+
+
+def find_subnet_regions(profile, regions, subnet_ids):
+    """
+    Find in which of the regions each subnet is. All the regions are queried
+    at the same time.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param regions: A list of region names
+    :param subnet_ids: A list of subnet IDs
+    :return: A dict containing region -> subnet IDs, only the regions where
+             subnets were found are included. None on error.
+    """
+    subnets, errors = describe_subnets_in_regions(profile, regions, subnet_ids)
+
+    if errors:
+        return None
+
+    result = {}
+
+    for region in regions:
+        if region not in subnets:
+            continue
+
+        region_subnets = set(s['SubnetId'] for s in subnets[region])
+        result[region] = [s for s in subnet_ids if s in region_subnets]
+
+    return result
+
+
+def locate_subnets(profile, subnet_ids, exclude=()):
+    """
+    Find the region of the subnets. The regions enabled in the account are
+    queried concurrently, the first region which has one of the subnets is
+    returned and the queries which did not start yet are cancelled.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param subnet_ids: A list of subnet IDs
+    :param exclude: Regions which are not queried, eg. because the caller
+                    already did
+    :return: The region name, None if the subnets were not found
+    """
+    region = cached_subnet_region(subnet_ids)
+    if region is not None and region not in exclude:
+        return region
+
+    try:
+        regions = enabled_regions(profile)
+    except Exception as e:
+        print('Failed to call ec2.describe_regions: %s' % e)
+        return None
+
+    regions = [r for r in regions if r not in exclude]
+
+    if not regions:
+        return None
+
+    print('Looking for %s in %s regions...' % (', '.join(subnet_ids), len(regions)))
+
+    start = time.time()
+    subnets, _ = describe_subnets_in_regions(profile, regions, subnet_ids,
+                                             first_match=True)
+
+    for region, region_subnets in subnets.items():
+        cache_subnet_regions(dict((s['SubnetId'], region) for s in region_subnets))
+
+        args = (region, time.time() - start)
+        print('Found the subnets in %s after %.2f seconds' % args)
+        return region
+
+    return None
+
+
+def enabled_regions(profile):
+    """
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :return: The names of the regions enabled in the account
+    """
+    ec2_client = get_client('ec2', profile, resolve_region(profile))
+    response = ec2_client.describe_regions()
+
+    return [r['RegionName'] for r in response['Regions']]
+
+
+def cached_subnet_region(subnet_ids):
+    """
+    :param subnet_ids: A list of subnet IDs
+    :return: The cached region of the first subnet which is in the cache,
+             None if none of them is
+    """
+    cache = load_subnet_regions()
+
+    for subnet_id in subnet_ids:
+        if subnet_id in cache:
+            return cache[subnet_id]
+
+    return None
+
+
+def cache_subnet_regions(subnet_regions):
+    """
+    Save subnet ID -> region pairs to SUBNET_REGIONS_FILE
+
+    :param subnet_regions: A dict containing subnet ID -> region
+    """
+    with _cache_lock:
+        cache = load_subnet_regions()
+        cache.update(subnet_regions)
+
+        os.makedirs(DATA_PATH, exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(dir=DATA_PATH,
+                                             prefix='.subnet-regions-',
+                                             suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(cache, indent=4, sort_keys=True))
+
+        os.replace(temp_filename, SUBNET_REGIONS_FILE)
+
+
+def load_subnet_regions():
+    try:
+        with open(SUBNET_REGIONS_FILE) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def worker_args(options, region, subnet_ids):
+    """
+    :return: The command line arguments of the `create` worker for `region`
+    """
+    args = ['create',
+            '--worker',
+            '--profile', options.profile,
+            '--region', region,
+            '--transport', options.transport,
+            '--vpn-port', str(options.vpn_port),
+            '--ca-backend', options.ca_backend,
+            '--key-algorithm', options.key_algorithm]
+
+    for subnet_id in subnet_ids:
+        args.extend(['--subnet-id', subnet_id])
+
+    if options.all_azs:
+        args.append('--all-azs')
+
+    if options.keypool:
+        args.append('--keypool')
+
+    if options.no_cache:
+        args.append('--no-cache')
+
+    if options.easyrsa_tarball is not None:
+        args.extend(['--easyrsa-tarball', os.path.abspath(options.easyrsa_tarball)])
+
+    if options.download_timeout is not None:
+        args.extend(['--download-timeout', str(options.download_timeout)])
+
+    return args
+
+
+def region_home(region):
+    return os.path.join(REGIONS_PATH, region)
+
+
+def read_region_state(region):
+    """
+    :return: The state of the region, an empty dict if there is none
+    """
+    filename = os.path.join(region_home(region), os.path.basename(STATE_FILE))
+
+    try:
+        with open(filename) as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def run_in_region(region, args, log_name):
+    """
+    Run a sub-command in a background process which uses the state directory
+    of `region`
+
+    :param region: The region name
+    :param args: The sub-command and its arguments
+    :param log_name: The output is written to this file in the state directory
+    :return: The subprocess.Popen instance
+    """
+    home = region_home(region)
+    os.makedirs(home, exist_ok=True)
+
+    log_filename = os.path.join(home, log_name)
+    open(log_filename, 'w').close()
+
+    return spawn_detached('vpc_vpn_pivot.main', args, log_filename, {HOME_ENV: home})
+
+
+def wait_for_regions(processes, log_name):
+    """
+    Wait for the processes started by run_in_region(), the last lines of the
+    output are shown for the ones which fail
+
+    :param processes: A dict containing region -> subprocess.Popen
+    :param log_name: The name of the log file of the processes
+    :return: A dict containing region -> exit code
+    """
+    start = time.time()
+    pending = dict(processes)
+    exit_codes = {}
+
+    while pending:
+        for region, process in list(pending.items()):
+            exit_code = process.poll()
+
+            if exit_code is None:
+                continue
+
+            del pending[region]
+            exit_codes[region] = exit_code
+
+            if exit_code == 0:
+                print('%s finished after %.1f seconds' % (region, time.time() - start))
+                continue
+
+            log_filename = os.path.join(region_home(region), log_name)
+            print('%s failed after %.1f seconds, last lines of %s:' % (region,
+                                                                    time.time() - start,
+                                                                    log_filename))
+
+            with open(log_filename, 'rb') as f:
+                for line in tail(f, FAILED_LOG_LINES):
+                    print('    %s' % line.decode('utf-8', errors='replace').rstrip())
+
+        if pending:
+            time.sleep(WAIT_INTERVAL)
+
+    return exit_codes
+
+
+def activate_region(region, regions):
+    """
+    Copy the state of `region` to the main state, `connect` uses it
+
+    :param region: The region to use
+    :param regions: All the regions created by `create --regions`
+    """
+    state = read_region_state(region)
+    state.pop('create_progress', None)
+
+    state['regions'] = regions
+    State().force(state)
+
+
+def pick_fastest(profile, regions):
+    """
+    Measure the API and endpoint latency of each region, from this
+    workstation, and choose the region with the lowest latency. The
+    endpoint latency is used when it could be measured for all the regions.
+
+    :param profile: AWS profile name (as stored in ~/.aws/credentials)
+    :param regions: The regions where the VPN was created
+    :return: The name of the fastest region
+    """
+    print('')
+    print('Measuring the latency to %s...' % ', '.join(regions))
+
+    clients = get_regional_clients('ec2', profile, regions)
+
+    def measure(region):
+        return measure_region(clients[region], read_region_state(region))
+
+    latencies = {}
+
+    for region, latency, error in map_concurrently(measure, [r for r in regions if r in clients]):
+        if error is not None:
+            print('Failed to measure the latency to %s: %s' % (region, error))
+            continue
+
+        latencies[region] = latency
+
+    if not latencies:
+        return regions[0]
+
+    use_endpoint = all(latency['endpoint_ms'] is not None for latency in latencies.values())
+
+    def rank(region):
+        latency = latencies[region]
+
+        if use_endpoint:
+            return latency['endpoint_ms'], latency['api_ms']
+
+        return latency['api_ms'], 0.0
+
+    ranked = sorted(latencies, key=rank)
+
+    print('')
+    print('    %-16s %14s %14s' % ('Region', 'API latency', 'Endpoint RTT'))
+
+    for region in ranked:
+        latency = latencies[region]
+        endpoint_ms = latency['endpoint_ms']
+        endpoint_ms = '-' if endpoint_ms is None else '%.1f ms' % endpoint_ms
+        print('    %-16s %11.1f ms %14s' % (region, latency['api_ms'], endpoint_ms))
+
+    print('')
+    print('Using %s' % ranked[0])
+
+    return ranked[0]
+
+
+def measure_region(ec2_client, region_state):
+    """
+    :param ec2_client: The EC2 client for the region
+    :param region_state: The state of the region
+    :return: A dict with the median API latency and endpoint round trip
+             time in milliseconds. The endpoint RTT is None when it could
+             not be measured.
+    """
+    vpn_endpoint_id = region_state['vpn_endpoint_id']
+
+    def describe():
+        ec2_client.describe_client_vpn_endpoints(ClientVpnEndpointIds=[vpn_endpoint_id])
+
+    #
+    # The first call opens the connection, it is not included
+    #
+    describe()
+
+    api_ms = []
+
+    for _ in range(REGION_LATENCY_SAMPLES):
+        start = time.perf_counter()
+        describe()
+        api_ms.append((time.perf_counter() - start) * 1000.0)
+
+    host = endpoint_host(region_state['openvpn_config_file'])
+
+    endpoint_ms = None
+    if host is not None:
+        endpoint_ms = endpoint_rtt(host,
+                                   region_state.get('transport'),
+                                   region_state.get('vpn_port'))
+
+    return {'api_ms': median(api_ms),
+            'endpoint_ms': endpoint_ms}
+
+
+def endpoint_rtt(host, transport, port):
+    """
+    Measure the round trip time to the Client VPN endpoint. TCP endpoints
+    are measured using the connection setup time, UDP ones using ping.
+
+    :return: The median RTT in milliseconds, None if the endpoint did not
+             answer
+    """
+    if transport == 'tcp':
+        rtts = []
+
+        for _ in range(REGION_LATENCY_SAMPLES):
+            start = time.perf_counter()
+
+            try:
+                sock = socket.create_connection((host, port), timeout=SOCKET_TIMEOUT)
+            except OSError:
+                continue
+
+            rtts.append((time.perf_counter() - start) * 1000.0)
+            sock.close()
+
+        return median(rtts) if rtts else None
+
+    if not which('ping'):
+        return None
+
+    cmd = ['ping', '-n', '-q',
+           '-c', str(REGION_LATENCY_SAMPLES),
+           '-W', str(SOCKET_TIMEOUT),
+           host]
+
+    completed = subprocess.run(cmd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+
+    match = PING_AVG_RE.search(completed.stdout.decode('utf-8', errors='replace'))
+    if match is None:
+        return None
+
+    return float(match.group(1))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
@@ -1,33 +1,37 @@
 from vpc_vpn_pivot.state import State
-from vpc_vpn_pivot.ssl.easyrsa import (remove_previous_install,
-                                       install_easyrsa,
-                                       create_vpn_certs)
+from vpc_vpn_pivot.constants import CA_BACKEND_NATIVE, DEFAULT_KEY_ALGORITHM
+from vpc_vpn_pivot.ssl import native, easyrsa, keypool
+from vpc_vpn_pivot.utils.download import DOWNLOAD_TIMEOUT
 
 
 def create_ssl_certs(options):
     """
-    Create the SSL certificates using easyrsa
+    Create the SSL certificates using the CA backend selected by the user:
+    the in-process native CA (default) or EasyRSA.
+
+    The paths are not saved to the state, see save_ssl_certs()
 
     :param options: Options passed as command line arguments by the user
-    :return: True if all the SSL certs were successfully created
+    :return: A dict containing the paths to the SSL certs and keys, or False
+             if the certs could not be created
     """
-    #
-    # Cleanup
-    #
-    remove_previous_install()
+    ca_backend = getattr(options, 'ca_backend', CA_BACKEND_NATIVE)
+    algorithm = getattr(options, 'key_algorithm', DEFAULT_KEY_ALGORITHM)
 
-    #
-    # Install EasyRSA
-    #
-    success = install_easyrsa()
+    if algorithm != DEFAULT_KEY_ALGORITHM:
+        print('Using %s keys. AWS Client VPN documents %s for the server'
+              ' certificate, ACM or the endpoint might reject other'
+              ' key types.' % (algorithm, DEFAULT_KEY_ALGORITHM))
 
-    if not success:
-        return False
+    if ca_backend == CA_BACKEND_NATIVE and not native.is_available():
+        print('The `cryptography` library is not installed, using EasyRSA'
+              ' to create the SSL certificates')
+        ca_backend = None
 
-    #
-    # Create VPN certs
-    #
-    result = create_vpn_certs()
+    if ca_backend == CA_BACKEND_NATIVE:
+        result = create_native_certs(options, algorithm)
+    else:
+        result = create_easyrsa_certs(options, algorithm)
 
     if not result:
         return False
@@ -38,14 +42,72 @@ def create_ssl_certs(options):
     client_crt = result[3]
     client_key = result[4]
 
+    certs = {'ca_crt': ca_crt,
+             'server_crt': server_crt,
+             'server_key': server_key,
+             'client_crt': client_crt,
+             'client_key': client_key}
+
+    print('Successfully created SSL certificates for the VPN')
+
+    return certs
+
+
+def save_ssl_certs(certs):
+    """
+    Save the paths to the SSL certs and keys to the state. `create` calls
+    this once the initial checks passed, a failed check must not leave a
+    state behind.
+
+    :param certs: The dict returned by create_ssl_certs()
+    :return: The same dict
+    """
     state = State()
 
-    state.append('ca_crt', ca_crt)
-    state.append('server_crt', server_crt)
-    state.append('server_key', server_key)
-    state.append('client_crt', client_crt)
-    state.append('client_key', client_key)
+    with state.transaction():
+        for key, path in certs.items():
+            state.append(key, path)
+
+    return certs
 
-    print('Successfully created SSL certificates for the VPN')
 
-    return True
+def create_native_certs(options, algorithm):
+    use_keypool = getattr(options, 'keypool', False)
+
+    try:
+        result = native.create_vpn_certs(algorithm, use_keypool)
+    except Exception as e:
+        print('Failed to create the SSL certificates: %s' % e)
+        return False
+
+    if use_keypool:
+        keypool.refill_in_background(algorithm)
+
+    return result
+
+
+def create_easyrsa_certs(options, algorithm):
+    if getattr(options, 'keypool', False):
+        print('EasyRSA generates its own keys, the key pool is not used')
+
+    #
+    # Install EasyRSA, this uses the cached copy when available
+    #
+    timeout = getattr(options, 'download_timeout', None)
+    timeout = DOWNLOAD_TIMEOUT if timeout is None else (timeout, timeout)
+
+    success = easyrsa.install_easyrsa(getattr(options, 'easyrsa_tarball', None),
+                                      timeout)
+
+    if not success:
+        return False
+
+    #
+    # Cleanup
+    #
+    easyrsa.reset_pki()
+
+    #
+    # Create VPN certs
+    #
+    return easyrsa.create_vpn_certs(algorithm)
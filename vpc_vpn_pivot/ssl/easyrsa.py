@@ -1,59 +1,243 @@
 import os
+import json
+import fcntl
 import shutil
-import tarfile
-import requests
 
-from vpc_vpn_pivot.utils.misc import run_cmd
-from vpc_vpn_pivot.constants import CA_PATH
+from vpc_vpn_pivot.utils.misc import run_cmd, sha256_file
+from vpc_vpn_pivot.utils.download import (stream_download,
+                                          extract_stream,
+                                          DownloadError,
+                                          DOWNLOAD_TIMEOUT)
+from vpc_vpn_pivot.ssl.keys import easyrsa_env
+from vpc_vpn_pivot.constants import (CA_PATH,
+                                     DEFAULT_KEY_ALGORITHM,
+                                     CACHE_PATH,
+                                     CACHE_LOCK_FILE,
+                                     EASYRSA_VERSION,
+                                     EASYRSA_RELEASE,
+                                     EASYRSA_PATH,
+                                     EASYRSA_SHA256,
+                                     EASYRSA_CACHE_INDEX)
 
-EASYRSA_RELEASE = 'https://github.com/OpenVPN/easy-rsa/releases/download/v3.0.6/EasyRSA-unix-v3.0.6.tgz'
-EASYRSA_PATH = '/tmp/EasyRSA-v3.0.6/'
-EASYRSA_COMPRESSED = '/tmp/EasyRSA-unix-v3.0.6.tgz'
+#
+# Written inside EASYRSA_PATH, contains the SHA-256 of the extracted tarball
+#
+EXTRACTED_MARKER = '.sha256'
 
+_cache_stats = {'hits': 0,
+                'misses': 0}
 
-def remove_previous_install():
-    paths_to_remove = (
-        EASYRSA_PATH,
-        EASYRSA_COMPRESSED
-    )
 
-    for path_to_remove in paths_to_remove:
-        try:
-            shutil.rmtree(path_to_remove)
-        except:
-            continue
+def reset_pki():
+    """
+    Remove the PKI created by a previous run, the EasyRSA install is kept
+    """
+    shutil.rmtree(CA_PATH, ignore_errors=True)
+
+
+def install_easyrsa(seed_filename=None, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Make sure the EasyRSA release is extracted at EASYRSA_PATH. The release
+    tarball is downloaded only when it is not in the cache.
 
+    :param seed_filename: Optional path to a local copy of the EasyRSA
+                          release tarball, used to seed the cache without
+                          network access
+    :param timeout: (connect, read) timeout in seconds for the download
+    :return: True if EasyRSA is ready to be used
+    """
+    os.makedirs(CACHE_PATH, exist_ok=True)
 
-def install_easyrsa():
     #
-    # Download and decompress
+    # The cache is shared by the workers of `create --regions`, only one of
+    # them downloads and extracts the release
     #
+    with open(CACHE_LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        try:
+            return _install_easyrsa(seed_filename, timeout)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _install_easyrsa(seed_filename, timeout):
+    if seed_filename is not None:
+        return seed_cache(seed_filename)
+
+    expected_sha256 = get_expected_sha256()
+
+    if expected_sha256 is not None and is_cached(expected_sha256):
+        _cache_stats['hits'] += 1
+        print('EasyRSA %s cache hit (sha256 %s)' % (EASYRSA_VERSION, expected_sha256[:12]))
+
+        if not is_extracted(expected_sha256):
+            return extract(expected_sha256)
+
+        return True
+
+    _cache_stats['misses'] += 1
+    print('EasyRSA %s cache miss, downloading %s' % (EASYRSA_VERSION, EASYRSA_RELEASE))
+
+    return download(expected_sha256, timeout)
+
+
+def seed_cache(seed_filename):
+    """
+    Copy a local EasyRSA release tarball to the cache
+
+    :param seed_filename: Path to the EasyRSA release tarball
+    :return: True if the cache was seeded and the release extracted
+    """
     try:
-        r = requests.get(EASYRSA_RELEASE)
-    except Exception as e:
+        sha256 = sha256_file(seed_filename)
+    except OSError as e:
+        print('Failed to read EasyRSA release %s: %s' % (seed_filename, e))
+        return False
+
+    if EASYRSA_SHA256 is not None and sha256 != EASYRSA_SHA256:
+        args = (seed_filename, sha256, EASYRSA_VERSION, EASYRSA_SHA256)
+        print('%s has SHA-256 %s but EasyRSA %s is pinned to %s' % args)
+        return False
+
+    shutil.copyfile(seed_filename, cached_tarball(sha256))
+    save_sha256(sha256)
+
+    print('Seeded EasyRSA %s cache from %s' % (EASYRSA_VERSION, seed_filename))
+
+    return extract(sha256)
+
+
+def download(expected_sha256, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Download the EasyRSA release to the cache, extracting it while the data
+    arrives. Interrupted downloads are resumed on the next run.
+
+    :param expected_sha256: The expected SHA-256 of the release, or None if
+                            the release was never downloaded before
+    :param timeout: (connect, read) timeout in seconds
+    :return: True if the release was downloaded, verified and extracted
+    """
+    download_filename = os.path.join(CACHE_PATH, os.path.basename(EASYRSA_RELEASE))
+
+    shutil.rmtree(EASYRSA_PATH, ignore_errors=True)
+
+    try:
+        stats = stream_download(EASYRSA_RELEASE,
+                                download_filename,
+                                extract_to=CACHE_PATH,
+                                expected_sha256=expected_sha256,
+                                timeout=timeout)
+    except DownloadError as e:
+        shutil.rmtree(EASYRSA_PATH, ignore_errors=True)
         print('Failed to download EasyRSA: %s' % e)
         return False
 
-    with open(EASYRSA_COMPRESSED, 'wb') as f:
-        f.write(r.content)
+    print('Downloaded EasyRSA: %s' % stats)
 
-    tf = tarfile.open(EASYRSA_COMPRESSED)
-    tf.extractall(path='/tmp/')
+    os.replace(download_filename, cached_tarball(stats.sha256))
+    save_sha256(stats.sha256)
+    write_marker(stats.sha256)
 
     return True
 
 
+def extract(sha256):
+    """
+    Extract the cached release tarball to EASYRSA_PATH
+
+    :param sha256: The SHA-256 of the release, identifies the tarball
+    :return: True if the release was extracted
+    """
+    shutil.rmtree(EASYRSA_PATH, ignore_errors=True)
+
+    try:
+        with open(cached_tarball(sha256), 'rb') as f:
+            extract_stream(f, CACHE_PATH)
+    except Exception as e:
+        print('Failed to extract EasyRSA: %s' % e)
+        return False
+
+    write_marker(sha256)
+
+    return True
+
+
+def write_marker(sha256):
+    with open(os.path.join(EASYRSA_PATH, EXTRACTED_MARKER), 'w') as f:
+        f.write(sha256)
+
+
+def cached_tarball(sha256):
+    filename = 'EasyRSA-unix-v%s-%s.tgz' % (EASYRSA_VERSION, sha256)
+    return os.path.join(CACHE_PATH, filename)
+
+
+def is_cached(sha256):
+    """
+    :return: True if the cached tarball exists and matches the SHA-256
+    """
+    filename = cached_tarball(sha256)
+
+    if not os.path.exists(filename):
+        return False
+
+    return sha256_file(filename) == sha256
+
+
+def is_extracted(sha256):
+    try:
+        with open(os.path.join(EASYRSA_PATH, EXTRACTED_MARKER)) as f:
+            return f.read().strip() == sha256
+    except OSError:
+        return False
+
+
+def load_index():
+    try:
+        with open(EASYRSA_CACHE_INDEX) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def get_expected_sha256():
+    """
+    :return: The pinned SHA-256, or the one recorded in the cache index
+    """
+    if EASYRSA_SHA256 is not None:
+        return EASYRSA_SHA256
+
+    return load_index().get(EASYRSA_VERSION)
+
+
+def save_sha256(sha256):
+    index = load_index()
+    index[EASYRSA_VERSION] = sha256
+
+    with open(EASYRSA_CACHE_INDEX, 'w') as f:
+        f.write(json.dumps(index, indent=4, sort_keys=True))
+
+
+def cache_stats():
+    """
+    :return: A dict with the number of cache hits and misses
+    """
+    return dict(_cache_stats)
+
+
 def cert_path(filename):
     return os.path.join(CA_PATH, filename)
 
 
-def create_vpn_certs():
+def create_vpn_certs(algorithm=DEFAULT_KEY_ALGORITHM):
     """
     Create all SSL certs required for the VPN connection and return the fs
     paths.
 
     https://github.com/aws-quickstart/quickstart-biotech-blueprint/blob/f2e1e76dc8cbc30fd938dd78f0ea5c029c03a9d4/scripts/clientvpnendpoint-customlambdaresource.py#L63-L72
 
+    :param algorithm: The key algorithm, one of KEY_ALGORITHMS
     :return: A tuple containing paths to:
                 * ca.crt
                 * server.crt
@@ -70,6 +254,8 @@ def create_vpn_certs():
 
     env = os.environ.copy()
     env['EASYRSA_BATCH'] = '1'
+    env['EASYRSA_PKI'] = CA_PATH
+    env.update(easyrsa_env(algorithm))
 
     for cmd in create_certs_commands:
         return_code, stdout, stderr = run_cmd(cmd, cwd=EASYRSA_PATH, env=env)
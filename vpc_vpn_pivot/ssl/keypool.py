@@ -0,0 +1,175 @@
+import os
+import sys
+import fcntl
+
+from vpc_vpn_pivot.constants import (KEYPOOL_PATH,
+                                     KEYPOOL_SIZE,
+                                     KEY_ALGORITHMS)
+from vpc_vpn_pivot.ssl.keys import generate_key, serialize_key, load_key
+from vpc_vpn_pivot.utils.misc import spawn_detached
+
+KEY_SUFFIX = '.pem'
+
+#
+# The size chosen with `keypool --size` is saved in the pool directory of
+# each algorithm and used by the background refills. The refills hold a
+# lock on LOCK_FILE so concurrent creates don't overfill the pool.
+#
+SIZE_FILE = 'size'
+LOCK_FILE = os.path.join(KEYPOOL_PATH, '.lock')
+
+
+def keypool(options):
+    """
+    Fill the pool of pre-generated private keys used by `create --keypool`
+
+    :param options: Options passed as command line arguments by the user
+    :return: Return code
+    """
+    try:
+        save_size(options.key_algorithm, options.size)
+        added = fill(options.key_algorithm, options.size)
+    except Exception as e:
+        print('Failed to fill the key pool: %s' % e)
+        return 1
+
+    args = (added, options.key_algorithm, count(options.key_algorithm), pool_path(options.key_algorithm))
+    print('Generated %s %s keys, the pool has %s keys at %s' % args)
+    return 0
+
+
+def pool_path(algorithm):
+    return os.path.join(KEYPOOL_PATH, algorithm)
+
+
+def save_size(algorithm, size):
+    path = pool_path(algorithm)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    with open(os.path.join(path, SIZE_FILE), 'w') as f:
+        f.write('%s\n' % size)
+
+
+def configured_size(algorithm):
+    """
+    :return: The size chosen with `keypool --size`, KEYPOOL_SIZE if it was
+             never set
+    """
+    try:
+        with open(os.path.join(pool_path(algorithm), SIZE_FILE)) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return KEYPOOL_SIZE
+
+
+def count(algorithm):
+    try:
+        filenames = os.listdir(pool_path(algorithm))
+    except FileNotFoundError:
+        return 0
+
+    return len([f for f in filenames if f.endswith(KEY_SUFFIX)])
+
+
+def fill(algorithm, size=None):
+    """
+    Generate keys until the pool for `algorithm` has `size` keys
+
+    :param size: The number of keys, the configured size when None
+    :return: The number of generated keys
+    """
+    if algorithm not in KEY_ALGORITHMS:
+        raise ValueError('Unsupported key algorithm: %s' % algorithm)
+
+    if size is None:
+        size = configured_size(algorithm)
+
+    path = pool_path(algorithm)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    with open(LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        try:
+            return _fill(algorithm, path, size)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _fill(algorithm, path, size):
+    added = 0
+
+    while count(algorithm) < size:
+        data = serialize_key(generate_key(algorithm))
+
+        #
+        # Write to a hidden temp file and rename, so take_key() never reads
+        # a partially written key
+        #
+        name = '%s-%s' % (os.getpid(), os.urandom(8).hex())
+        temp_filename = os.path.join(path, '.%s.tmp' % name)
+
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        os.rename(temp_filename, os.path.join(path, name + KEY_SUFFIX))
+        added += 1
+
+    return added
+
+
+def take_key(algorithm):
+    """
+    Remove one key from the pool
+
+    :param algorithm: One of KEY_ALGORITHMS
+    :return: A cryptography private key, or None if the pool is empty
+    """
+    path = pool_path(algorithm)
+
+    try:
+        filenames = sorted(os.listdir(path))
+    except FileNotFoundError:
+        return None
+
+    for filename in filenames:
+        if not filename.endswith(KEY_SUFFIX):
+            continue
+
+        #
+        # Claim the key with an atomic rename, other processes taking keys
+        # from the pool at the same time will get a different one
+        #
+        claimed = os.path.join(path, '.claimed-%s-%s' % (os.getpid(), filename))
+
+        try:
+            os.rename(os.path.join(path, filename), claimed)
+        except FileNotFoundError:
+            continue
+
+        try:
+            with open(claimed, 'rb') as f:
+                return load_key(f.read())
+        except Exception:
+            continue
+        finally:
+            os.remove(claimed)
+
+    return None
+
+
+def refill_in_background(algorithm):
+    """
+    Start a detached process which refills the pool up to the configured
+    size, the current process doesn't wait for it. The count is checked
+    again by fill() while holding the lock.
+    """
+    if count(algorithm) >= configured_size(algorithm):
+        return
+
+    spawn_detached('vpc_vpn_pivot.ssl.keypool', [algorithm])
+
+
+if __name__ == '__main__':
+    fill(sys.argv[1])
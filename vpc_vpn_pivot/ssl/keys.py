@@ -0,0 +1,63 @@
+from vpc_vpn_pivot.constants import DEFAULT_KEY_ALGORITHM
+
+RSA_KEY_SIZES = {'rsa2048': 2048,
+                 'rsa3072': 3072,
+                 'rsa4096': 4096}
+
+EC_CURVES = {'ec256': 'secp256r1',
+             'ec384': 'secp384r1'}
+
+
+def generate_key(algorithm=DEFAULT_KEY_ALGORITHM):
+    """
+    :param algorithm: One of KEY_ALGORITHMS
+    :return: A new cryptography private key
+    """
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
+    if algorithm in RSA_KEY_SIZES:
+        return rsa.generate_private_key(public_exponent=65537,
+                                        key_size=RSA_KEY_SIZES[algorithm])
+
+    if algorithm in EC_CURVES:
+        curve = getattr(ec, EC_CURVES[algorithm].upper())
+        return ec.generate_private_key(curve())
+
+    raise ValueError('Unsupported key algorithm: %s' % algorithm)
+
+
+def is_rsa(algorithm):
+    return algorithm in RSA_KEY_SIZES
+
+
+def easyrsa_env(algorithm):
+    """
+    :param algorithm: One of KEY_ALGORITHMS
+    :return: The EasyRSA environment variables to generate keys of this type
+    """
+    if algorithm in RSA_KEY_SIZES:
+        return {'EASYRSA_ALGO': 'rsa',
+                'EASYRSA_KEY_SIZE': str(RSA_KEY_SIZES[algorithm])}
+
+    if algorithm in EC_CURVES:
+        return {'EASYRSA_ALGO': 'ec',
+                'EASYRSA_CURVE': EC_CURVES[algorithm]}
+
+    raise ValueError('Unsupported key algorithm: %s' % algorithm)
+
+
+def serialize_key(key):
+    """
+    :return: The private key in unencrypted PKCS#8 PEM format
+    """
+    from cryptography.hazmat.primitives import serialization
+
+    return key.private_bytes(encoding=serialization.Encoding.PEM,
+                             format=serialization.PrivateFormat.PKCS8,
+                             encryption_algorithm=serialization.NoEncryption())
+
+
+def load_key(data):
+    from cryptography.hazmat.primitives import serialization
+
+    return serialization.load_pem_private_key(data, password=None)
@@ -0,0 +1,206 @@
+import os
+import shutil
+import datetime
+
+from vpc_vpn_pivot.constants import PKI_PATH, DEFAULT_KEY_ALGORITHM
+from vpc_vpn_pivot.ssl.keys import generate_key, serialize_key, is_rsa
+from vpc_vpn_pivot.ssl.keypool import take_key
+
+CA_COMMON_NAME = 'vpc-vpn-pivot CA'
+SERVER_COMMON_NAME = 'server'
+CLIENT_COMMON_NAME = 'client.domain.tld'
+
+#
+# Same defaults as EasyRSA 3.0.6
+#
+CA_EXPIRE_DAYS = 3650
+CERT_EXPIRE_DAYS = 1080
+
+
+def is_available():
+    """
+    :return: True if the cryptography library is installed
+    """
+    try:
+        import cryptography
+    except ImportError:
+        return False
+
+    return True
+
+
+def cert_path(filename):
+    return os.path.join(PKI_PATH, filename)
+
+
+def remove_previous_pki():
+    shutil.rmtree(PKI_PATH, ignore_errors=True)
+
+
+def create_vpn_certs(algorithm=DEFAULT_KEY_ALGORITHM, use_keypool=False):
+    """
+    Create all SSL certs required for the VPN connection in-process, without
+    calling EasyRSA or openssl, and return the fs paths.
+
+    The layout of the PKI directory and the certificate extensions are the
+    same as the ones generated by EasyRSA.
+
+    :param algorithm: The key algorithm, one of KEY_ALGORITHMS
+    :param use_keypool: Take the private keys from the key pool, keys are
+                        generated only when the pool is empty
+
+    :return: A tuple containing paths to:
+                * ca.crt
+                * server.crt
+                * server.key
+                * client.crt
+                * client.key
+    """
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+    from cryptography.hazmat.primitives import hashes
+
+    remove_previous_pki()
+
+    os.makedirs(cert_path('issued'), exist_ok=True)
+    os.makedirs(cert_path('private'), mode=0o700, exist_ok=True)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    pool_stats = {'hits': 0, 'misses': 0}
+
+    def new_key():
+        key = take_key(algorithm) if use_keypool else None
+
+        if key is not None:
+            pool_stats['hits'] += 1
+            return key
+
+        pool_stats['misses'] += 1
+        return generate_key(algorithm)
+
+    #
+    # Certificate authority
+    #
+    ca_key = new_key()
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, CA_COMMON_NAME)])
+    ca_ski = x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key())
+
+    ca_crt = x509.CertificateBuilder(
+    ).subject_name(
+        ca_name
+    ).issuer_name(
+        ca_name
+    ).public_key(
+        ca_key.public_key()
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now
+    ).not_valid_after(
+        now + datetime.timedelta(days=CA_EXPIRE_DAYS)
+    ).add_extension(
+        x509.BasicConstraints(ca=True, path_length=None), critical=True
+    ).add_extension(
+        key_usage(key_cert_sign=True, crl_sign=True), critical=True
+    ).add_extension(
+        ca_ski, critical=False
+    ).sign(ca_key, hashes.SHA256())
+
+    #
+    # Server and client certificates signed by the CA
+    #
+    def issue(common_name, extended_key_usage, **usages):
+        key = new_key()
+
+        builder = x509.CertificateBuilder(
+        ).subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+        ).issuer_name(
+            ca_name
+        ).public_key(
+            key.public_key()
+        ).serial_number(
+            x509.random_serial_number()
+        ).not_valid_before(
+            now
+        ).not_valid_after(
+            now + datetime.timedelta(days=CERT_EXPIRE_DAYS)
+        ).add_extension(
+            x509.BasicConstraints(ca=False, path_length=None), critical=False
+        ).add_extension(
+            key_usage(**usages), critical=False
+        ).add_extension(
+            x509.ExtendedKeyUsage([extended_key_usage]), critical=False
+        ).add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False
+        ).add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ca_ski),
+            critical=False
+        )
+
+        if extended_key_usage == ExtendedKeyUsageOID.SERVER_AUTH:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName([x509.DNSName(common_name)]),
+                critical=False
+            )
+
+        return key, builder.sign(ca_key, hashes.SHA256())
+
+    server_key, server_crt = issue(SERVER_COMMON_NAME,
+                                   ExtendedKeyUsageOID.SERVER_AUTH,
+                                   digital_signature=True,
+                                   key_encipherment=is_rsa(algorithm))
+
+    client_key, client_crt = issue(CLIENT_COMMON_NAME,
+                                   ExtendedKeyUsageOID.CLIENT_AUTH,
+                                   digital_signature=True)
+
+    certs = (cert_path('ca.crt'),
+             cert_path('issued/%s.crt' % SERVER_COMMON_NAME),
+             cert_path('private/%s.key' % SERVER_COMMON_NAME),
+             cert_path('issued/%s.crt' % CLIENT_COMMON_NAME),
+             cert_path('private/%s.key' % CLIENT_COMMON_NAME))
+
+    if use_keypool:
+        args = (pool_stats['hits'], pool_stats['misses'])
+        print('Took %s keys from the key pool, generated %s keys' % args)
+
+    write_key(cert_path('private/ca.key'), ca_key)
+    write_crt(certs[0], ca_crt)
+    write_crt(certs[1], server_crt)
+    write_key(certs[2], server_key)
+    write_crt(certs[3], client_crt)
+    write_key(certs[4], client_key)
+
+    return certs
+
+
+def key_usage(digital_signature=False, key_encipherment=False,
+              key_cert_sign=False, crl_sign=False):
+    from cryptography import x509
+
+    return x509.KeyUsage(digital_signature=digital_signature,
+                         content_commitment=False,
+                         key_encipherment=key_encipherment,
+                         data_encipherment=False,
+                         key_agreement=False,
+                         key_cert_sign=key_cert_sign,
+                         crl_sign=crl_sign,
+                         encipher_only=False,
+                         decipher_only=False)
+
+
+def write_crt(filename, crt):
+    from cryptography.hazmat.primitives import serialization
+
+    with open(filename, 'wb') as f:
+        f.write(crt.public_bytes(serialization.Encoding.PEM))
+
+
+def write_key(filename, key):
+    data = serialize_key(key)
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
@@ -1,37 +1,250 @@
 import os
 import json
+import fcntl
+import tempfile
+import threading
+
+from contextlib import contextmanager
 
 from vpc_vpn_pivot.constants import STATE_PATH, STATE_FILE
 
+STATE_LOCK_FILE = STATE_FILE + '.lock'
+
+PERMISSION_ERROR = ('Permission denied accessing %s, it was probably written by'
+                    ' a command run with sudo. Fix the owner with:\n'
+                    '\n'
+                    '    sudo chown -R $USER %s')
+
+
+class StateError(Exception):
+    pass
+
 
 class State(object):
+    """
+    Key / value store persisted to STATE_FILE.
+
+    The state file is loaded only once per process and all reads are served
+    from memory. Every instance shares the same data, so it is still safe to
+    call State() wherever the state is needed.
+
+    Mutations are written to disk immediately unless they happen inside a
+    `with state.transaction():` block, in which case a single write is
+    performed when the outermost block exits.
+
+    Other processes (the supervisor, the metrics exporter, background
+    creates) write to the same file. Each write takes a lock on the state
+    file, reads it again and only applies the keys changed by this process,
+    so the keys written by the others are kept.
+    """
+    _lock = threading.RLock()
+    _data = None
+    _transaction_depth = 0
+    _dirty = False
+
+    #
+    # Keys set and removed by this process since the last write. force()
+    # replaces the whole file instead.
+    #
+    _changed = set()
+    _removed = set()
+    _replace = False
+
+    _stats = {'reads': 0,
+              'writes': 0,
+              'bytes_written': 0}
+
     def __init__(self):
         os.makedirs(STATE_PATH, exist_ok=True)
 
     def get(self, key):
-        try:
-            state = json.loads(open(STATE_FILE).read())
-        except FileNotFoundError:
-            return None
-        else:
-            return state.get(key, None)
+        with self._lock:
+            return self._load().get(key, None)
 
     def append(self, key, value):
-        state = self.dump()
-        state[key] = value
-        self.force(state)
+        with self._lock:
+            self._load()[key] = value
+            State._changed.add(key)
+            State._removed.discard(key)
+            self._mark_dirty()
 
     def remove(self, key):
-        state = self.dump()
-        state.pop(key)
-        self.force(state)
+        with self._lock:
+            self._load().pop(key)
+            State._removed.add(key)
+            State._changed.discard(key)
+            self._mark_dirty()
 
     def dump(self):
+        with self._lock:
+            return dict(self._load())
+
+    def force(self, state):
+        with self._lock:
+            State._data = dict(state)
+            State._replace = True
+            State._changed.clear()
+            State._removed.clear()
+            self._mark_dirty()
+
+    def reload(self):
+        """
+        Discard the in-memory copy and read the state file again. Useful for
+        long running processes which need to see changes made by others.
+        """
+        with self._lock:
+            State._data = None
+            self._reset_changes()
+            return self.dump()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several mutations into one write to the state file.
+        Transactions can be nested, only the outermost one flushes.
+
+        The mutations are written even when the block raises an exception:
+        they usually record AWS resources which were already created, and
+        `purge` needs them to remove those resources.
+        """
+        with self._lock:
+            State._transaction_depth += 1
+
         try:
-            return json.loads(open(STATE_FILE).read())
+            yield self
+        finally:
+            with self._lock:
+                State._transaction_depth -= 1
+
+                if State._transaction_depth == 0 and State._dirty:
+                    self._flush()
+
+    @classmethod
+    def stats(cls):
+        """
+        :return: A dict with the number of reads, writes and bytes written
+                 to the state file by this process
+        """
+        with cls._lock:
+            return dict(cls._stats)
+
+    def _load(self):
+        if State._data is None:
+            State._data = self._read()
+
+        return State._data
+
+    def _read(self):
+        try:
+            with open(STATE_FILE) as f:
+                data = json.loads(f.read())
         except FileNotFoundError:
-            return {}
+            data = {}
+        except PermissionError:
+            raise StateError(PERMISSION_ERROR % (STATE_FILE, STATE_PATH))
 
-    def force(self, state):
-        state = json.dumps(state, indent=4, sort_keys=True)
-        open(STATE_FILE, 'w').write(state)
+        State._stats['reads'] += 1
+        return data
+
+    def _reset_changes(self):
+        State._dirty = False
+        State._replace = False
+        State._changed.clear()
+        State._removed.clear()
+
+    def _mark_dirty(self):
+        State._dirty = True
+
+        if State._transaction_depth == 0:
+            self._flush()
+
+    def _flush(self):
+        """
+        Atomically write the state to disk: the state file is read again
+        while holding the lock, the changes made by this process are applied,
+        and the result is written to a temp file in the same directory,
+        fsync'ed and then renamed over the previous state file.
+        """
+        #
+        # Read only, the lock file might have been created by root
+        #
+        try:
+            lock = os.open(STATE_LOCK_FILE, os.O_RDONLY | os.O_CREAT, 0o644)
+        except PermissionError:
+            raise StateError(PERMISSION_ERROR % (STATE_LOCK_FILE, STATE_PATH))
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._write(self._merge())
+        finally:
+            os.close(lock)
+
+    def _merge(self):
+        """
+        :return: The state file contents with the changes of this process
+        """
+        if State._replace:
+            return dict(State._data)
+
+        merged = self._read()
+
+        for key in State._changed:
+            merged[key] = State._data[key]
+
+        for key in State._removed:
+            merged.pop(key, None)
+
+        return merged
+
+    def _write(self, state):
+        data = json.dumps(state, indent=4, sort_keys=True).encode('utf-8')
+
+        try:
+            fd, temp_filename = tempfile.mkstemp(dir=STATE_PATH,
+                                                 prefix='.state-',
+                                                 suffix='.tmp')
+        except PermissionError:
+            raise StateError(PERMISSION_ERROR % (STATE_PATH, STATE_PATH))
+
+        try:
+            copy_owner(STATE_FILE, fd)
+
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp_filename, STATE_FILE)
+        except Exception:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+            raise
+
+        State._data = state
+        self._reset_changes()
+
+        State._stats['writes'] += 1
+        State._stats['bytes_written'] += len(data)
+
+
+def copy_owner(filename, fd):
+    """
+    Give the file open as `fd` the mode and owner of `filename`, the state
+    file keeps them when it is replaced by `sudo ./vpc-vpn-pivot connect`
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return
+
+    os.fchmod(fd, stat.st_mode & 0o7777)
+
+    try:
+        os.fchown(fd, stat.st_uid, stat.st_gid)
+    except PermissionError:
+        #
+        # Only root can give the file to another user
+        #
+        pass
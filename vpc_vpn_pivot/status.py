@@ -1,21 +1,48 @@
-import psutil
+import os
+import time
 
 from vpc_vpn_pivot.state import State
-from vpc_vpn_pivot.connect import OPENVPN_LOG_FILE
+from vpc_vpn_pivot.constants import (OPENVPN_LOG_FILE,
+                                     CREATE_LOG_FILE,
+                                     CREATE_STEP_ETA)
+from vpc_vpn_pivot.utils.misc import pid_is_alive
+from vpc_vpn_pivot.utils.tail import tail, follow
 
+FOLLOW_CONTEXT_LINES = 10
+FOLLOW_POLL_INTERVAL = 0.5
 
-def status(options):
 
+def status(options):
     state = State()
 
+    progress = state.get('create_progress')
+    if progress is not None and progress.get('finished') is None:
+        return create_status(progress)
+
+    import psutil
+
     openvpn_pid = state.get('openvpn_pid')
+
+    if openvpn_pid is None and progress is not None and progress.get('exit_code'):
+        return failed_create_status(progress)
+
     if openvpn_pid is None:
         print('The VPN connection was never initiated. Call the `connect` sub-command')
         return 1
 
+    supervisor_pid = state.get('supervisor_pid')
+    supervised = pid_is_alive(supervisor_pid)
+
+    if supervised:
+        supervisor_status(state, supervisor_pid)
+
     try:
         p = psutil.Process(openvpn_pid)
     except psutil.NoSuchProcess:
+        if supervised:
+            print('The OpenVPN process died, the supervisor is restarting it')
+            return 1
+
         print('The OpenVPN process died! Check the %s log file' % OPENVPN_LOG_FILE)
         return 1
 
@@ -24,4 +51,144 @@ def status(options):
         return 1
 
     print('The VPN connection is alive')
+
+    if getattr(options, 'follow', False):
+        return follow_openvpn_log(supervisor_pid if supervised else openvpn_pid)
+
+    from vpc_vpn_pivot import watch
+
+    if getattr(options, 'watch', False):
+        return watch.watch(openvpn_pid)
+
+    watch.print_summary()
+    return 0
+
+
+def supervisor_status(state, supervisor_pid):
+    """
+    Show the outages recovered by the supervisor
+
+    :param state: The State instance
+    :param supervisor_pid: The PID of the supervisor process
+    """
+    outages = state.get('outages') or []
+
+    print('The VPN connection is supervised by process %s' % supervisor_pid)
+
+    if not outages:
+        print('No outages so far')
+        print('')
+        return
+
+    downtime = sum(o['duration'] for o in outages)
+    print('%s outage(s) recovered, %.1f seconds of downtime in total' % (len(outages), downtime))
+
+    last = outages[-1]
+    args = (time.time() - last['end'], last['duration'], last['reason'])
+    print('Last outage ended %.0f seconds ago, lasted %.1f seconds (%s)' % args)
+    print('')
+
+
+def follow_openvpn_log(openvpn_pid):
+    """
+    Print the last lines of the OpenVPN log and then the new lines as they
+    are written, until the OpenVPN process exits or the user hits Ctrl+C.
+
+    Only the new data is read on each poll, the log is never scanned again.
+
+    :param openvpn_pid: The PID of the OpenVPN client
+    :return: Return code
+    """
+    offset = 0
+
+    if os.path.exists(OPENVPN_LOG_FILE):
+        with open(OPENVPN_LOG_FILE, 'rb') as f:
+            offset = f.seek(0, os.SEEK_END)
+            lines = tail(f, FOLLOW_CONTEXT_LINES)
+
+        print('')
+        for line in lines:
+            print(line.decode('utf-8', errors='replace'), end='')
+
+    def is_done():
+        return not pid_is_alive(openvpn_pid)
+
+    try:
+        for line in follow(OPENVPN_LOG_FILE, is_done, FOLLOW_POLL_INTERVAL, offset):
+            print(line, end='', flush=True)
+    except KeyboardInterrupt:
+        return 0
+
+    print('')
+    print('The OpenVPN process exited')
+    return 1
+
+
+def failed_create_status(progress):
+    """
+    Show the result of a `create` which failed
+
+    :param progress: The create_progress saved to the state by `create`
+    :return: Return code
+    """
+    exit_code = progress.get('exit_code')
+
+    if progress.get('background'):
+        print('The background create failed with exit code %s. Check the %s'
+              ' log file' % (exit_code, CREATE_LOG_FILE))
+    else:
+        print('The last create failed with exit code %s' % exit_code)
+
+    print('Run `purge` to remove the resources it created, then `create` again')
+    return 1
+
+
+def create_status(progress):
+    """
+    Show the progress of a `create` which is still running
+
+    :param progress: The create_progress saved to the state by `create`
+    :return: Return code
+    """
+    now = time.time()
+    pid = progress.get('pid')
+
+    if pid is not None and not pid_is_alive(pid):
+        print('The create process (%s) died before finishing. Check the %s'
+              ' log file' % (pid, CREATE_LOG_FILE))
+        return 1
+
+    steps = progress.get('steps', {})
+
+    print('The VPN is being created (%.0f seconds elapsed)' % (now - progress['started']))
+    print('')
+
+    ordered = sorted(steps.items(), key=lambda x: x[1].get('start') or now)
+
+    for name, step in ordered:
+        if step['status'] == 'running':
+            args = (name, 'running', now - step['start'])
+        else:
+            spent = (step['end'] - step['start']) if step.get('start') else 0
+            args = (name, step['status'], spent)
+
+        print('    %-40s %-10s %7.1fs' % args)
+
+    eta = 0.0
+
+    for name, expected in CREATE_STEP_ETA.items():
+        step = steps.get(name)
+
+        if step is None:
+            eta += expected
+        elif step['status'] == 'running':
+            eta += max(expected - (now - step['start']), 0)
+
+    print('')
+
+    if eta:
+        print('Estimated time left: %.0f seconds' % eta)
+    else:
+        print('Estimated time left: any moment now')
+
     return 0
@@ -0,0 +1,233 @@
+import sys
+
+from vpc_vpn_pivot.clients import get_client, resolve_region, print_stats
+from vpc_vpn_pivot.utils.misc import is_valid_vpc_id
+
+PUBLIC = 'public'
+PRIVATE = 'private'
+ISOLATED = 'isolated'
+
+DEFAULT_ROUTES = ('0.0.0.0/0', '::/0')
+
+ROW_FORMAT = '%-26s %-23s %-15s %-19s %9s  %-23s %-9s %s'
+HEADER = ('SUBNET', 'VPC', 'AZ', 'CIDR', 'FREE IPS', 'ROUTE TABLE', 'TYPE', 'NAME')
+
+
+def list_subnets(options):
+    """
+    List the subnets which can be used as `create --subnet-id`. The rows are
+    printed as soon as each page of results is received.
+
+    :param options: Options passed as command line arguments by the user
+    :return: Return code
+    """
+    if options.profile is None:
+        print('The --profile argument is required')
+        return 1
+
+    if options.vpc_id is not None and not is_valid_vpc_id(options.vpc_id):
+        print('%s does not have a valid VPC ID format' % options.vpc_id)
+        return 1
+
+    try:
+        filters = build_filters(vpc_id=options.vpc_id,
+                                availability_zone=options.az,
+                                cidr_block=options.cidr,
+                                tags=options.tag)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    try:
+        region = resolve_region(options.profile, options.region)
+    except Exception:
+        print('%s is not a valid profile defined in ~/.aws/credentials' % options.profile)
+        return 1
+
+    ec2_client = get_client('ec2', options.profile, region)
+
+    try:
+        count = print_subnets(ec2_client, filters, options.page_size)
+    except Exception as e:
+        print('Failed to list the subnets in %s: %s' % (region, e))
+        return 1
+
+    print('')
+    print('%s subnet(s) found in %s' % (count, region))
+    print_stats()
+
+    return 0
+
+
+def build_filters(vpc_id=None, availability_zone=None, cidr_block=None, tags=None):
+    """
+    Build the server side filters for describe_subnets()
+
+    :param vpc_id: Only the subnets in this VPC
+    :param availability_zone: Only the subnets in this availability zone
+    :param cidr_block: Only the subnet with this exact CIDR block
+    :param tags: A list of Key=Value or Key strings, the subnets need to
+                 have all of them
+    :return: A list of filters
+    """
+    filters = []
+
+    if vpc_id is not None:
+        filters.append({'Name': 'vpc-id', 'Values': [vpc_id]})
+
+    if availability_zone is not None:
+        filters.append({'Name': 'availability-zone', 'Values': [availability_zone]})
+
+    if cidr_block is not None:
+        filters.append({'Name': 'cidr-block', 'Values': [cidr_block]})
+
+    for tag in tags or []:
+        key, separator, value = tag.partition('=')
+
+        if not key:
+            raise ValueError('%s is not a valid tag filter, use Key=Value or Key' % tag)
+
+        if separator:
+            filters.append({'Name': 'tag:%s' % key, 'Values': [value]})
+        else:
+            filters.append({'Name': 'tag-key', 'Values': [key]})
+
+    return filters
+
+
+def iter_subnets(ec2_client, filters=None, page_size=None):
+    """
+    Yield the subnets as the pages of describe_subnets() are received
+
+    :param ec2_client: The EC2 client
+    :param filters: The server side filters, see build_filters()
+    :param page_size: Number of subnets requested in each page
+    """
+    paginator = ec2_client.get_paginator('describe_subnets')
+
+    pagination_config = {}
+    if page_size is not None:
+        pagination_config['PageSize'] = page_size
+
+    pages = paginator.paginate(Filters=filters or [],
+                               PaginationConfig=pagination_config)
+
+    for page in pages:
+        for subnet in page['Subnets']:
+            yield subnet
+
+
+def print_subnets(ec2_client, filters=None, page_size=None, output=sys.stdout, subnets=None):
+    """
+    Print one row per subnet, with the route table and whether the subnet is
+    public, private (default route through a NAT) or isolated
+
+    :param ec2_client: The EC2 client
+    :param filters: The server side filters, see build_filters()
+    :param page_size: Number of subnets requested in each page
+    :param output: The file where the rows are written
+    :param subnets: Print these subnets instead of calling describe_subnets(),
+                    eg. the ones in the inventory
+    :return: The number of subnets
+    """
+    route_tables = RouteTableIndex(ec2_client)
+    count = 0
+
+    if subnets is None:
+        subnets = iter_subnets(ec2_client, filters, page_size)
+
+    output.write((ROW_FORMAT % HEADER).rstrip() + '\n')
+
+    for subnet in subnets:
+        route_table = route_tables.for_subnet(subnet['SubnetId'], subnet['VpcId'])
+
+        route_table_id = '-'
+        if route_table is not None:
+            route_table_id = route_table['RouteTableId']
+
+        row = (subnet['SubnetId'],
+               subnet['VpcId'],
+               subnet['AvailabilityZone'],
+               subnet['CidrBlock'],
+               subnet['AvailableIpAddressCount'],
+               route_table_id,
+               classify(route_table),
+               tag_value(subnet, 'Name') or '')
+
+        output.write((ROW_FORMAT % row).rstrip() + '\n')
+        output.flush()
+
+        count += 1
+
+    return count
+
+
+class RouteTableIndex(object):
+    """
+    Find the route table used by each subnet. The route tables are described
+    once per VPC, the first time a subnet of that VPC is seen.
+    """
+    def __init__(self, ec2_client):
+        self.ec2_client = ec2_client
+        self.by_subnet = {}
+        self.main_by_vpc = {}
+        self.loaded_vpcs = set()
+
+    def for_subnet(self, subnet_id, vpc_id):
+        """
+        :return: The route table explicitly associated with the subnet, or
+                 the main route table of the VPC. None if there is none.
+        """
+        if vpc_id not in self.loaded_vpcs:
+            self.load(vpc_id)
+
+        return self.by_subnet.get(subnet_id, self.main_by_vpc.get(vpc_id))
+
+    def load(self, vpc_id):
+        paginator = self.ec2_client.get_paginator('describe_route_tables')
+        pages = paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+
+        for page in pages:
+            for route_table in page['RouteTables']:
+                for association in route_table.get('Associations', []):
+                    if association.get('Main'):
+                        self.main_by_vpc[vpc_id] = route_table
+
+                    if association.get('SubnetId'):
+                        self.by_subnet[association['SubnetId']] = route_table
+
+        self.loaded_vpcs.add(vpc_id)
+
+
+def classify(route_table):
+    """
+    :param route_table: A route table as returned by describe_route_tables()
+    :return: PUBLIC when the default route goes through an internet gateway,
+             PRIVATE when it goes through a NAT gateway, instance, etc. and
+             ISOLATED when there is no default route
+    """
+    if route_table is None:
+        return ISOLATED
+
+    result = ISOLATED
+
+    for route in route_table.get('Routes', []):
+        destination = route.get('DestinationCidrBlock') or route.get('DestinationIpv6CidrBlock')
+
+        if destination not in DEFAULT_ROUTES or route.get('State') == 'blackhole':
+            continue
+
+        if route.get('GatewayId', '').startswith('igw-'):
+            return PUBLIC
+
+        result = PRIVATE
+
+    return result
+
+
+def tag_value(resource, key):
+    for tag in resource.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+
+    return None
@@ -0,0 +1,414 @@
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+
+from vpc_vpn_pivot.state import State
+from vpc_vpn_pivot.constants import (MANAGEMENT_SOCKET,
+                                     SUPERVISOR_CONFIG_FILE,
+                                     OPENVPN_LOG_FILE,
+                                     OPENVPN_LOG_BACKUPS,
+                                     OPENVPN_LOG_MAX_SIZE,
+                                     MAX_OUTAGES)
+from vpc_vpn_pivot.connect import openvpn_command
+from vpc_vpn_pivot.watch import dns_rtt, find_tun_device
+from vpc_vpn_pivot.utils.poll import Backoff
+from vpc_vpn_pivot.utils.tail import rotate_if_larger
+
+#
+# OpenVPN sends a ping every PING seconds and restarts the connection when
+# nothing was received for PING_RESTART seconds. These override the values
+# in the config so dead tunnels are detected quickly.
+#
+PING = 5
+PING_RESTART = 20
+
+#
+# The tunnel is considered unhealthy after HEALTH_FAILURES consecutive DNS
+# queries through it failed, OpenVPN is then asked to reconnect
+#
+HEALTH_INTERVAL = 5
+HEALTH_FAILURES = 3
+
+#
+# Seconds to wait for OpenVPN to re-establish the tunnel by itself before
+# the process is killed and started again
+#
+RECONNECT_TIMEOUT = 45
+
+MANAGEMENT_CONNECT_TIMEOUT = 10
+POLL_INTERVAL = 0.5
+
+RESTART_BACKOFF_CAP = 30
+
+#
+# Seconds between the checks of the OpenVPN log size
+#
+LOG_ROTATE_INTERVAL = 60
+
+CONNECTED = 'CONNECTED'
+
+
+class Management(object):
+    """
+    Client for the OpenVPN management interface, only used to receive the
+    state changes and to send signals.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._socket = None
+        self._buffer = b''
+        self._history = []
+
+    def connect(self, process, timeout=MANAGEMENT_CONNECT_TIMEOUT):
+        """
+        Connect to the management socket, waiting for OpenVPN to create it
+
+        :return: True if connected
+        """
+        deadline = time.time() + timeout
+
+        while time.time() < deadline and process.poll() is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                time.sleep(0.1)
+                continue
+
+            self._socket = sock
+
+            #
+            # `state on all` also returns the states OpenVPN went through
+            # before the socket was connected, the tunnel might be up already
+            #
+            self.send('state on all')
+            return True
+
+        return False
+
+    def send(self, command):
+        if self._socket is None:
+            return
+
+        try:
+            self._socket.sendall(command.encode('ascii') + b'\n')
+        except OSError:
+            self.close()
+
+    def read_states(self, timeout):
+        """
+        :param timeout: Max seconds to wait for data
+        :return: A list with the state names received, eg. CONNECTED
+        """
+        if self._socket is None:
+            time.sleep(timeout)
+            return []
+
+        self._socket.settimeout(timeout)
+
+        try:
+            data = self._socket.recv(4096)
+        except socket.timeout:
+            return []
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close()
+            return []
+
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+
+        states = []
+
+        for line in lines:
+            line = line.decode('utf-8', errors='replace').strip()
+
+            #
+            # >STATE:1603372800,CONNECTED,SUCCESS,10.2.0.2,3.3.3.3,...
+            #
+            if line.startswith('>STATE:'):
+                fields = line[len('>STATE:'):].split(',')
+
+                if len(fields) > 1:
+                    states.append(fields[1])
+
+                continue
+
+            #
+            # The history returned by `state on all` has the same fields
+            # without the prefix and ends with END. Only the last entry,
+            # the current state, is reported.
+            #
+            if line == 'END':
+                if self._history:
+                    states.append(self._history[-1])
+                    self._history = []
+
+                continue
+
+            fields = line.split(',')
+
+            if len(fields) > 1 and fields[0].isdigit():
+                self._history.append(fields[1])
+
+        return states
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class Supervisor(object):
+    """
+    Own the OpenVPN client process and keep the tunnel up.
+
+    Failures are detected by the process exiting, the management interface
+    reporting that the tunnel is down, and DNS queries through the tunnel
+    failing. OpenVPN is first given the chance to reconnect by itself, if
+    it doesn't manage to do so in RECONNECT_TIMEOUT seconds it is restarted
+    with an exponential backoff.
+
+    Each outage is recorded in the state with its start, end, duration and
+    the reason it started.
+    """
+    def __init__(self, config_filename):
+        self.config_filename = config_filename
+        self.state = State()
+        self.stopped = threading.Event()
+        self.process = None
+        self.management = None
+        self.outage = None
+        self.connected = False
+        self.health_failures = 0
+        self.next_health_check = 0
+        self.reconnect_deadline = 0
+        self.next_log_rotate = 0
+
+        #
+        # The DNS servers pushed to the clients are not routed through the
+        # tunnel, the VPC resolver is. The health checks are disabled when
+        # it is unknown.
+        #
+        self.dns_server = self.state.get('probe_dns_server')
+
+    def run(self):
+        backoff = Backoff(initial=1.0, cap=RESTART_BACKOFF_CAP)
+
+        while not self.stopped.is_set():
+            start = time.time()
+            self.start_openvpn()
+            self.monitor()
+
+            if self.stopped.is_set():
+                break
+
+            self.start_outage('process exited with code %s' % self.process.returncode)
+
+            #
+            # Reset the backoff if the process was running for a while
+            #
+            if time.time() - start > RECONNECT_TIMEOUT:
+                backoff = Backoff(initial=1.0, cap=RESTART_BACKOFF_CAP)
+
+            delay = backoff.next_delay()
+            print('Restarting OpenVPN in %.1f seconds' % delay, flush=True)
+            self.stopped.wait(delay)
+
+        self.stop_openvpn()
+
+    def start_openvpn(self):
+        try:
+            os.remove(MANAGEMENT_SOCKET)
+        except FileNotFoundError:
+            pass
+
+        extra_params = ['--management', MANAGEMENT_SOCKET, 'unix',
+                        '--ping', str(PING),
+                        '--ping-restart', str(PING_RESTART)]
+
+        cmd = openvpn_command(self.config_filename,
+                              append_log=True,
+                              extra_params=extra_params)
+
+        self.process = subprocess.Popen(cmd, close_fds=True)
+        self.connected = False
+        self.health_failures = 0
+        self.reconnect_deadline = time.time() + RECONNECT_TIMEOUT
+
+        #
+        # Other processes write to the state while the supervisor runs,
+        # reload it before each change
+        #
+        self.state.reload()
+        self.state.append('openvpn_pid', self.process.pid)
+        print('OpenVPN client started in process %s' % self.process.pid, flush=True)
+
+        self.management = Management(MANAGEMENT_SOCKET)
+
+        if not self.management.connect(self.process):
+            print('Failed to connect to the OpenVPN management interface', flush=True)
+
+    def monitor(self):
+        """
+        Return when the OpenVPN process exited or was killed
+        """
+        while not self.stopped.is_set() and self.process.poll() is None:
+            for state in self.management.read_states(POLL_INTERVAL):
+                self.state_changed(state)
+
+            if self.connected and time.time() >= self.next_health_check:
+                self.health_check()
+
+            if time.time() >= self.next_log_rotate:
+                self.rotate_log()
+
+            if self.outage is not None and time.time() > self.reconnect_deadline:
+                print('OpenVPN did not reconnect in %s seconds, killing it' % RECONNECT_TIMEOUT,
+                      flush=True)
+                self.process.kill()
+                self.process.wait()
+
+        self.management.close()
+
+    def state_changed(self, state):
+        print('OpenVPN state changed to %s' % state, flush=True)
+
+        if state == CONNECTED:
+            self.connected = True
+            self.health_failures = 0
+            self.next_health_check = time.time() + HEALTH_INTERVAL
+
+            device = find_tun_device()
+            if device is not None:
+                self.state.reload()
+                self.state.append('tun_device', device)
+
+            self.end_outage()
+            return
+
+        if self.connected:
+            self.connected = False
+            self.start_outage('OpenVPN state changed to %s' % state)
+
+    def rotate_log(self):
+        """
+        OpenVPN keeps the log open in append mode, so it is copied and
+        truncated instead of renamed
+        """
+        self.next_log_rotate = time.time() + LOG_ROTATE_INTERVAL
+
+        try:
+            rotated = rotate_if_larger(OPENVPN_LOG_FILE, OPENVPN_LOG_MAX_SIZE, OPENVPN_LOG_BACKUPS)
+        except OSError as e:
+            print('Failed to rotate %s: %s' % (OPENVPN_LOG_FILE, e), flush=True)
+            return
+
+        if rotated:
+            print('Rotated %s' % OPENVPN_LOG_FILE, flush=True)
+
+    def health_check(self):
+        self.next_health_check = time.time() + HEALTH_INTERVAL
+
+        if self.dns_server is None:
+            return
+
+        if dns_rtt(self.dns_server) is not None:
+            self.health_failures = 0
+            return
+
+        self.health_failures += 1
+
+        if self.health_failures < HEALTH_FAILURES:
+            return
+
+        print('%s DNS queries through the tunnel failed, asking OpenVPN to'
+              ' reconnect' % self.health_failures, flush=True)
+
+        self.connected = False
+        self.health_failures = 0
+        self.start_outage('health check failed')
+        self.management.send('signal SIGUSR1')
+
+    def start_outage(self, reason):
+        if self.outage is not None:
+            return
+
+        print('Outage started: %s' % reason, flush=True)
+        self.outage = {'start': time.time(), 'reason': reason}
+        self.reconnect_deadline = time.time() + RECONNECT_TIMEOUT
+
+    def end_outage(self):
+        if self.outage is None:
+            return
+
+        outage = self.outage
+        outage['end'] = time.time()
+        outage['duration'] = outage['end'] - outage['start']
+        self.outage = None
+
+        print('Outage ended after %.1f seconds' % outage['duration'], flush=True)
+
+        self.state.reload()
+
+        with self.state.transaction():
+            outages = self.state.get('outages') or []
+            outages.append(outage)
+
+            self.state.append('outages', outages[-MAX_OUTAGES:])
+            self.state.append('reconnect_count', (self.state.get('reconnect_count') or 0) + 1)
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def stop_openvpn(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+        self.state.reload()
+
+        with self.state.transaction():
+            for key in ('openvpn_pid', 'supervisor_pid'):
+                if self.state.get(key) is not None:
+                    self.state.remove(key)
+
+        for filename in (MANAGEMENT_SOCKET, self.config_filename):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+        print('OpenVPN supervisor stopped', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='vpc_vpn_pivot.supervisor')
+    parser.add_argument('--config', default=SUPERVISOR_CONFIG_FILE)
+    options = parser.parse_args()
+
+    supervisor = Supervisor(options.config)
+
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+
+    supervisor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import tempfile
+import subprocess
+
+from vpc_vpn_pivot.constants import (DATA_PATH,
+                                     CIPHER_BENCH_FILE,
+                                     DEFAULT_TUNING_PROFILE)
+from vpc_vpn_pivot.utils.which import which
+
+#
+# Data channel ciphers offered to the server, in order of preference. AWS
+# Client VPN endpoints use AES, so other ciphers are not benchmarked.
+#
+DATA_CIPHERS = ('AES-256-GCM', 'AES-128-GCM', 'AES-256-CBC', 'AES-128-CBC')
+
+#
+# Directives added by each profile, in the order they are written. A value of
+# '' is used for flags, eg. fast-io
+#
+PROFILE_DIRECTIVES = {
+    'default': [],
+    'throughput': [
+        ('sndbuf', '524288'),
+        ('rcvbuf', '524288'),
+        ('fast-io', ''),
+        ('data-ciphers', None),
+        ('allow-compression', 'no'),
+        ('ping', '10'),
+        ('ping-restart', '60'),
+    ],
+    'latency': [
+        ('sndbuf', '131072'),
+        ('rcvbuf', '131072'),
+        ('fast-io', ''),
+        ('tcp-nodelay', ''),
+        ('data-ciphers', None),
+        ('allow-compression', 'no'),
+        ('ping', '5'),
+        ('ping-restart', '30'),
+    ],
+}
+
+#
+# A directive is not added when the config already contains any of these
+#
+CONFLICTS = {
+    'ping': ('keepalive',),
+    'ping-restart': ('keepalive', 'ping-exit'),
+    'data-ciphers': ('ncp-ciphers', 'ncp-disable'),
+    'allow-compression': ('comp-lzo', 'compress'),
+}
+
+#
+# Directives which only apply to one transport protocol
+#
+PROTOCOLS = {
+    'fast-io': 'udp',
+    'tcp-nodelay': 'tcp',
+}
+
+#
+# Directives unknown to OpenVPN 2.4, ignored by older clients instead of
+# failing to start
+#
+NEWER_DIRECTIVES = ('data-ciphers', 'allow-compression')
+
+BENCH_RUNS = 3
+
+
+def parse_directives(openvpn_config_file):
+    """
+    :param openvpn_config_file: The OpenVPN config file contents
+    :return: A dict with the directive names found in the config and their
+             arguments. Comments and inline files (eg. <ca>) are ignored.
+    """
+    directives = {}
+    inline = None
+
+    for line in openvpn_config_file.splitlines():
+        line = line.strip()
+
+        if not line or line[0] in '#;':
+            continue
+
+        if inline is not None:
+            if line == '</%s>' % inline:
+                inline = None
+            continue
+
+        if line.startswith('<') and line.endswith('>'):
+            inline = line[1:-1]
+            continue
+
+        name, _, args = line.partition(' ')
+        directives[name] = args.strip()
+
+    return directives
+
+
+def apply_tuning(openvpn_config_file, profile=DEFAULT_TUNING_PROFILE):
+    """
+    Append the directives of a tuning profile to the OpenVPN config.
+
+    Directives which are already in the config, or which conflict with the
+    ones in it, are not added: the config exported by AWS always wins.
+
+    :param openvpn_config_file: The OpenVPN config file contents
+    :param profile: One of TUNING_PROFILES
+    :return: A tuple containing the updated config and a list with the
+             directives which were skipped
+    """
+    existing = parse_directives(openvpn_config_file)
+    protocol = 'tcp' if existing.get('proto', 'udp').startswith('tcp') else 'udp'
+
+    added = []
+    skipped = []
+
+    for name, args in PROFILE_DIRECTIVES[profile]:
+        if name in existing:
+            skipped.append((name, 'already set to "%s"' % existing[name]))
+            continue
+
+        conflicts = [c for c in CONFLICTS.get(name, ()) if c in existing]
+        if conflicts:
+            skipped.append((name, 'conflicts with %s' % ', '.join(conflicts)))
+            continue
+
+        if PROTOCOLS.get(name, protocol) != protocol:
+            skipped.append((name, 'only applies to %s' % PROTOCOLS[name]))
+            continue
+
+        if name == 'data-ciphers':
+            args = ':'.join(preferred_ciphers())
+
+        added.append((name, args))
+
+    if not added:
+        return openvpn_config_file, skipped
+
+    lines = ['', '', '# vpc-vpn-pivot tuning profile: %s' % profile]
+
+    newer = [name for name, _ in added if name in NEWER_DIRECTIVES]
+    if newer:
+        lines.append('ignore-unknown-option %s' % ' '.join(newer))
+
+    for name, args in added:
+        lines.append(('%s %s' % (name, args)).strip())
+
+    return openvpn_config_file + '\n'.join(lines) + '\n', skipped
+
+
+def preferred_ciphers():
+    """
+    :return: DATA_CIPHERS sorted by the results of `cipher-bench`, fastest
+             first. The default order is kept if the benchmark never ran.
+    """
+    results = load_cipher_bench()
+
+    def speed(cipher):
+        seconds = results.get(cipher)
+        return seconds if seconds is not None else float('inf')
+
+    if not results:
+        return list(DATA_CIPHERS)
+
+    return sorted(DATA_CIPHERS, key=speed)
+
+
+def load_cipher_bench():
+    """
+    :return: A dict containing cipher -> seconds, empty if `cipher-bench`
+             never ran
+    """
+    try:
+        with open(CIPHER_BENCH_FILE) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cipher_bench(results):
+    """
+    Save the cipher -> seconds results to CIPHER_BENCH_FILE
+    """
+    os.makedirs(DATA_PATH, exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(dir=DATA_PATH,
+                                         prefix='.cipher-bench-',
+                                         suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps(results, indent=4, sort_keys=True))
+
+    os.replace(temp_filename, CIPHER_BENCH_FILE)
+
+
+def cipher_bench(options):
+    """
+    Measure how fast each data channel cipher is on this CPU using
+    `openvpn --test-crypto`, the results are used by the tuning profiles to
+    sort the data-ciphers directive.
+
+    :param options: Options passed as command line arguments by the user
+    :return: Return code
+    """
+    openvpn_executables = which('openvpn')
+    if not openvpn_executables:
+        print('This command requires `openvpn` to be installed in your'
+              ' system.')
+        return 1
+
+    openvpn = openvpn_executables[0]
+    runs = getattr(options, 'runs', BENCH_RUNS)
+
+    key_directory = tempfile.mkdtemp(prefix='vpc-vpn-pivot-')
+    key_filename = os.path.join(key_directory, 'static.key')
+
+    try:
+        completed = subprocess.run([openvpn, '--genkey', '--secret', key_filename],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+
+        if completed.returncode != 0:
+            print('Failed to create the key for the benchmark:\n%s' % completed.stdout.decode())
+            return 1
+
+        results = {}
+
+        for cipher in DATA_CIPHERS:
+            seconds = bench_cipher(openvpn, key_filename, cipher, runs)
+            results[cipher] = seconds
+
+            if seconds is None:
+                print('    %-20s not supported' % cipher)
+            else:
+                print('    %-20s %8.3f seconds' % (cipher, seconds))
+    finally:
+        if os.path.exists(key_filename):
+            os.remove(key_filename)
+        os.rmdir(key_directory)
+
+    supported = {c: s for c, s in results.items() if s is not None}
+    if not supported:
+        print('None of the ciphers could be tested')
+        return 1
+
+    save_cipher_bench(supported)
+
+    print('')
+    print('Cipher preference for the tuning profiles: %s' % ':'.join(preferred_ciphers()))
+    return 0
+
+
+def bench_cipher(openvpn, key_filename, cipher, runs):
+    """
+    :return: The fastest of `runs` executions of `openvpn --test-crypto` for
+             `cipher`, in seconds. None if the cipher is not supported.
+    """
+    cmd = [openvpn,
+           '--test-crypto',
+           '--secret', key_filename,
+           '--cipher', cipher,
+           '--auth', 'SHA256',
+           '--verb', '0']
+
+    best = None
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run(cmd,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        spent = time.perf_counter() - start
+
+        if completed.returncode != 0:
+            return None
+
+        best = spent if best is None else min(best, spent)
+
+    return best
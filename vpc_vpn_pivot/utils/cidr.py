@@ -0,0 +1,153 @@
+import bisect
+import ipaddress
+
+
+def to_interval(prefix):
+    """
+    :param prefix: An IPv4 prefix, eg. 10.0.0.0/16, or an IPv4Network
+    :return: A (first address, last address) tuple with the addresses as
+             integers
+    """
+    network = ipaddress.ip_network(prefix, strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+def to_prefix(start, prefix_length):
+    """
+    :return: The prefix which starts at the `start` address (an integer)
+    """
+    return str(ipaddress.IPv4Network((start, prefix_length)))
+
+
+class PrefixIndex(object):
+    """
+    Sorted index of the IPv4 address ranges in use. Overlapping and adjacent
+    prefixes are merged when the index is built, so the lookups are binary
+    searches over disjoint intervals, no matter how many prefixes are added.
+    """
+    def __init__(self, prefixes=()):
+        self.pending = []
+        self.starts = []
+        self.ends = []
+
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        """
+        :param prefix: An IPv4 prefix, IPv6 prefixes are ignored
+        """
+        network = ipaddress.ip_network(prefix, strict=False)
+
+        if network.version != 4:
+            return
+
+        self.pending.append((int(network.network_address), int(network.broadcast_address)))
+
+    def build(self):
+        """
+        Merge the prefixes added since the last call into the index
+        """
+        if not self.pending:
+            return
+
+        intervals = sorted(list(zip(self.starts, self.ends)) + self.pending)
+        self.pending = []
+
+        starts = []
+        ends = []
+
+        for start, end in intervals:
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+                continue
+
+            starts.append(start)
+            ends.append(end)
+
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        self.build()
+        return len(self.starts)
+
+    def overlaps(self, prefix):
+        """
+        :return: True if any address of `prefix` is in use
+        """
+        self.build()
+
+        start, end = to_interval(prefix)
+        return self._overlapping(start, end) is not None
+
+    def first_free(self, prefix_length, lower, upper):
+        """
+        Find the lowest free block of `prefix_length` between `lower` and
+        `upper`, both inclusive
+
+        :param prefix_length: The size of the block, eg. 22 for a /22
+        :param lower: The first address (integer) the block can use
+        :param upper: The last address (integer) the block can use
+        :return: The first address of the block, None if there is no room
+        """
+        self.build()
+
+        size = 2 ** (32 - prefix_length)
+        start = _align_up(lower, size)
+
+        while start + size - 1 <= upper:
+            index = self._overlapping(start, start + size - 1)
+
+            if index is None:
+                return start
+
+            start = _align_up(self.ends[index] + 1, size)
+
+        return None
+
+    def last_free(self, prefix_length, lower, upper):
+        """
+        Find the highest free block of `prefix_length` between `lower` and
+        `upper`, both inclusive
+
+        :return: The first address of the block, None if there is no room
+        """
+        self.build()
+
+        size = 2 ** (32 - prefix_length)
+
+        if upper + 1 < size:
+            return None
+
+        start = _align_down(upper + 1 - size, size)
+
+        while start >= lower:
+            index = self._overlapping(start, start + size - 1)
+
+            if index is None:
+                return start
+
+            start = _align_down(self.starts[index] - size, size)
+
+        return None
+
+    def _overlapping(self, start, end):
+        """
+        :return: The position of the interval with the highest start which
+                 overlaps [start, end], None if no interval does
+        """
+        index = bisect.bisect_right(self.starts, end) - 1
+
+        if index >= 0 and self.ends[index] >= start:
+            return index
+
+        return None
+
+
+def _align_up(address, size):
+    return -(-address // size) * size
+
+
+def _align_down(address, size):
+    return (address // size) * size
@@ -0,0 +1,208 @@
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+SUCCESS = 'success'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
+
+
+class Step(object):
+    def __init__(self, name, function, requires=()):
+        """
+        :param name: Unique step name
+        :param function: The function to run, receives a Context instance.
+                         The step fails if the function raises an exception
+                         or returns False.
+        :param requires: Names of the steps which need to succeed before this
+                         one can start
+        """
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
+
+
+class StepResult(object):
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.value = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def spent(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class Context(object):
+    """
+    Shared by all the steps. The value returned by each successful step is
+    stored in `results` using the step name as key, so steps can consume the
+    output of the steps they require.
+
+    Long running steps should check `cancelled` and return early when it is
+    set.
+    """
+    def __init__(self, options):
+        self.options = options
+        self.results = {}
+        self.cancelled = threading.Event()
+
+
+def run_steps(steps, options=None, max_workers=8, cancel_on_failure=False,
+              listener=None):
+    """
+    Run the steps, starting each one as soon as all the steps it requires
+    have finished successfully. Steps which do not depend on each other run
+    concurrently. When a step fails all the steps that depend on it are
+    skipped, independent branches keep running unless `cancel_on_failure`
+    is set.
+
+    :param steps: A list of Step instances
+    :param options: Options passed as command line arguments by the user,
+                    available to the steps via Context.options
+    :param max_workers: Max number of steps to run at the same time
+    :param cancel_on_failure: When True the first failure sets
+                              Context.cancelled and the steps which did not
+                              start yet are cancelled
+    :param listener: Optional function called with the StepResult each time
+                     a step starts or finishes, from the thread which runs
+                     the step
+    :return: A dict containing step name -> StepResult
+    """
+    _validate(steps)
+
+    context = Context(options)
+    lock = threading.Lock()
+
+    pending = list(steps)
+    results = dict((step.name, StepResult(step.name)) for step in steps)
+    running = {}
+
+    def notify(result):
+        if listener is None:
+            return
+
+        try:
+            listener(result)
+        except Exception as e:
+            print('Step listener failed: %s' % e)
+
+    def run_one(step):
+        result = results[step.name]
+        result.start = time.time()
+        notify(result)
+
+        try:
+            value = step.function(context)
+        except Exception as e:
+            result.error = e
+            result.status = FAILED
+            print('Step %s failed with unexpected exception: %s' % (step.name, e))
+        else:
+            result.value = value
+            result.status = FAILED if value is False else SUCCESS
+
+            with lock:
+                context.results[step.name] = value
+        finally:
+            result.end = time.time()
+
+        if result.status == FAILED and cancel_on_failure:
+            context.cancelled.set()
+
+        notify(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if context.cancelled.is_set():
+                for step in pending:
+                    results[step.name].status = CANCELLED
+                    print('Cancelled %s: another step failed' % step.name)
+                    notify(results[step.name])
+
+                pending = []
+
+            for step in pending[:]:
+                statuses = [results[r].status for r in step.requires]
+
+                if FAILED in statuses or SKIPPED in statuses or CANCELLED in statuses:
+                    results[step.name].status = SKIPPED
+                    pending.remove(step)
+                    print('Skipping %s: a required step did not succeed' % step.name)
+                    notify(results[step.name])
+                    continue
+
+                if all(s == SUCCESS for s in statuses):
+                    pending.remove(step)
+                    running[executor.submit(run_one, step)] = step
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                running.pop(future)
+
+    return results
+
+
+def all_succeeded(results):
+    return all(r.status == SUCCESS for r in results.values())
+
+
+def print_timings(results, wall_time):
+    """
+    Print a per-step timing summary
+
+    :param results: The dict returned by run_steps()
+    :param wall_time: Total seconds spent running the steps
+    """
+    print('')
+    print('Step timings:')
+
+    ordered = sorted(results.values(),
+                     key=lambda r: (r.start is None, r.start or 0))
+
+    for result in ordered:
+        args = (result.name, result.status, result.spent)
+        print('    %-40s %-8s %7.2fs' % args)
+
+    total = sum(r.spent for r in results.values())
+    print('    %-40s %-8s %7.2fs (sum of steps %.2fs)' % ('total', '', wall_time, total))
+    print('')
+
+
+def _validate(steps):
+    names = [step.name for step in steps]
+
+    if len(names) != len(set(names)):
+        raise ValueError('Step names must be unique')
+
+    for step in steps:
+        for required in step.requires:
+            if required not in names:
+                raise ValueError('Step %s requires unknown step %s' % (step.name, required))
+
+    #
+    # Detect dependency cycles, they would make run_steps() loop forever
+    #
+    requires = dict((step.name, step.requires) for step in steps)
+    resolved = set()
+
+    while len(resolved) != len(names):
+        ready = [n for n in names
+                 if n not in resolved and all(r in resolved for r in requires[n])]
+
+        if not ready:
+            raise ValueError('The steps contain a dependency cycle')
+
+        resolved.update(ready)
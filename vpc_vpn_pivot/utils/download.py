@@ -0,0 +1,225 @@
+import os
+import time
+import tarfile
+import hashlib
+
+#
+# (connect, read) timeouts in seconds passed to requests
+#
+DOWNLOAD_TIMEOUT = (10, 30)
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadStats(object):
+    def __init__(self):
+        self.bytes_downloaded = 0
+        self.bytes_resumed = 0
+        self.seconds = 0.0
+        self.peak_buffer = 0
+        self.peak_rss_kb = 0
+        self.sha256 = None
+
+    @property
+    def throughput(self):
+        """
+        :return: Downloaded bytes per second
+        """
+        if not self.seconds:
+            return 0.0
+        return self.bytes_downloaded / self.seconds
+
+    def __str__(self):
+        args = (self.bytes_downloaded / 1024.0,
+                self.seconds,
+                self.throughput / 1024.0,
+                self.bytes_resumed / 1024.0,
+                self.peak_buffer / 1024.0,
+                self.peak_rss_kb / 1024.0)
+        return ('%.1f KiB in %.2fs (%.1f KiB/s), %.1f KiB resumed,'
+                ' peak buffer %.1f KiB, peak RSS %.1f MiB' % args)
+
+
+class _StreamReader(object):
+    """
+    File-like object which reads from an iterator of chunks. Every chunk is
+    hashed and, unless it was replayed from the partial file, appended to it.
+
+    This is the `fileobj` consumed by tarfile in stream mode, so the download,
+    hashing, writing to disk and extraction happen in one pass without
+    keeping the whole file in memory.
+    """
+    def __init__(self, chunks, partial_file, stats):
+        self._chunks = chunks
+        self._partial_file = partial_file
+        self._stats = stats
+        self._buffer = b''
+        self._sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                chunk, replayed = next(self._chunks)
+            except StopIteration:
+                break
+
+            self._sha256.update(chunk)
+
+            if not replayed:
+                self._partial_file.write(chunk)
+                self._stats.bytes_downloaded += len(chunk)
+
+            self._buffer += chunk
+            self._stats.peak_buffer = max(self._stats.peak_buffer, len(self._buffer))
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+def stream_download(url, filename, extract_to=None, expected_sha256=None,
+                    timeout=DOWNLOAD_TIMEOUT, resume=True):
+    """
+    Download `url` to `filename`, optionally extracting the tarball while it
+    is being downloaded.
+
+    The data is written to `filename`.part and renamed once the download
+    completes and the checksum is verified. If a previous download was
+    interrupted the partial file is reused and only the missing bytes are
+    requested using a HTTP range request.
+
+    :param url: The URL to download
+    :param filename: Where to store the downloaded file
+    :param extract_to: Directory where the tarball members are extracted,
+                       None to only download the file
+    :param expected_sha256: Optional SHA-256 to verify the download against
+    :param timeout: (connect, read) timeout in seconds
+    :param resume: Reuse the partial file from a previous download
+    :return: A DownloadStats instance, raises DownloadError on failure
+    """
+    import requests
+
+    partial_filename = filename + '.part'
+    offset = 0
+
+    if resume and os.path.exists(partial_filename):
+        offset = os.path.getsize(partial_filename)
+    elif os.path.exists(partial_filename):
+        os.remove(partial_filename)
+
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%s-' % offset
+
+    stats = DownloadStats()
+    start = time.time()
+
+    try:
+        response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    except Exception as e:
+        raise DownloadError('Failed to download %s: %s' % (url, e))
+
+    if offset and response.status_code == 416:
+        #
+        # The partial file is already complete
+        #
+        response.close()
+        response = None
+    elif offset and response.status_code != 206:
+        #
+        # The server ignored the range request, start from scratch
+        #
+        offset = 0
+
+    if response is not None and response.status_code not in (200, 206):
+        response.close()
+        raise DownloadError('Failed to download %s: HTTP %s' % (url, response.status_code))
+
+    stats.bytes_resumed = offset
+
+    def chunks():
+        if offset:
+            with open(partial_filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk, True
+
+        if response is None:
+            return
+
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                yield chunk, False
+
+    try:
+        with open(partial_filename, 'ab' if offset else 'wb') as partial_file:
+            reader = _StreamReader(chunks(), partial_file, stats)
+
+            if extract_to is not None:
+                extract_stream(reader, extract_to)
+
+            reader.drain()
+    except DownloadError:
+        raise
+    except Exception as e:
+        raise DownloadError('Failed to download %s: %s' % (url, e))
+    finally:
+        if response is not None:
+            response.close()
+
+    stats.seconds = time.time() - start
+    stats.sha256 = reader.hexdigest()
+    stats.peak_rss_kb = peak_rss_kb()
+
+    if expected_sha256 is not None and stats.sha256 != expected_sha256:
+        os.remove(partial_filename)
+        args = (url, stats.sha256, expected_sha256)
+        raise DownloadError('Checksum mismatch for %s: got %s, expected %s' % args)
+
+    os.replace(partial_filename, filename)
+
+    return stats
+
+
+def extract_stream(fileobj, path):
+    """
+    Extract a (optionally compressed) tarball read from a non-seekable
+    file-like object. Members which would be written outside `path` are
+    rejected.
+
+    :param fileobj: The file-like object to read from
+    :param path: The directory to extract to
+    """
+    root = os.path.realpath(path)
+
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        for member in tf:
+            target = os.path.realpath(os.path.join(root, member.name))
+
+            if target != root and not target.startswith(root + os.sep):
+                raise DownloadError('Refusing to extract %s' % member.name)
+
+            if hasattr(tarfile, 'data_filter'):
+                tf.extract(member, path=root, filter='data')
+            else:
+                tf.extract(member, path=root)
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -1,7 +1,11 @@
 import re
 import os
+import sys
+import hashlib
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
+
 
 def run_cmd(cmd, cwd='.', env=None):
     """
@@ -64,6 +68,38 @@ def read_file(filename):
     return open(filename, 'r').read()
 
 
+def sha256_file(filename):
+    """
+    :param filename: The file to hash
+    :return: The hex encoded SHA-256 of the file contents
+    """
+    h = hashlib.sha256()
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def pid_is_alive(pid):
+    """
+    :param pid: A process ID
+    :return: True if a process with that PID exists
+    """
+    if pid is None:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
 def is_root():
     """
     :return: True when the user running the command is root
@@ -72,3 +108,64 @@ def is_root():
         return True
 
     return False
+
+
+def spawn_detached(module, args, log_filename=None, extra_env=None):
+    """
+    Run `python -m module args` in a new session, the process keeps running
+    after the current one exits.
+
+    :param module: The module to run, eg. vpc_vpn_pivot.ssl.keypool
+    :param args: A list with the command line arguments
+    :param log_filename: Write stdout and stderr to this file, when None the
+                         output is discarded
+    :param extra_env: A dict with environment variables to set in the process
+    :return: The subprocess.Popen instance
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    env = os.environ.copy()
+    env.update(extra_env or {})
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (package_root, env.get('PYTHONPATH')) if p)
+    env['PYTHONUNBUFFERED'] = '1'
+
+    output = subprocess.DEVNULL
+    if log_filename is not None:
+        output = open(log_filename, 'ab')
+
+    try:
+        return subprocess.Popen([sys.executable, '-m', module] + list(args),
+                                stdin=subprocess.DEVNULL,
+                                stdout=output,
+                                stderr=subprocess.STDOUT,
+                                env=env,
+                                close_fds=True,
+                                start_new_session=True)
+    finally:
+        if log_filename is not None:
+            output.close()
+
+
+def map_concurrently(function, items, max_workers=8):
+    """
+    Call `function` for each item using a thread pool
+
+    :param function: A function which receives one item
+    :param items: The items to process
+    :param max_workers: Max number of concurrent calls
+    :return: A list with one (item, value, exception) tuple per item, in the
+             same order as `items`. `exception` is None on success.
+    """
+    items = list(items)
+
+    if not items:
+        return []
+
+    def call(item):
+        try:
+            return item, function(item), None
+        except Exception as e:
+            return item, None, e
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
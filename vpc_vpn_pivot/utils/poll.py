@@ -0,0 +1,56 @@
+import time
+import random
+
+
+class Backoff(object):
+    """
+    Polling intervals which start short and grow exponentially up to `cap`.
+    Each delay is randomized by +/- `jitter` (a fraction of the delay) to
+    prevent several pollers from hitting the API at the same time.
+    """
+    def __init__(self, initial=1.0, factor=1.5, cap=5.0, jitter=0.2):
+        self.initial = initial
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+        self._current = initial
+
+    def next_delay(self):
+        delay = self._current
+        self._current = min(self._current * self.factor, self.cap)
+
+        spread = delay * self.jitter
+        return max(0.0, delay + random.uniform(-spread, spread))
+
+
+def wait_until(check, timeout=600, interval=5, cancelled=None):
+    """
+    Call `check` until it returns True or the timeout is reached.
+
+    :param check: A function without arguments
+    :param timeout: Max seconds to wait
+    :param interval: Seconds to sleep between calls, or a Backoff instance
+    :param cancelled: Optional threading.Event, when set the wait stops
+    :return: True if `check` returned True before the timeout
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        if check():
+            return True
+
+        if isinstance(interval, Backoff):
+            delay = interval.next_delay()
+        else:
+            delay = interval
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        delay = min(delay, remaining)
+
+        if cancelled is None:
+            time.sleep(delay)
+        elif cancelled.wait(delay):
+            return False
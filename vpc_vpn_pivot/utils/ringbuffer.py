@@ -0,0 +1,121 @@
+import os
+import struct
+
+#
+# magic, record size, capacity, next slot, number of records
+#
+HEADER = struct.Struct('<4sHIII')
+MAGIC = b'VVPR'
+
+
+class RingBuffer(object):
+    """
+    Fixed size file holding the last `capacity` records. Each record is packed
+    using `record_format` (see the struct module), so appending a record is a
+    single small write and the file never grows.
+
+    The file is recreated by append() if it was written using a different
+    format or capacity. read() never writes to the file.
+    """
+    def __init__(self, filename, record_format, capacity):
+        self.filename = filename
+        self.record = struct.Struct(record_format)
+        self.capacity = capacity
+
+    def append(self, values):
+        """
+        :param values: A tuple with the record values
+        """
+        with self._open() as f:
+            _next, count = self._read_header(f)
+
+            f.seek(HEADER.size + _next * self.record.size)
+            f.write(self.record.pack(*values))
+
+            _next = (_next + 1) % self.capacity
+            count = min(count + 1, self.capacity)
+
+            self._write_header(f, _next, count)
+
+    def read(self):
+        """
+        :return: A list with the records, oldest first
+        """
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return []
+
+        with f:
+            if not self._is_valid(f):
+                return []
+
+            _next, count = self._read_header(f)
+
+            f.seek(HEADER.size)
+            data = f.read(self.capacity * self.record.size)
+
+        records = []
+        first = (_next - count) % self.capacity
+
+        for i in range(count):
+            offset = ((first + i) % self.capacity) * self.record.size
+            records.append(self.record.unpack_from(data, offset))
+
+        return records
+
+    def clear(self):
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def _size(self):
+        return HEADER.size + self.capacity * self.record.size
+
+    def _is_valid(self, f):
+        """
+        :return: True if the open file has the size and header of this
+                 record format and capacity
+        """
+        f.seek(0)
+        header = f.read(HEADER.size)
+
+        if len(header) != HEADER.size or os.fstat(f.fileno()).st_size != self._size():
+            return False
+
+        magic, record_size, capacity, _, _ = HEADER.unpack(header)
+
+        return (magic == MAGIC and
+                record_size == self.record.size and
+                capacity == self.capacity)
+
+    def _open(self):
+        size = self._size()
+
+        try:
+            f = open(self.filename, 'r+b')
+        except FileNotFoundError:
+            f = None
+        else:
+            if not self._is_valid(f):
+                f.close()
+                f = None
+
+        if f is None:
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+
+            f = open(self.filename, 'w+b')
+            f.truncate(size)
+            self._write_header(f, 0, 0)
+
+        return f
+
+    def _read_header(self, f):
+        f.seek(0)
+        _, _, _, _next, count = HEADER.unpack(f.read(HEADER.size))
+        return _next, count
+
+    def _write_header(self, f, _next, count):
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, self.record.size, self.capacity, _next, count))
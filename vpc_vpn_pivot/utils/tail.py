@@ -1,13 +1,181 @@
-def tail(f, n):
+import os
+import time
+import shutil
+
+TAIL_BLOCK_SIZE = 8 * 1024
+
+
+def tail(f, n, block_size=TAIL_BLOCK_SIZE):
+    """
+    Return the last `n` lines of a file. The file is read backwards in blocks
+    until enough lines were found, so the I/O is bounded by the size of the
+    last `n` lines and not by the size of the file.
+
+    :param f: A file object opened in text or binary mode
+    :param n: The number of lines to return
+    :param block_size: Bytes to read on each step
+    :return: A list with the lines
+    """
     assert n >= 0
-    pos, lines = n+1, []
-    while len(lines) <= n:
+
+    if n == 0:
+        return []
+
+    raw = getattr(f, 'buffer', f)
+
+    raw.seek(0, os.SEEK_END)
+    position = raw.tell()
+    data = b''
+
+    #
+    # n + 1 line separators are needed to be sure the first of the last n
+    # lines is complete, unless the beginning of the file is reached
+    #
+    while position > 0 and data.count(b'\n') <= n:
+        size = min(block_size, position)
+        position -= size
+
+        raw.seek(position)
+        data = raw.read(size) + data
+
+    lines = data.splitlines(True)[-n:]
+
+    if raw is f:
+        return lines
+
+    return [line.decode('utf-8', errors='replace') for line in lines]
+
+
+def rotate(filename, backups, copy_truncate=False):
+    """
+    Rename `filename` to `filename`.1, shifting the existing backups up to
+    `filename`.`backups`. The oldest backup is removed.
+
+    :param filename: The file to rotate
+    :param backups: The number of old files to keep
+    :param copy_truncate: Copy the file to `filename`.1 and truncate it
+                          instead of renaming it. Use it for files which
+                          another process keeps open in append mode.
+    :return: True if the file was rotated
+    """
+    if not os.path.exists(filename):
+        return False
+
+    if backups <= 0:
+        if copy_truncate:
+            os.truncate(filename, 0)
+        else:
+            os.remove(filename)
+        return True
+
+    for i in range(backups - 1, 0, -1):
+        source = '%s.%s' % (filename, i)
+
+        if os.path.exists(source):
+            os.replace(source, '%s.%s' % (filename, i + 1))
+
+    if copy_truncate:
+        shutil.copyfile(filename, '%s.1' % filename)
+        os.truncate(filename, 0)
+    else:
+        os.replace(filename, '%s.1' % filename)
+
+    return True
+
+
+def rotate_if_larger(filename, max_size, backups):
+    """
+    Rotate `filename` using copy and truncate when it is larger than
+    `max_size` bytes
+
+    :return: True if the file was rotated
+    """
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        return False
+
+    if size <= max_size:
+        return False
+
+    return rotate(filename, backups, copy_truncate=True)
+
+
+class LogFollower(object):
+    """
+    Incrementally read the lines appended to a file. The offset of the last
+    complete line is tracked, so each call only reads the new data.
+
+    Truncated and rotated files are detected, in both cases the reading
+    starts again from the beginning of the (new) file.
+    """
+    def __init__(self, filename, offset=0):
+        self.filename = filename
+        self.offset = offset
+        self._partial = ''
+        self._inode = None
+
+    def read_lines(self):
+        """
+        :return: A list with the complete lines written since the last call
+        """
         try:
-            f.seek(-pos, 2)
-        except IOError:
-            f.seek(0)
-            break
-        finally:
-            lines = list(f)
-        pos *= 2
-    return lines[-n:]
+            f = open(self.filename, 'r', errors='replace')
+        except FileNotFoundError:
+            return []
+
+        with f:
+            stat = os.fstat(f.fileno())
+
+            if self._inode is not None and stat.st_ino != self._inode:
+                #
+                # The file was rotated, start from the beginning of the new one
+                #
+                self.offset = 0
+                self._partial = ''
+
+            self._inode = stat.st_ino
+
+            if stat.st_size < self.offset:
+                #
+                # The file was truncated, start from the beginning
+                #
+                self.offset = 0
+                self._partial = ''
+
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+
+        data = self._partial + data
+        lines = data.splitlines(True)
+
+        if lines and not lines[-1].endswith('\n'):
+            self._partial = lines.pop()
+        else:
+            self._partial = ''
+
+        return lines
+
+
+def follow(filename, is_done, poll_interval=0.5, offset=0):
+    """
+    Yield the lines appended to `filename` until `is_done` returns True
+
+    :param filename: The file to follow
+    :param is_done: A function without arguments, called after each poll
+    :param poll_interval: Seconds to wait between polls
+    :param offset: Start reading at this offset
+    """
+    follower = LogFollower(filename, offset)
+
+    while True:
+        done = is_done()
+
+        for line in follower.read_lines():
+            yield line
+
+        if done:
+            return
+
+        time.sleep(poll_interval)
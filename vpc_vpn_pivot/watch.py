@@ -0,0 +1,300 @@
+import os
+import math
+import time
+import random
+import socket
+import struct
+
+from datetime import datetime
+
+from vpc_vpn_pivot.state import State
+from vpc_vpn_pivot.constants import (OPENVPN_LOG_FILE,
+                                     TUNNEL_SAMPLES_FILE,
+                                     TUNNEL_SAMPLES_SIZE)
+from vpc_vpn_pivot.utils.misc import pid_is_alive
+from vpc_vpn_pivot.connect import TUN_DEVICE_RE
+from vpc_vpn_pivot.utils.tail import tail, LogFollower
+from vpc_vpn_pivot.utils.ringbuffer import RingBuffer
+
+PROC_NET_DEV = '/proc/net/dev'
+
+WATCH_INTERVAL = 1.0
+DNS_TIMEOUT = 1.0
+DNS_QUERY_NAME = 'amazonaws.com'
+
+#
+# Lines read from the end of the OpenVPN log to find the last handshake when
+# the watch starts, after that the log is followed incrementally
+#
+HANDSHAKE_CONTEXT_LINES = 500
+HANDSHAKE = 'Peer Connection Initiated'
+
+#
+# timestamp, rx bytes/s, tx bytes/s, rx packets/s, tx packets/s, rtt ms
+# (NaN when the DNS server did not answer)
+#
+SAMPLE_FORMAT = '<dddddd'
+
+
+def get_samples():
+    return RingBuffer(TUNNEL_SAMPLES_FILE, SAMPLE_FORMAT, TUNNEL_SAMPLES_SIZE)
+
+
+def watch(openvpn_pid):
+    """
+    Print the tunnel throughput, latency and time since the last handshake
+    every second until the OpenVPN process exits or the user hits Ctrl+C.
+
+    Each reading is stored in the samples ring buffer, `status` uses them to
+    print the recent min / avg / p95.
+
+    :param openvpn_pid: The PID of the OpenVPN client
+    :return: Return code
+    """
+    state = State()
+
+    device = state.get('tun_device') or find_tun_device()
+    if device is None or read_interface_counters(device) is None:
+        print('Failed to find the tun device used by the VPN connection')
+        return 1
+
+    dns_server = state.get('probe_dns_server')
+
+    handshake = HandshakeTracker()
+    samples = get_samples()
+
+    if dns_server is None:
+        print('Watching %s, the VPC DNS server is unknown and the RTT is not'
+              ' measured (Ctrl+C to stop)' % device)
+    else:
+        print('Watching %s, RTT measured to the VPC DNS server %s (Ctrl+C to stop)'
+              % (device, dns_server))
+    print('')
+
+    last_counters = read_interface_counters(device)
+    last_time = time.time()
+
+    try:
+        while pid_is_alive(openvpn_pid):
+            time.sleep(WATCH_INTERVAL)
+
+            counters = read_interface_counters(device)
+            now = time.time()
+
+            if counters is None:
+                break
+
+            elapsed = now - last_time
+            rates = [(new - old) / elapsed for new, old in zip(counters, last_counters)]
+
+            rtt = dns_rtt(dns_server) if dns_server is not None else None
+
+            samples.append([now] + rates + [math.nan if rtt is None else rtt])
+            print_sample(rates, rtt, handshake.seconds_since())
+
+            last_counters = counters
+            last_time = now
+    except KeyboardInterrupt:
+        return 0
+
+    print('')
+    print('The OpenVPN process exited')
+    return 1
+
+
+def print_sample(rates, rtt, handshake_age):
+    rx_bytes, tx_bytes, rx_packets, tx_packets = rates
+
+    rtt = '%6.1f ms' % rtt if rtt is not None else '   - ms'
+    handshake_age = '%6.0fs ago' % handshake_age if handshake_age is not None else '     never'
+
+    args = (rx_bytes / 1024.0, rx_packets, tx_bytes / 1024.0, tx_packets, rtt, handshake_age)
+    print('    rx %9.1f KiB/s %7.0f pkt/s   tx %9.1f KiB/s %7.0f pkt/s'
+          '   rtt %s   handshake %s' % args, flush=True)
+
+
+def print_summary():
+    """
+    Print the min / avg / p95 of the samples collected by `status --watch`
+
+    :return: True if there were samples to show
+    """
+    records = get_samples().read()
+    if not records:
+        return False
+
+    window = records[-1][0] - records[0][0]
+
+    print('')
+    print('Tunnel statistics for the last %.0f seconds (%s samples):' % (window, len(records)))
+    print('')
+    print('    %-20s %12s %12s %12s' % ('', 'min', 'avg', 'p95'))
+
+    columns = (('rx KiB/s', 1, 1024.0),
+               ('tx KiB/s', 2, 1024.0),
+               ('rx pkt/s', 3, 1.0),
+               ('tx pkt/s', 4, 1.0),
+               ('rtt ms', 5, 1.0))
+
+    for name, index, scale in columns:
+        values = [r[index] / scale for r in records if not math.isnan(r[index])]
+
+        if not values:
+            print('    %-20s %12s %12s %12s' % (name, '-', '-', '-'))
+            continue
+
+        args = (name, min(values), sum(values) / len(values), percentile(values, 95))
+        print('    %-20s %12.1f %12.1f %12.1f' % args)
+
+    return True
+
+
+def percentile(values, p):
+    """
+    :return: The `p` percentile of `values` using the nearest-rank method
+    """
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def read_interface_counters(device):
+    """
+    Read the counters of a network interface from /proc/net/dev
+
+    :param device: The interface name, eg. tun0
+    :return: A tuple containing rx bytes, tx bytes, rx packets and tx packets,
+             or None if the interface does not exist
+    """
+    try:
+        f = open(PROC_NET_DEV)
+    except FileNotFoundError:
+        return None
+
+    with f:
+        for line in f:
+            name, sep, counters = line.partition(':')
+
+            if not sep or name.strip() != device:
+                continue
+
+            counters = counters.split()
+            return (int(counters[0]),
+                    int(counters[8]),
+                    int(counters[1]),
+                    int(counters[9]))
+
+    return None
+
+
+def find_tun_device():
+    """
+    :return: The tun device opened by OpenVPN, found in its log
+    """
+    if not os.path.exists(OPENVPN_LOG_FILE):
+        return None
+
+    with open(OPENVPN_LOG_FILE) as f:
+        lines = tail(f, HANDSHAKE_CONTEXT_LINES)
+
+    for line in reversed(lines):
+        match = TUN_DEVICE_RE.search(line)
+        if match:
+            return match.group(1)
+
+    return None
+
+
+def dns_rtt(server, timeout=DNS_TIMEOUT):
+    """
+    Send one DNS query to `server` and measure the time until the answer
+    arrives. Use the VPC DNS server (`probe_dns_server` in the state), the
+    route to the VPC goes through the tunnel.
+
+    :param server: The DNS server IP address
+    :param timeout: Max seconds to wait for the answer
+    :return: The round trip time in milliseconds, None on timeout or error
+    """
+    query_id = random.randint(0, 0xffff)
+
+    query = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    for label in DNS_QUERY_NAME.split('.'):
+        query += struct.pack('B', len(label)) + label.encode('ascii')
+    query += struct.pack('>BHH', 0, 1, 1)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+
+    try:
+        start = time.perf_counter()
+        sock.sendto(query, (server, 53))
+
+        while True:
+            response = sock.recv(512)
+
+            if len(response) >= 2 and struct.unpack('>H', response[:2])[0] == query_id:
+                return (time.perf_counter() - start) * 1000.0
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def parse_log_time(line):
+    """
+    :return: The timestamp at the beginning of an OpenVPN log line, None if
+             the line doesn't start with one
+    """
+    formats = ((19, '%Y-%m-%d %H:%M:%S'),
+               (24, '%a %b %d %H:%M:%S %Y'))
+
+    for length, fmt in formats:
+        try:
+            return datetime.strptime(line[:length], fmt).timestamp()
+        except ValueError:
+            continue
+
+    return None
+
+
+class HandshakeTracker(object):
+    """
+    Track the time of the last TLS handshake logged by OpenVPN. The end of
+    the log is scanned once, then only the new lines are read.
+    """
+    def __init__(self):
+        self.last_handshake = None
+        self._follower = None
+
+        if not os.path.exists(OPENVPN_LOG_FILE):
+            return
+
+        with open(OPENVPN_LOG_FILE, 'rb') as f:
+            offset = f.seek(0, os.SEEK_END)
+            lines = tail(f, HANDSHAKE_CONTEXT_LINES)
+
+        for line in lines:
+            self._process(line.decode('utf-8', errors='replace'))
+
+        self._follower = LogFollower(OPENVPN_LOG_FILE, offset)
+
+    def seconds_since(self):
+        """
+        :return: Seconds since the last handshake, None if it is unknown
+        """
+        if self._follower is None:
+            self._follower = LogFollower(OPENVPN_LOG_FILE)
+
+        for line in self._follower.read_lines():
+            self._process(line)
+
+        if self.last_handshake is None:
+            return None
+
+        return max(time.time() - self.last_handshake, 0.0)
+
+    def _process(self, line):
+        if HANDSHAKE not in line:
+            return
+
+        self.last_handshake = parse_log_time(line) or time.time()